@@ -13,10 +13,10 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
 
-from sys import argv, exc_info
+from sys import argv, exc_info, exit
 from os.path import isfile
 from os import environ
-from tkinter import Tk
+from multiprocessing import freeze_support
 import subprocess
 from subprocess import check_output, STDOUT, PIPE
 from re import search
@@ -24,7 +24,6 @@ import logging
 from saddlebags.AlleleSubCommon import showInfoBox
 from saddlebags.Logging import initializeLog
 from saddlebags.SaddlebagsConfig import loadConfigurationFile
-from saddlebags.AlleleSubMainGui import AlleleSubMainGui
 from saddlebags.EnaSubJar import findJarFile
 
 # TODO: Version has never really been updated
@@ -99,6 +98,8 @@ def checkPrerequisites():
     # TODO: Anything to check for google drive submission?
 
 if __name__=='__main__':
+    # The batch generation worker processes need this inside a compiled exe file.
+    freeze_support()
     try:
         # This is a really simple way to read commandline args, 
         # because there really shouldn't be any.
@@ -110,6 +111,10 @@ if __name__=='__main__':
             loadConfigurationFile()
             checkPrerequisites()
 
+            # tkinter is imported here, so the headless command line never needs it.
+            from tkinter import Tk
+            from saddlebags.AlleleSubMainGui import AlleleSubMainGui
+
             logging.info('*******Starting Saddlebags*******')
             root = Tk()
             AlleleSubMainGui(root).pack()
@@ -128,11 +133,19 @@ if __name__=='__main__':
             pass
             #
 
-        # You executed the software wrong.  Sorry. 
+        # Headless command line, for pipelines and servers without a display.
+        # The command line module is only imported here, so starting the GUI does not import the local annotation and batch modules.
         else:
+            from saddlebags.AlleleSubMainCli import runCommandLine, commandLineCommands
+            if (argv[1].lower() in commandLineCommands):
+                exit(runCommandLine(argv[1:]))
+
+            # You executed the software wrong.  Sorry. 
             print("usage:\n" + 
                 "\tRun this program using standard python call:\n" + 
                 "\t$python AlleleSubmissionMain.py\n" + 
+                "\tOr without a display, using one of the commands " + ', '.join(commandLineCommands) + ":\n" +
+                "\t$python AlleleSubMain.py convert-ena submissions.csv -o ENA.HLA.Submission.txt\n" + 
                 "\tbiopython must be accessible in your python environment.  To run using Anaconda,\n"
                 "\tCheck readme at https://github.com/transplantation-immunology-maastricht/saddle-bags\n"
             )
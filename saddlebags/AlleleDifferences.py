@@ -0,0 +1,180 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import join
+from sys import exc_info
+
+from saddlebags.AlleleSubCommon import getSaddlebagsDirectory
+from saddlebags.CodonTranslation import translateCodon
+from saddlebags.HlaSequence import cleanSequence
+from saddlebags.HlaSequenceException import HlaSequenceException
+from saddlebags.LocalAnnotation import getLocalAnnotator
+from saddlebags.ReferenceDatabase import getReferenceDatabase
+
+import logging
+
+# Describe how a novel allele differs from its closest IMGT/HLA reference allele, for the "identical except" description
+# (closestAlleleWrittenDescription) of an IPD submission.
+# The sequence is aligned to the closest reference allele of the local database. The positions are in the genomic coordinates
+# of the reference allele, with the reference feature they are in. Substitutions in exons are translated, to show the amino acid change.
+
+# The length of the signal peptide of each locus, in codons. IMGT/HLA numbers the codons of the mature protein from 1,
+# the codons of the signal peptide are numbered backwards from -1, there is no codon 0.
+signalPeptideLengths = {'A': 24, 'B': 24, 'C': 24, 'DRA': 25, 'DRB1': 29, 'DRB3': 29, 'DRB4': 29, 'DRB5': 29
+    , 'DQA1': 23, 'DQB1': 32, 'DPA1': 31, 'DPB1': 29}
+
+def findSequenceDifferences(referenceSequence, querySequence, aligner):
+    # Returns a list of tuples (referencePosition, referenceText, queryText). referencePosition is 1-based.
+    # A substitution has one nucleotide in both texts, an insertion (after referencePosition) has an empty referenceText,
+    # and a deletion has an empty queryText. The parts of either sequence beyond the ends of the other are not differences.
+    referenceSequence = referenceSequence.upper()
+    querySequence = querySequence.upper()
+    sequenceAlignment = aligner.align(referenceSequence, querySequence)[0]
+
+    sequenceDifferences = []
+    previousReferenceEnd = None
+    previousQueryEnd = None
+    for (referenceBegin, referenceEnd), (queryBegin, queryEnd) in zip(*sequenceAlignment.aligned):
+        # The gap between this aligned block and the previous one.
+        if (previousReferenceEnd is not None):
+            referenceGap = referenceSequence[previousReferenceEnd:referenceBegin]
+            queryGap = querySequence[previousQueryEnd:queryBegin]
+            if (len(referenceGap) == 0):
+                sequenceDifferences.append((previousReferenceEnd, '', queryGap))
+            elif (len(referenceGap) > 0 or len(queryGap) > 0):
+                sequenceDifferences.append((previousReferenceEnd + 1, referenceGap, queryGap))
+
+        for blockIndex in range(0, referenceEnd - referenceBegin):
+            if (referenceSequence[referenceBegin + blockIndex] != querySequence[queryBegin + blockIndex]):
+                sequenceDifferences.append((referenceBegin + blockIndex + 1, referenceSequence[referenceBegin + blockIndex], querySequence[queryBegin + blockIndex]))
+        previousReferenceEnd = referenceEnd
+        previousQueryEnd = queryEnd
+    return sequenceDifferences
+
+def findFeature(featureCoordinates, referencePosition):
+    # Returns the (featureName, beginIndex, endIndex, exon) that contains a 1-based position, and the number of exon
+    # nucleotides before that position. The feature is None if the position is outside of the features.
+    exonLength = 0
+    for featureName, beginIndex, endIndex, isExon in featureCoordinates:
+        if (beginIndex <= referencePosition <= endIndex):
+            return (featureName, beginIndex, endIndex, isExon), exonLength + (referencePosition - beginIndex if isExon else 0)
+        if (isExon):
+            exonLength += endIndex - beginIndex + 1
+    return None, exonLength
+
+def getIndefiniteArticle(letterText):
+    # 'an A', 'a G'. The names of these letters start with a vowel sound.
+    return 'an' if letterText[0:1].upper() in 'AEFHILMNORSX' else 'a'
+
+def getCodonText(codonNumber, locus):
+    # codonNumber is counted from the start codon, which is codon 1. It is numbered like IMGT/HLA if we know the signal peptide of the locus.
+    signalPeptideLength = signalPeptideLengths.get(str(locus).replace('HLA-', ''))
+    if (signalPeptideLength is None):
+        return 'codon ' + str(codonNumber) + ' (counted from the start codon)'
+    if (codonNumber <= signalPeptideLength):
+        return 'codon ' + str(codonNumber - signalPeptideLength - 1)
+    return 'codon ' + str(codonNumber - signalPeptideLength)
+
+def describeAminoAcidChange(exonSequence, codingPosition, queryNucleotide, locus=None):
+    # codingPosition is the 0-based position of a substitution in the exon sequence, which begins with the start codon.
+    # Returns None if the amino acid is the same.
+    codonBegin = codingPosition - codingPosition % 3
+    referenceCodon = exonSequence[codonBegin:codonBegin + 3]
+    if (len(referenceCodon) < 3):
+        return None
+    queryCodon = referenceCodon[0:codingPosition % 3] + queryNucleotide + referenceCodon[codingPosition % 3 + 1:]
+    referenceAminoAcid = translateCodon(referenceCodon)
+    queryAminoAcid = translateCodon(queryCodon)
+    if (referenceAminoAcid == queryAminoAcid):
+        return None
+    return (getCodonText(codonBegin // 3 + 1, locus) + ' changes from ' + ('a stop codon' if referenceAminoAcid == '*' else referenceAminoAcid)
+        + ' to ' + ('a stop codon' if queryAminoAcid == '*' else queryAminoAcid))
+
+def describeDifference(sequenceDifference, featureCoordinates, exonSequence, locus=None):
+    referencePosition, referenceText, queryText = sequenceDifference
+    feature, codingPosition = findFeature(featureCoordinates, max(referencePosition, 1))
+    featureText = '' if feature is None else ' (' + feature[0] + ')'
+
+    if (len(referenceText) == 0):
+        differenceText = 'an insertion of ' + queryText + ' after position ' + str(referencePosition) + featureText
+    elif (len(queryText) == 0):
+        differenceText = ('a deletion of position' + (' ' if len(referenceText) == 1 else 's ') + str(referencePosition)
+            + ('' if len(referenceText) == 1 else '-' + str(referencePosition + len(referenceText) - 1)) + featureText)
+    elif (len(referenceText) == 1 and len(queryText) == 1):
+        differenceText = 'position ' + str(referencePosition) + featureText + ' is ' + getIndefiniteArticle(queryText) + ' ' + queryText + ' instead of ' + referenceText
+        if (feature is not None and feature[3] and exonSequence is not None):
+            aminoAcidChange = describeAminoAcidChange(exonSequence, codingPosition, queryText, locus)
+            if (aminoAcidChange is not None):
+                differenceText += ', ' + aminoAcidChange
+    else:
+        differenceText = ('positions ' + str(referencePosition) + '-' + str(referencePosition + len(referenceText) - 1) + featureText
+            + ' are ' + queryText + ' instead of ' + referenceText)
+
+    # Insertions and deletions in an exon shift the reading frame, unless they are a multiple of 3 long.
+    if (feature is not None and feature[3] and (len(queryText) - len(referenceText)) % 3 != 0):
+        differenceText += ', causing a frameshift'
+    return differenceText
+
+def describeAlleleDifferences(newAlleleName, closestAlleleName, sequenceDifferences, featureCoordinates, exonSequence):
+    # The "identical except" text. Each difference is on its own line, they become separate CC lines in the IPD submission.
+    closestAlleleName = str(closestAlleleName).replace('HLA-', '')
+    locus = closestAlleleName.split('*')[0]
+    if (len(sequenceDifferences) == 0):
+        return str(newAlleleName) + ' is identical to ' + closestAlleleName + '.'
+    differenceTexts = [describeDifference(sequenceDifference, featureCoordinates, exonSequence, locus) for sequenceDifference in sequenceDifferences]
+    if (len(differenceTexts) == 1):
+        return str(newAlleleName) + ' is identical to ' + closestAlleleName + ' except for ' + differenceTexts[0] + '.'
+    return (str(newAlleleName) + ' is identical to ' + closestAlleleName + ' except for these differences:\n'
+        + '\n'.join(differenceText + '.' for differenceText in differenceTexts))
+
+def describeNovelAllele(submission, databaseFullPath=None):
+    # Returns a tuple (closestAlleleName, description) for the submitted allele, compared to the closest allele in the local database.
+    if (databaseFullPath is None):
+        databaseFullPath = join(getSaddlebagsDirectory(), 'SeqAnnDatabase.db')
+    hlaSequence = submission.submittedAllele
+    if (hlaSequence.geneLocus is None or len(str(hlaSequence.geneLocus)) < 1):
+        raise HlaSequenceException('The gene locus is needed to find the closest allele.')
+    querySequence = cleanSequence(hlaSequence.rawSequence if len(hlaSequence.features) == 0 else hlaSequence.getAnnotatedSequence(includeLineBreaks=False)).upper()
+    if (len(querySequence) < 1):
+        raise HlaSequenceException('The sequence is empty.')
+
+    localAnnotator = getLocalAnnotator(hlaSequence.geneLocus, databaseFullPath)
+    closestIndex = localAnnotator.findClosestAllele(querySequence)
+    if (closestIndex is None):
+        raise HlaSequenceException('The sequence is not similar to any reference allele of ' + str(hlaSequence.geneLocus))
+    closestAlleleName, annotatedReference = localAnnotator.referenceAlleles[closestIndex]
+
+    referenceDatabase = getReferenceDatabase(databaseFullPath)
+    sequenceDifferences = findSequenceDifferences(annotatedReference, querySequence, localAnnotator.aligner)
+    newAlleleName = submission.localAlleleName if submission.localAlleleName is not None else closestAlleleName.replace('HLA-', '') + 'new'
+    return closestAlleleName, describeAlleleDifferences(newAlleleName, closestAlleleName, sequenceDifferences
+        , referenceDatabase.getFeatureCoordinates(closestAlleleName), referenceDatabase.getExonSequence(closestAlleleName))
+
+def describeNovelAlleles(submissionBatch, databaseFullPath=None, overwrite=False):
+    # Fill in the closestAlleleWrittenDescription of every submission in the batch that doesn't have one yet.
+    # Returns a list of tuples (submission, errorMessage), errorMessage is None if the description was written or was already there.
+    describeResults = []
+    for submission in submissionBatch.submissionBatch:
+        if (not overwrite and submission.closestAlleleWrittenDescription is not None and len(str(submission.closestAlleleWrittenDescription).strip()) > 0):
+            describeResults.append((submission, None))
+            continue
+        try:
+            closestAlleleName, description = describeNovelAllele(submission, databaseFullPath)
+            submission.closestAlleleWrittenDescription = description
+            describeResults.append((submission, None))
+        except Exception:
+            logging.error('Could not describe the differences of allele ' + str(submission.localAlleleName) + ':' + str(exc_info()[1]))
+            describeResults.append((submission, str(exc_info()[1])))
+    return describeResults
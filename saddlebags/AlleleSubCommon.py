@@ -27,20 +27,40 @@ except Exception:
 
 from os import makedirs, name
 from os.path import expanduser, join, abspath, split, isdir
-from tkinter import messagebox, simpledialog
 
 import logging
 
+# In headless mode (the command line interface) there is no display. The popup boxes are logged instead.
+# tkinter is only imported when a box is shown, so the headless code never imports it.
+headlessMode = False
+
+def setHeadlessMode(headless):
+    global headlessMode
+    headlessMode = headless
+
 def showInfoBox(title, message):
     # A wrapper method for the tkinter popup box.
+    if headlessMode:
+        logging.warning(str(title) + ':' + str(message))
+        return
+    from tkinter import messagebox
     messagebox.showinfo(title, message)
 
 def getInfoBox(title, message):
     # wrapper to get a text input from the user.
+    if headlessMode:
+        logging.warning('Cannot ask for input without a display, ' + str(title) + ':' + str(message))
+        return None
+    from tkinter import simpledialog
     return simpledialog.askstring(title, message)
 
 def showYesNoBox(title, message):
     # A wrapper method for the tkinter ask yes/no question box.
+    # Without a display, the answer is always no.
+    if headlessMode:
+        logging.warning('Cannot ask a question without a display, answering no. ' + str(title) + ':' + str(message))
+        return False
+    from tkinter import messagebox
     response = messagebox.askquestion(title, message,icon='warning')
     # the response is a string, 'yes' or 'no'. That's really funny.
     return response == 'yes'
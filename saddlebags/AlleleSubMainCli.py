@@ -0,0 +1,284 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from argparse import ArgumentParser
+from os.path import abspath, join
+from sys import exc_info
+
+from saddlebags.AlleleSubCommon import setHeadlessMode, getSaddlebagsDirectory
+from saddlebags.SaddlebagsConfig import loadConfigurationFile, loadFromCSV, getConfigurationValue, assignConfigurationValue
+from saddlebags.IpdSubGenerator import createIPDZipFile
+from saddlebags.HlaSequence import HlaSequence
+from saddlebags.HlaSequenceException import HlaSequenceException
+from saddlebags.BatchAnnotation import annotateSequencesUsingService, annotateBatchUsingService
+from saddlebags.LocalAnnotation import annotateSequencesLocally, getLocalAnnotator, alignerBackends, configureLocalAligner
+from saddlebags.BandedAlignment import BandedAligner, benchmarkAligners
+from saddlebags.AlleleDifferences import describeNovelAlleles
+from saddlebags.SubmissionBatchGenerator import iterateSubmissionTexts, writeSubmissionBatch, getTranslationReport
+from saddlebags.SequenceFileReader import iterateSequenceFile
+from saddlebags.SequenceAnnotation import loadHLADataIntoSqlite, updateHLADataInSqlite
+
+import logging
+
+# The headless command line interface. This is for pipelines and servers without a display, nothing here imports tkinter.
+# python AlleleSubMain.py convert-ena submissions.csv -o ENA.HLA.Submission.txt
+# python AlleleSubMain.py convert-ipd submissions.csv -o IPD.HLA.Submission.zip
+# python AlleleSubMain.py convert-ipd submissions.csv -o IPD.HLA.Submission.zip --describe-differences
+# python AlleleSubMain.py convert-ena submissions.csv -o ENA.HLA.Submission.txt --annotate
+# python AlleleSubMain.py annotate sequences.fasta -o annotated.fasta
+# python AlleleSubMain.py annotate sequences.fasta -o annotated.fasta --local HLA-A
+# python AlleleSubMain.py validate submissions.csv
+# python AlleleSubMain.py load-imgt IMGTHLA_folder
+# python AlleleSubMain.py benchmark-aligners HLA-A
+
+commandLineCommands = ['convert-ena', 'convert-ipd', 'annotate', 'validate', 'load-imgt', 'benchmark-aligners']
+
+# Number of FASTA records that are read before they are sent to the annotation service.
+annotationChunkSize = 200
+
+def createArgumentParser():
+    parser = ArgumentParser(prog='AlleleSubMain.py', description='Create HLA allele submissions without the graphical interface.')
+    subParsers = parser.add_subparsers(dest='command')
+    subParsers.required = True
+
+    enaParser = subParsers.add_parser('convert-ena', help='Convert a .csv file of submissions to an ENA flatfile.')
+    enaParser.add_argument('csvFile', help='Input .csv file, in the same format as the Saddlebags .csv input.')
+    enaParser.add_argument('-o', '--output', required=True, help='Output flatfile. Every allele is a separate entry in this file.')
+
+    ipdParser = subParsers.add_parser('convert-ipd', help='Convert a .csv file of submissions to an IPD-IMGT/HLA .zip file.')
+    ipdParser.add_argument('csvFile', help='Input .csv file, in the same format as the Saddlebags .csv input.')
+    ipdParser.add_argument('-o', '--output', required=True, help='Output .zip file.')
+    ipdParser.add_argument('--describe-differences', action='store_true', help='Write the "identical except" description of each allele that does not have one, by comparing it to the closest allele in the local SeqAnn database.')
+    ipdParser.add_argument('-d', '--database', default=None, help='The local SeqAnn database. The default is SeqAnnDatabase.db in the saddlebags directory.')
+
+    annotateParser = subParsers.add_parser('annotate', help='Annotate the sequences in a .fasta file using the ACT service.')
+    annotateParser.add_argument('fastaFile', help='Input .fasta or .fastq file (can be gzipped) with one or more HLA sequences.')
+    annotateParser.add_argument('-o', '--output', required=True, help='Output .fasta file. Exons are uppercase, introns and UTRs are lowercase.')
+    annotateParser.add_argument('-n', '--in-flight', type=int, default=None, help='Number of annotation requests sent at the same time.')
+    annotateParser.add_argument('-l', '--local', metavar='LOCUS', default=None, help='Annotate offline against the reference alleles of this locus (ex. HLA-A) in the local SeqAnn database, instead of the ACT service.')
+    annotateParser.add_argument('-d', '--database', default=None, help='The local SeqAnn database. The default is SeqAnnDatabase.db in the saddlebags directory.')
+
+    validateParser = subParsers.add_parser('validate', help='Check that every submission in a .csv file can be generated.')
+    validateParser.add_argument('csvFile', help='Input .csv file, in the same format as the Saddlebags .csv input.')
+
+    loadParser = subParsers.add_parser('load-imgt', help='Load the reference alleles of an IMGT/HLA release, for the local annotation.')
+    loadParser.add_argument('hlaDataFolder', help='Folder with the hla.dat and Allelelist.txt files of the release.')
+    loadParser.add_argument('-d', '--database', default=None, help='The local SeqAnn database. The default is SeqAnnDatabase.db in the saddlebags directory.')
+    loadParser.add_argument('--full', action='store_true', help='Reload every allele. By default only the alleles that changed since the loaded release are written.')
+
+    benchmarkParser = subParsers.add_parser('benchmark-aligners', help='Time the alignment backends (the local_aligner config value) on the reference alleles of a locus in the local SeqAnn database.')
+    benchmarkParser.add_argument('locus', help='The locus, ex. HLA-A')
+    benchmarkParser.add_argument('-d', '--database', default=None, help='The local SeqAnn database. The default is SeqAnnDatabase.db in the saddlebags directory.')
+    benchmarkParser.add_argument('-s', '--samples', type=int, default=5, help='Number of reference alleles that are aligned against the first one.')
+
+    # Batch generation can use several worker processes. The defaults are in the config file.
+    for batchParser in (enaParser, ipdParser, validateParser):
+        batchParser.add_argument('-a', '--annotate', action='store_true', help='Annotate the sequences with the ACT service, instead of reading the exons from the uppercase letters of the sequence.')
+        batchParser.add_argument('-n', '--in-flight', type=int, default=None, help='Number of annotation requests sent at the same time, with --annotate.')
+        batchParser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes, 0 means one per CPU.')
+        batchParser.add_argument('-c', '--chunk-size', type=int, default=None, help='Number of submissions sent to a worker at once, 0 means automatic.')
+
+    return parser
+
+def loadSubmissionBatch(csvFileName, annotate=False):
+    # The batch information (IPD submitter, lab of origin...) comes from the configuration file.
+    # The submissions that were saved in the configuration are not part of this batch, only the submissions from the .csv.
+    submissionBatch = getConfigurationValue('submission_batch')
+    if (submissionBatch is not None):
+        submissionBatch.submissionBatch = []
+    submissionBatch = loadFromCSV(csvFileName)
+
+    # The sequences of the whole batch are annotated concurrently. An allele that could not be annotated has no features,
+    # it is reported again when its submission is generated.
+    if (annotate):
+        for submission, errorMessage in annotateBatchUsingService(submissionBatch):
+            if (errorMessage is not None):
+                logging.error('Could not annotate allele ' + str(submission.localAlleleName) + ':' + str(errorMessage))
+    return submissionBatch
+
+def printTranslationReport(submissionBatch):
+    # The translation problems of the whole batch together, instead of a warning box for each allele.
+    reportLines = getTranslationReport(submissionBatch)
+    if (len(reportLines) > 0):
+        print(str(len(reportLines)) + ' submission(s) have a problem in the translated protein:')
+        for reportLine in reportLines:
+            print('  ' + reportLine)
+
+def convertToEna(csvFileName, outputFileName, annotate=False):
+    submissionBatch = loadSubmissionBatch(csvFileName, annotate)
+    failureCount = 0
+
+    # Every allele is written into the same file. With a single worker the entries are generated directly into the file.
+    with open(outputFileName, 'w') as outputFile:
+        for submission, outputStream, errorMessage in writeSubmissionBatch(submissionBatch, 'ENA', lambda submission: outputFile
+            , int(getConfigurationValue('generation_worker_count')), int(getConfigurationValue('generation_chunk_size'))):
+            if (errorMessage is not None):
+                logging.error('Could not generate an ENA submission for allele ' + str(submission.localAlleleName) + ':' + str(errorMessage))
+                failureCount += 1
+
+    printTranslationReport(submissionBatch)
+    print('Wrote ' + str(len(submissionBatch.submissionBatch) - failureCount) + ' ENA submission(s) to ' + str(outputFileName))
+    return failureCount == 0
+
+def convertToIpd(csvFileName, outputFileName, describeDifferences=False, databaseFullPath=None, annotate=False):
+    submissionBatch = loadSubmissionBatch(csvFileName, annotate)
+
+    if (describeDifferences):
+        for submission, errorMessage in describeNovelAlleles(submissionBatch, databaseFullPath):
+            if (errorMessage is not None):
+                logging.warning('The differences of allele ' + str(submission.localAlleleName) + ' are not described:' + str(errorMessage))
+
+    createIPDZipFile(abspath(outputFileName))
+
+    print('Wrote ' + str(len(submissionBatch.submissionBatch)) + ' IPD-IMGT/HLA submission(s) to ' + str(outputFileName))
+    return True
+
+def annotateFastaRecords(fastaRecords, outputFile, locus=None, databaseFullPath=None):
+    # Annotate a chunk of records concurrently, and write the annotated sequences in the same order.
+    # If a locus is given, the records are annotated with the local database instead of the service.
+    # Returns the number of records that could not be annotated.
+    hlaSequences = []
+    for recordName, sequence in fastaRecords:
+        hlaSequence = HlaSequence()
+        hlaSequence.rawSequence = sequence
+        hlaSequences.append(hlaSequence)
+
+    # One bad sequence or a dropped connection (pycurl.error) should not stop the rest of the file.
+    try:
+        if (locus is not None):
+            errorMessages = annotateSequencesLocally(hlaSequences, locus, databaseFullPath)
+        else:
+            errorMessages = annotateSequencesUsingService(hlaSequences, getConfigurationValue('nmdp_act_rest_address')
+                , int(getConfigurationValue('act_max_in_flight')))
+    except Exception:
+        logging.error('Error when annotating sequences:' + str(exc_info()[1]))
+        errorMessages = [str(exc_info()[1])] * len(hlaSequences)
+
+    failureCount = 0
+    for (recordName, sequence), hlaSequence, errorMessage in zip(fastaRecords, hlaSequences, errorMessages):
+        if (errorMessage is None and len(hlaSequence.features) > 0):
+            outputFile.write('>' + str(recordName) + '\n' + hlaSequence.getAnnotatedSequence(includeLineBreaks=False) + '\n')
+        else:
+            logging.error('Could not annotate sequence ' + str(recordName) + ':' + str(errorMessage))
+            failureCount += 1
+    return failureCount
+
+def annotateFasta(fastaFileName, outputFileName, locus=None, databaseFullPath=None):
+    sequenceCount = 0
+    failureCount = 0
+
+    # The records are annotated in chunks, so a large file is not held in memory while the requests are in flight.
+    # The input can be FASTA or FASTQ, gzipped or not.
+    with open(outputFileName, 'w') as outputFile:
+        fastaRecords = []
+        for fastaRecord in iterateSequenceFile(fastaFileName):
+            sequenceCount += 1
+            fastaRecords.append(fastaRecord)
+            if (len(fastaRecords) >= annotationChunkSize):
+                failureCount += annotateFastaRecords(fastaRecords, outputFile, locus, databaseFullPath)
+                fastaRecords = []
+        if (len(fastaRecords) > 0):
+            failureCount += annotateFastaRecords(fastaRecords, outputFile, locus, databaseFullPath)
+
+    print('Annotated ' + str(sequenceCount - failureCount) + ' of ' + str(sequenceCount) + ' sequence(s) to ' + str(outputFileName))
+    return failureCount == 0
+
+def validateCsv(csvFileName, annotate=False):
+    submissionBatch = loadSubmissionBatch(csvFileName, annotate)
+    failureCount = 0
+
+    for submission, submissionText, errorMessage in iterateSubmissionTexts(submissionBatch, 'ENA'
+        , int(getConfigurationValue('generation_worker_count')), int(getConfigurationValue('generation_chunk_size'))):
+        if (submissionText is None):
+            print(str(submission.localAlleleName) + ': INVALID, ' + str(errorMessage).replace('\n', ' '))
+            failureCount += 1
+        else:
+            print(str(submission.localAlleleName) + ': OK')
+
+    printTranslationReport(submissionBatch)
+    print(str(len(submissionBatch.submissionBatch) - failureCount) + ' of ' + str(len(submissionBatch.submissionBatch)) + ' submission(s) are valid.')
+    return failureCount == 0
+
+def loadImgtRelease(hlaDataFolder, databaseFullPath, fullLoad=False):
+    if (databaseFullPath is None):
+        databaseFullPath = join(getSaddlebagsDirectory(), 'SeqAnnDatabase.db')
+    if (fullLoad):
+        alleleCount = loadHLADataIntoSqlite(databaseFullPath, hlaDataFolder)
+        print('Loaded ' + str(alleleCount) + ' reference allele(s) into ' + str(databaseFullPath))
+        return alleleCount > 0
+
+    insertCount, updateCount, deleteCount = updateHLADataInSqlite(databaseFullPath, hlaDataFolder)
+    print('Updated ' + str(databaseFullPath) + ': ' + str(insertCount) + ' inserted, ' + str(updateCount) + ' updated, '
+        + str(deleteCount) + ' deleted reference allele(s)')
+    return True
+
+def benchmarkAlignerBackends(locus, databaseFullPath, sampleCount):
+    # Align a few reference alleles against the first one with every backend, and print the average time of each.
+    referenceAlleles = getLocalAnnotator(locus, databaseFullPath).referenceAlleles
+    if (len(referenceAlleles) < 2):
+        print('Locus ' + str(locus) + ' needs at least 2 reference alleles for the benchmark.')
+        return False
+    # The backends that local_aligner can select, and the banded kernel without the score check.
+    # Candidates are always scored with the PairwiseAligner, only the alignment that is projected uses the backend.
+    aligners = dict((backendName, createBackend()) for backendName, createBackend in alignerBackends.items())
+    aligners['BandedAligner (unchecked)'] = BandedAligner()
+    for alignerMethod in ('align',):
+        totalTimes = dict((backendName, 0.0) for backendName in aligners)
+        for alleleName, annotatedSequence in referenceAlleles[1:sampleCount + 1]:
+            for backendName, alignerTime in benchmarkAligners(aligners, referenceAlleles[0][1].upper(), annotatedSequence.upper(), alignerMethod).items():
+                totalTimes[backendName] += alignerTime
+        for backendName, totalTime in sorted(totalTimes.items(), key=lambda backendTime: backendTime[1]):
+            print(str(alignerMethod) + '\t' + str(backendName) + '\t' + str(round(totalTime / len(referenceAlleles[1:sampleCount + 1]), 4)) + ' seconds')
+    return True
+
+def runCommandLine(commandLineArguments):
+    # Returns the exit code, 0 if every sequence was processed.
+    parsedArguments = createArgumentParser().parse_args(commandLineArguments)
+
+    setHeadlessMode(True)
+    loadConfigurationFile()
+
+    # Command line options override the configuration for this run.
+    if (getattr(parsedArguments, 'workers', None) is not None):
+        assignConfigurationValue('generation_worker_count', str(parsedArguments.workers))
+    if (getattr(parsedArguments, 'chunk_size', None) is not None):
+        assignConfigurationValue('generation_chunk_size', str(parsedArguments.chunk_size))
+    if (getattr(parsedArguments, 'in_flight', None) is not None):
+        assignConfigurationValue('act_max_in_flight', str(parsedArguments.in_flight))
+    try:
+        configureLocalAligner(getConfigurationValue('local_aligner') or 'PairwiseAligner')
+    except HlaSequenceException:
+        logging.error(str(exc_info()[1]) + '. Using the PairwiseAligner.')
+        configureLocalAligner('PairwiseAligner')
+
+    logging.info('*******Starting Saddlebags (' + str(parsedArguments.command) + ')*******')
+
+    if (parsedArguments.command == 'convert-ena'):
+        success = convertToEna(parsedArguments.csvFile, parsedArguments.output, parsedArguments.annotate)
+    elif (parsedArguments.command == 'convert-ipd'):
+        success = convertToIpd(parsedArguments.csvFile, parsedArguments.output, parsedArguments.describe_differences, parsedArguments.database
+            , parsedArguments.annotate)
+    elif (parsedArguments.command == 'annotate'):
+        success = annotateFasta(parsedArguments.fastaFile, parsedArguments.output, parsedArguments.local, parsedArguments.database)
+    elif (parsedArguments.command == 'load-imgt'):
+        success = loadImgtRelease(parsedArguments.hlaDataFolder, parsedArguments.database, parsedArguments.full)
+    elif (parsedArguments.command == 'benchmark-aligners'):
+        success = benchmarkAlignerBackends(parsedArguments.locus, parsedArguments.database, parsedArguments.samples)
+    else:
+        success = validateCsv(parsedArguments.csvFile, parsedArguments.annotate)
+
+    logging.info('*******Closing Saddlebags*******')
+
+    return 0 if success else 1
@@ -72,4 +72,5 @@ class AlleleSubmission():
         self.enaSubmissionText = None
         self.ipdSubmissionText = None
         self.isPseudoGene = False # A null allele uses pseudogene if length of the coding sequence is not a multiple of 3.
+        self.translationResult = None # The TranslationResult of the last time the submission was generated.
 
@@ -0,0 +1,157 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from hashlib import sha256
+from os import listdir, makedirs, remove, replace, stat, utime, getpid
+from os.path import join, isdir, isfile, dirname
+from sys import exc_info
+from time import time
+
+from saddlebags.AlleleSubCommon import getSaddlebagsDirectory
+
+import logging
+
+# A cache of the JSON returned by the ACT annotation service, stored on disk in the saddlebags directory.
+# The same sequences are annotated over and over (re-opened batches, identical alleles from different samples),
+# the cached annotation is read from disk instead of asking the ACT server again.
+# Each response is a file named by the sha256 hash of the annotation service address and the cleaned, uppercase sequence.
+# The modification time of a file is the last time it was used, old files are deleted and the cache has a maximum size.
+
+# These are assigned from the config file by configureAnnotationCache, HlaSequence cannot read the configuration directly.
+cacheEnabled = True
+defaultMaximumAgeDays = 30
+defaultMaximumSizeMb = 100
+
+sharedAnnotationCache = None
+
+class AnnotationCache():
+
+    def __init__(self, cacheDirectory=None, maximumAgeDays=None, maximumSizeMb=None):
+        self.cacheDirectory = join(getSaddlebagsDirectory(), 'annotation_cache') if cacheDirectory is None else cacheDirectory
+        self.maximumAge = 86400 * (defaultMaximumAgeDays if maximumAgeDays is None else maximumAgeDays)
+        self.maximumSize = 1024 * 1024 * (defaultMaximumSizeMb if maximumSizeMb is None else maximumSizeMb)
+        # Check the size of the cache the first time something is stored, and then every few hundred files.
+        self.storesUntilEviction = 0
+
+    def getCacheFileName(self, cleanedSequence, requestURL):
+        cacheKey = sha256((str(requestURL) + '\n' + cleanedSequence.upper()).encode('utf-8')).hexdigest()
+        # Two levels of folders, so one folder doesn't get too many files.
+        return join(self.cacheDirectory, cacheKey[0:2], cacheKey + '.json')
+
+    def lookup(self, cleanedSequence, requestURL):
+        # Returns the cached annotation JSON, or None if this sequence is not in the cache.
+        cacheFileName = self.getCacheFileName(cleanedSequence, requestURL)
+        try:
+            if (not isfile(cacheFileName)):
+                return None
+            if (time() - stat(cacheFileName).st_mtime > self.maximumAge):
+                remove(cacheFileName)
+                return None
+            with open(cacheFileName, 'r') as cacheFile:
+                annotationJson = cacheFile.read()
+            # This annotation was used, so it is kept longer.
+            utime(cacheFileName, None)
+            logging.debug('Found a cached annotation:%s', cacheFileName)
+            return annotationJson
+        except Exception:
+            logging.warning('Could not read the cached annotation ' + cacheFileName + ':' + str(exc_info()[1]))
+            return None
+
+    def store(self, cleanedSequence, requestURL, annotationJson):
+        cacheFileName = self.getCacheFileName(cleanedSequence, requestURL)
+        try:
+            if (isfile(cacheFileName)):
+                utime(cacheFileName, None)
+                return
+            makedirs(dirname(cacheFileName), exist_ok=True)
+            # Write a temporary file and move it, so another process never reads half of a file.
+            temporaryFileName = cacheFileName + '.' + str(getpid()) + '.tmp'
+            # The batch annotation stores the response bytes as they are.
+            with open(temporaryFileName, 'wb' if isinstance(annotationJson, bytes) else 'w') as cacheFile:
+                cacheFile.write(annotationJson)
+            replace(temporaryFileName, cacheFileName)
+        except Exception:
+            logging.warning('Could not store the annotation in the cache ' + cacheFileName + ':' + str(exc_info()[1]))
+            return
+
+        self.storesUntilEviction -= 1
+        if (self.storesUntilEviction <= 0):
+            self.evict()
+            self.storesUntilEviction = 200
+
+    def evict(self):
+        # Delete the files that are too old, and then the least recently used files until the cache is small enough.
+        # Returns the number of deleted files.
+        if (not isdir(self.cacheDirectory)):
+            return 0
+
+        currentTime = time()
+        cacheFiles = []
+        deleteCount = 0
+        totalSize = 0
+        for cacheFolder in listdir(self.cacheDirectory):
+            cacheFolder = join(self.cacheDirectory, cacheFolder)
+            if (not isdir(cacheFolder)):
+                continue
+            for cacheFileName in listdir(cacheFolder):
+                cacheFileName = join(cacheFolder, cacheFileName)
+                try:
+                    fileStatus = stat(cacheFileName)
+                    if (currentTime - fileStatus.st_mtime > self.maximumAge):
+                        remove(cacheFileName)
+                        deleteCount += 1
+                    else:
+                        cacheFiles.append((fileStatus.st_mtime, fileStatus.st_size, cacheFileName))
+                        totalSize += fileStatus.st_size
+                except OSError:
+                    # Another process deleted it first.
+                    pass
+
+        if (totalSize > self.maximumSize):
+            cacheFiles.sort()
+            for modifiedTime, fileSize, cacheFileName in cacheFiles:
+                if (totalSize <= self.maximumSize):
+                    break
+                try:
+                    remove(cacheFileName)
+                    deleteCount += 1
+                except OSError:
+                    pass
+                totalSize -= fileSize
+
+        if (deleteCount > 0):
+            logging.info('Deleted ' + str(deleteCount) + ' old annotations from the annotation cache.')
+        return deleteCount
+
+def configureAnnotationCache(enabled, maximumAgeDays, maximumSizeMb):
+    # Called when the configuration is loaded.
+    global cacheEnabled
+    global defaultMaximumAgeDays
+    global defaultMaximumSizeMb
+    global sharedAnnotationCache
+
+    cacheEnabled = enabled
+    defaultMaximumAgeDays = maximumAgeDays
+    defaultMaximumSizeMb = maximumSizeMb
+    sharedAnnotationCache = None
+
+def getAnnotationCache():
+    # The cache that is shared by everything in this process. Returns None if the cache is disabled in the configuration.
+    global sharedAnnotationCache
+    if (not cacheEnabled):
+        return None
+    if (sharedAnnotationCache is None):
+        sharedAnnotationCache = AnnotationCache()
+    return sharedAnnotationCache
@@ -0,0 +1,82 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from saddlebags.HlaSequenceException import HlaSequenceException
+
+# orjson or ujson are used if they are installed, they parse the JSON several times faster than the json module.
+# All three accept the bytes of a response, so the body is never decoded into an intermediate str.
+try:
+    from orjson import loads as loadJson
+    jsonLibraryName = 'orjson'
+except ImportError:
+    try:
+        from ujson import loads as loadJson
+        jsonLibraryName = 'ujson'
+    except ImportError:
+        from json import loads as loadJson
+        jsonLibraryName = 'json'
+
+import logging
+
+# Decode the JSON that the ACT annotation service returns for a sequence.
+# A batch of annotations has hundreds of responses, so the body is parsed straight from the response bytes (or the cached text),
+# and the feature sequences are the strings created by the parser. They are not converted or cased here,
+# the FeatureTable cases each feature once when the features are assigned to the HlaSequence.
+
+# Whether each feature term of the ACT service is an exon.
+featureTermExons = {'five_prime_UTR': False, 'exon': True, 'intron': False, 'three_prime_UTR': False}
+
+def findAnnotationResponseError(responseBody):
+    # Check the text or bytes returned by the ACT service. Returns a message describing the problem, or None if it looks like JSON.
+    # Simple case is an empty string.
+    if(responseBody is None or len(responseBody) < 1):
+        return 'The JSON results were an empty string. Is there a problem with the ACT server?'
+
+    # Only an html page is decoded, to find its title.
+    if(isinstance(responseBody, bytes)):
+        if(not responseBody.startswith(b'<html>')):
+            return None
+        responseBody = responseBody.decode('utf8', 'replace')
+
+    # If it's an html error we can respond nicely.
+    if(responseBody.startswith('<html>')):
+        # TODO: this might not work if i get some other kind of html.
+        errorCode = responseBody[responseBody.find('<title>'):responseBody.find('</title>')]
+        return 'The annotation results are HTML, not JSON, probably an issue with the ACT webserver:\n' + str(errorCode)
+
+    return None
+
+def decodeAnnotationFeatures(responseBody):
+    # Returns a list of tuples (term, sequence, isExon) for the features in an ACT response, in order.
+    # Raises an HlaSequenceException if the response does not have features we know about.
+    parsedJson = loadJson(responseBody)
+
+    if(not isinstance(parsedJson, dict) or len(parsedJson) <= 1):
+        raise HlaSequenceException('No keys found in the JSON Dictionary, unable to annotate sequence.')
+    featureList = parsedJson.get('features')
+    if(featureList is None):
+        raise HlaSequenceException('Unable to identify any HLA exon features, unable to annotate sequence.')
+
+    annotationFeatures = []
+    for featureDictionary in featureList:
+        term = featureDictionary['term']
+        isExon = featureTermExons.get(term)
+        if(isExon is None):
+            raise HlaSequenceException('Unknown Feature Term, expected exon or intron:' + str(term))
+        sequence = featureDictionary['sequence']
+        annotationFeatures.append((term, sequence if isinstance(sequence, str) else str(sequence), isExon))
+
+    logging.debug('Decoded %s features with %s', len(annotationFeatures), jsonLibraryName)
+    return annotationFeatures
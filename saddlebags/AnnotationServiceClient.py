@@ -0,0 +1,283 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from gzip import compress
+from io import BytesIO
+from os import getpid
+from threading import Lock
+from urllib.parse import urlencode
+
+from pycurl import Curl, CurlMulti, CurlShare, SH_SHARE, LOCK_DATA_DNS, LOCK_DATA_SSL_SESSION, E_CALL_MULTI_PERFORM
+
+try:
+    from pycurl import LOCK_DATA_CONNECT
+except ImportError:
+    # Older libcurl versions cannot share the connection cache. Each handle still keeps its own connections alive.
+    LOCK_DATA_CONNECT = None
+
+import logging
+
+# A client for the ACT annotation service that keeps its connections open between requests.
+# Curl handles are reused from a pool instead of creating a new handle for every allele.
+# The handles share a DNS cache, TLS sessions and (if libcurl supports it) the connection cache,
+# so a batch of annotations does not repeat the DNS lookup and TCP/TLS handshake for each sequence.
+
+# Timeouts in seconds. These are assigned from the config file by configureAnnotationServiceClient.
+# HlaSequence cannot read the configuration directly (circular import), so the configuration is pushed here instead.
+defaultConnectTimeout = 10
+defaultRequestTimeout = 120
+# Send the sequences in the body of a POST request instead of the URL, optionally gzip compressed.
+defaultUsePost = True
+defaultCompressRequests = False
+
+# If the service answers a POST with one of these, it doesn't accept POST requests and GET is used instead.
+# 404 is not one of them, a GET to the same URL would not be found either. It is probably a wrong nmdp_act_rest_address.
+postFallbackResponseCodes = (405, 411, 415, 501)
+
+sharedAnnotationServiceClient = None
+
+class AnnotationServiceClient():
+
+    def __init__(self, connectTimeout=None, requestTimeout=None, maximumIdleHandles=8, usePost=None, compressRequests=None):
+        self.connectTimeout = defaultConnectTimeout if connectTimeout is None else connectTimeout
+        self.requestTimeout = defaultRequestTimeout if requestTimeout is None else requestTimeout
+        self.usePost = defaultUsePost if usePost is None else usePost
+        self.compressRequests = defaultCompressRequests if compressRequests is None else compressRequests
+        # The services that answered a POST request with an error get GET requests.
+        self.postUnsupportedURLs = set()
+        self.postSupportedURLs = set()
+        self.notFoundURLs = set()
+        self.maximumIdleHandles = maximumIdleHandles
+        self.poolLock = Lock()
+        self.createPool()
+
+    def createPool(self):
+        # curl handles and their connections cannot be used by a forked child process, so the pool remembers which process owns it.
+        self.processId = getpid()
+        self.idleHandles = []
+
+        self.curlShare = CurlShare()
+        self.curlShare.setopt(SH_SHARE, LOCK_DATA_DNS)
+        self.curlShare.setopt(SH_SHARE, LOCK_DATA_SSL_SESSION)
+        if (LOCK_DATA_CONNECT is not None):
+            self.curlShare.setopt(SH_SHARE, LOCK_DATA_CONNECT)
+
+    def acquireHandle(self):
+        with self.poolLock:
+            if (self.processId != getpid() or self.curlShare is None):
+                logging.debug('Creating a new pool of annotation service connections in process ' + str(getpid()))
+                self.createPool()
+
+            if (len(self.idleHandles) > 0):
+                curlObject = self.idleHandles.pop()
+                # reset() clears every option of the last request, including the share. The handle keeps its own open connections.
+                # pycurl still holds a reference to the old share, so that is released before the share is set again.
+                curlObject.reset()
+                curlObject.unsetopt(curlObject.SHARE)
+            else:
+                curlObject = Curl()
+            curlObject.setopt(curlObject.SHARE, self.curlShare)
+
+        curlObject.setopt(curlObject.CONNECTTIMEOUT_MS, int(self.connectTimeout * 1000))
+        curlObject.setopt(curlObject.TIMEOUT_MS, int(self.requestTimeout * 1000))
+        curlObject.setopt(curlObject.TCP_KEEPALIVE, 1)
+        # Timeouts use signals unless this is set, that doesn't work outside the main thread.
+        curlObject.setopt(curlObject.NOSIGNAL, 1)
+        return curlObject
+
+    def releaseHandle(self, curlObject):
+        with self.poolLock:
+            if (self.processId == getpid() and len(self.idleHandles) < self.maximumIdleHandles):
+                self.idleHandles.append(curlObject)
+                return
+        curlObject.close()
+
+    def getRequestBody(self, requestFields):
+        # The fields are sent as a form, the same way they would be encoded in the URL. Optionally gzip compressed.
+        requestBody = urlencode(requestFields).encode('utf-8')
+        if (self.compressRequests):
+            requestBody = compress(requestBody)
+        return requestBody
+
+    def prepareRequest(self, curlObject, requestURL, requestBody, resultsIoObject):
+        # requestBody=None is a GET request, otherwise the body is POSTed.
+        curlObject.setopt(curlObject.URL, requestURL)
+        curlObject.setopt(curlObject.WRITEDATA, resultsIoObject)
+        # Accept a compressed response, curl decompresses it.
+        curlObject.setopt(curlObject.ENCODING, '')
+        if (requestBody is not None):
+            requestHeaders = ['Content-Type: application/x-www-form-urlencoded', 'Expect:']
+            if (self.compressRequests):
+                requestHeaders.append('Content-Encoding: gzip')
+            curlObject.setopt(curlObject.POST, 1)
+            curlObject.setopt(curlObject.POSTFIELDSIZE, len(requestBody))
+            curlObject.setopt(curlObject.POSTFIELDS, requestBody)
+            curlObject.setopt(curlObject.HTTPHEADER, requestHeaders)
+
+    def performRequest(self, requestURL, requestBody=None):
+        # Returns a tuple (responseCode, responseBody). The body is bytes.
+        resultsIoObject = BytesIO()
+        curlObject = self.acquireHandle()
+        try:
+            self.prepareRequest(curlObject, requestURL, requestBody, resultsIoObject)
+            curlObject.perform()
+            responseCode = curlObject.getinfo(curlObject.RESPONSE_CODE)
+        except Exception:
+            # A handle that failed might have a broken connection, don't put it back in the pool.
+            curlObject.close()
+            raise
+
+        self.releaseHandle(curlObject)
+        return responseCode, resultsIoObject.getvalue()
+
+    def performGet(self, requestURL):
+        return self.performRequest(requestURL)
+
+    def performBatch(self, batchRequests, maxInFlight=8):
+        # Perform many requests concurrently with a CurlMulti, keeping up to maxInFlight requests open at once.
+        # batchRequests is a list of tuples (requestURL, requestBody), requestBody is None for a GET request.
+        # Returns a list of tuples (responseCode, responseBody, errorMessage), in the same order as batchRequests.
+        # errorMessage is None if the request was performed, responseCode and responseBody are None if it was not.
+        batchResults = [None] * len(batchRequests)
+        activeRequests = {}
+        nextRequestIndex = 0
+        curlMulti = CurlMulti()
+
+        try:
+            while (nextRequestIndex < len(batchRequests) or len(activeRequests) > 0):
+                # Top up the requests in flight.
+                while (nextRequestIndex < len(batchRequests) and len(activeRequests) < max(1, maxInFlight)):
+                    resultsIoObject = BytesIO()
+                    curlObject = self.acquireHandle()
+                    requestURL, requestBody = batchRequests[nextRequestIndex]
+                    self.prepareRequest(curlObject, requestURL, requestBody, resultsIoObject)
+                    activeRequests[curlObject] = (nextRequestIndex, resultsIoObject)
+                    curlMulti.add_handle(curlObject)
+                    nextRequestIndex += 1
+                multiResult = E_CALL_MULTI_PERFORM
+                while (multiResult == E_CALL_MULTI_PERFORM):
+                    multiResult, runningCount = curlMulti.perform()
+
+                # Collect the finished requests.
+                queuedCount = 1
+                while (queuedCount > 0):
+                    queuedCount, succeededHandles, failedHandles = curlMulti.info_read()
+                    for curlObject in succeededHandles:
+                        requestIndex, resultsIoObject = activeRequests.pop(curlObject)
+                        curlMulti.remove_handle(curlObject)
+                        batchResults[requestIndex] = (curlObject.getinfo(curlObject.RESPONSE_CODE), resultsIoObject.getvalue(), None)
+                        self.releaseHandle(curlObject)
+                    for curlObject, errorNumber, errorMessage in failedHandles:
+                        requestIndex, resultsIoObject = activeRequests.pop(curlObject)
+                        curlMulti.remove_handle(curlObject)
+                        logging.error('Annotation request failed (' + str(errorNumber) + '):' + str(errorMessage))
+                        batchResults[requestIndex] = (None, None, 'Request failed (' + str(errorNumber) + '):' + str(errorMessage))
+                        # A handle that failed might have a broken connection, don't put it back in the pool.
+                        curlObject.close()
+
+                if (len(activeRequests) > 0):
+                    curlMulti.select(1.0)
+
+        finally:
+            for curlObject in activeRequests:
+                curlMulti.remove_handle(curlObject)
+                curlObject.close()
+            curlMulti.close()
+
+        return batchResults
+
+    def isPostSupported(self, rawRequestURL):
+        return self.usePost and rawRequestURL not in self.postUnsupportedURLs
+
+    def checkPostResponse(self, rawRequestURL, responseCode):
+        # Returns True if the service did not accept the POST request, and the request should be sent again with GET.
+        if (responseCode in postFallbackResponseCodes):
+            if (rawRequestURL not in self.postUnsupportedURLs):
+                logging.warning('The annotation service does not accept POST requests (' + str(responseCode) + '), using GET requests:' + str(rawRequestURL))
+                self.postUnsupportedURLs.add(rawRequestURL)
+            return True
+        if (responseCode == 404):
+            if (rawRequestURL not in self.notFoundURLs):
+                logging.warning('The annotation service was not found (404), check the ACT service URL:' + str(rawRequestURL))
+                self.notFoundURLs.add(rawRequestURL)
+            return False
+        self.postSupportedURLs.add(rawRequestURL)
+        return False
+
+    def performAnnotation(self, rawRequestURL, requestFields):
+        # Send the fields (the sequence...) to the annotation service. Returns a tuple (responseCode, responseBody).
+        # The fields are POSTed in the request body, so long sequences don't make the URL too long (414 Request-URI Too Large).
+        # If the service doesn't accept POST, the fields are sent in the URL of a GET request.
+        if (self.isPostSupported(rawRequestURL)):
+            responseCode, responseBody = self.performRequest(rawRequestURL, self.getRequestBody(requestFields))
+            if (not self.checkPostResponse(rawRequestURL, responseCode)):
+                return responseCode, responseBody
+        return self.performGet(rawRequestURL + '?' + urlencode(requestFields))
+
+    def performAnnotationBatch(self, rawRequestURL, requestFieldsList, maxInFlight=8):
+        # The same as performAnnotation, for a list of requests that are sent concurrently.
+        # Returns a list of tuples (responseCode, responseBody, errorMessage), in the same order as requestFieldsList.
+        batchResults = [None] * len(requestFieldsList)
+        getIndices = list(range(0, len(requestFieldsList)))
+
+        # The first request to a new service is sent alone, to find out if it accepts POST requests before sending the rest.
+        if (self.isPostSupported(rawRequestURL) and rawRequestURL not in self.postSupportedURLs and len(requestFieldsList) > 1):
+            batchResults = self.performAnnotationBatch(rawRequestURL, requestFieldsList[0:1], maxInFlight) \
+                + self.performAnnotationBatch(rawRequestURL, requestFieldsList[1:], maxInFlight)
+            return batchResults
+
+        if (self.isPostSupported(rawRequestURL)):
+            batchResults = self.performBatch([(rawRequestURL, self.getRequestBody(requestFields)) for requestFields in requestFieldsList], maxInFlight)
+            getIndices = [requestIndex for requestIndex, (responseCode, responseBody, errorMessage) in enumerate(batchResults)
+                if errorMessage is None and self.checkPostResponse(rawRequestURL, responseCode)]
+
+        if (len(getIndices) > 0):
+            getResults = self.performBatch([(rawRequestURL + '?' + urlencode(requestFieldsList[requestIndex]), None) for requestIndex in getIndices], maxInFlight)
+            for requestIndex, getResult in zip(getIndices, getResults):
+                batchResults[requestIndex] = getResult
+
+        return batchResults
+
+    def close(self):
+        # Close the idle handles and the share, which holds the shared connections.
+        with self.poolLock:
+            for curlObject in self.idleHandles:
+                curlObject.close()
+            self.idleHandles = []
+            self.curlShare.close()
+            self.curlShare = None
+
+def configureAnnotationServiceClient(connectTimeout, requestTimeout, usePost=True, compressRequests=False):
+    # Called when the configuration is loaded. The shared client is recreated with the new settings.
+    global defaultConnectTimeout
+    global defaultRequestTimeout
+    global defaultUsePost
+    global defaultCompressRequests
+    global sharedAnnotationServiceClient
+
+    defaultConnectTimeout = connectTimeout
+    defaultRequestTimeout = requestTimeout
+    defaultUsePost = usePost
+    defaultCompressRequests = compressRequests
+    if (sharedAnnotationServiceClient is not None):
+        sharedAnnotationServiceClient.close()
+        sharedAnnotationServiceClient = None
+
+def getAnnotationServiceClient():
+    # The client that is shared by everything in this process.
+    global sharedAnnotationServiceClient
+    if (sharedAnnotationServiceClient is None):
+        sharedAnnotationServiceClient = AnnotationServiceClient()
+    return sharedAnnotationServiceClient
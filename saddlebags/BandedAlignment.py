@@ -0,0 +1,292 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from time import perf_counter
+
+import numpy
+
+from saddlebags.ReferenceIndex import findWindowMinimums, noMinimizer
+
+import logging
+
+# A banded alignment of a sequence against a reference allele, vectorized with numpy.
+# The scoring is the same as the PairwiseAligner from createAligner: a global alignment with affine gaps, where the
+# overhanging ends of either sequence are free. A submitted sequence is mostly the reference with a few differences,
+# so the alignment stays close to the diagonals where the two sequences share minimizers. Only a band around those is computed.
+# The cells of one anti-diagonal only depend on the two anti-diagonals before it, each anti-diagonal is computed in one numpy step.
+# If the best alignment touches the edge of the band, the band was too narrow, and the alignment is repeated with a wider band.
+# This is a heuristic: the result is only the optimal alignment if the optimal path is inside the band. A band that is placed badly
+# (long replaced stretches, few shared minimizers) can hold a worse path that never touches the edge, then the score is lower than
+# the PairwiseAligner score. LocalAnnotation checks the score, see CheckedBandedAligner.
+
+matchScore = 2
+mismatchScore = -1
+openGapScore = -3
+extendGapScore = -1
+
+# Cells outside of the band. Low enough that adding gap scores does not overflow.
+outsideBand = numpy.int32(-(1 << 28))
+
+# Number of diagonals added on each side of the diagonals of the shared minimizers.
+defaultBandWidth = 64
+
+# Trace bits of a cell. Bits 0-1 tell where the best score came from, bit 2 and 3 tell if a gap was extended.
+traceDiagonal = 0
+traceInsertion = 1
+traceDeletion = 2
+traceStart = 3
+traceExtendInsertion = 4
+traceExtendDeletion = 8
+
+class BandedAlignment():
+    # The result of alignBanded. cigar is a list of (operation, length), M for aligned nucleotides (the same or not),
+    # I for nucleotides of the query that are not in the reference, and D for nucleotides of the reference that are not in the query.
+    # The overhanging ends are I or D as well. aligned has the aligned blocks like a Bio.Align alignment,
+    # a tuple of (referenceBlocks, queryBlocks) with (begin, end) of each block.
+
+    def __init__(self, score, cigar):
+        self.score = score
+        self.cigar = cigar
+
+    @property
+    def aligned(self):
+        referenceBlocks = []
+        queryBlocks = []
+        referencePosition = 0
+        queryPosition = 0
+        for operation, length in self.cigar:
+            if (operation == 'M'):
+                referenceBlocks.append((referencePosition, referencePosition + length))
+                queryBlocks.append((queryPosition, queryPosition + length))
+            if (operation != 'I'):
+                referencePosition += length
+            if (operation != 'D'):
+                queryPosition += length
+        return tuple(referenceBlocks), tuple(queryBlocks)
+
+    def getCigarString(self):
+        return ''.join(str(length) + operation for operation, length in self.cigar)
+
+def encodeSequence(sequence):
+    return numpy.frombuffer(str(sequence).upper().encode('ascii', 'replace'), dtype=numpy.uint8)
+
+def findDiagonalRange(referenceSequence, querySequence):
+    # Returns the lowest and highest diagonal (query position - reference position) of the minimizers that occur once in both sequences.
+    # The alignment goes through these, the band has to cover them. None if the sequences do not share any minimizers.
+    referenceMinimums = findWindowMinimums(referenceSequence)
+    queryMinimums = findWindowMinimums(querySequence)
+    # The first window of each minimizer, and the minimizers that are in only one run of windows. Repeats are not used to place the band.
+    referenceMinimizers, referencePositions, referenceCounts = numpy.unique(referenceMinimums[findMinimizerRuns(referenceMinimums)], return_index=True, return_counts=True)
+    queryMinimizers, queryPositions, queryCounts = numpy.unique(queryMinimums[findMinimizerRuns(queryMinimums)], return_index=True, return_counts=True)
+    referencePositions = findMinimizerRuns(referenceMinimums)[referencePositions]
+    queryPositions = findMinimizerRuns(queryMinimums)[queryPositions]
+    sharedMinimizers, referenceIndices, queryIndices = numpy.intersect1d(referenceMinimizers, queryMinimizers, assume_unique=True, return_indices=True)
+    uniqueMinimizers = (sharedMinimizers != noMinimizer) & (referenceCounts[referenceIndices] == 1) & (queryCounts[queryIndices] == 1)
+    if (not uniqueMinimizers.any()):
+        return None
+    minimizerDiagonals = queryPositions[queryIndices[uniqueMinimizers]].astype(numpy.int64) - referencePositions[referenceIndices[uniqueMinimizers]].astype(numpy.int64)
+    return int(minimizerDiagonals.min()), int(minimizerDiagonals.max())
+
+def findMinimizerRuns(windowMinimums):
+    # The positions of the windows that start a run of windows with the same minimizer.
+    newMinimums = numpy.ones(len(windowMinimums), dtype=bool)
+    newMinimums[1:] = windowMinimums[1:] != windowMinimums[0:-1]
+    return numpy.flatnonzero(newMinimums)
+
+def fillBand(referenceCodes, queryCodes, lowDiagonal, highDiagonal):
+    # Fill the band of the scoring matrix, cell (i,j) is reference position i and query position j, the band is lowDiagonal <= j-i <= highDiagonal.
+    # Returns the trace bits and the first reference index of every anti-diagonal, and the best end cell (score, i, j).
+    referenceLength = len(referenceCodes)
+    queryLength = len(queryCodes)
+    reversedQueryCodes = queryCodes[::-1]
+
+    # The scores of the last anti-diagonals are kept in arrays by reference index i, shifted by one so i-1 = -1 has a place.
+    # H is kept for the two previous anti-diagonals, E (insertion) and F (deletion) for the previous one. The buffers are reused,
+    # only the cells of the band are written, and the cells just outside of the band are reset.
+    previousScores = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+    secondScores = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+    currentScores = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+    previousInsertions = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+    currentInsertions = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+    previousDeletions = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+    currentDeletions = numpy.full(referenceLength + 3, outsideBand, dtype=numpy.int32)
+
+    traces = []
+    traceBegins = []
+    bestEnd = None
+
+    for antiDiagonal in range(0, referenceLength + queryLength + 1):
+        cellBegin = max(0, antiDiagonal - queryLength, (antiDiagonal - highDiagonal + 1) // 2)
+        cellEnd = min(referenceLength, antiDiagonal, (antiDiagonal - lowDiagonal) // 2) + 1
+        if (cellEnd <= cellBegin):
+            traces.append(None)
+            traceBegins.append(cellBegin)
+            secondScores, previousScores, currentScores = previousScores, currentScores, secondScores
+            continue
+
+        # H(i-1,j-1) is on the second previous anti-diagonal, E comes from (i,j-1) and F from (i-1,j), on the previous one.
+        diagonalScores = secondScores[cellBegin:cellEnd].copy()
+        insertionScores = currentInsertions[cellBegin + 1:cellEnd + 1]
+        extendInsertions = previousInsertions[cellBegin + 1:cellEnd + 1] + extendGapScore
+        numpy.maximum(previousScores[cellBegin + 1:cellEnd + 1] + openGapScore, extendInsertions, out=insertionScores)
+        deletionScores = currentDeletions[cellBegin + 1:cellEnd + 1]
+        extendDeletions = previousDeletions[cellBegin:cellEnd] + extendGapScore
+        numpy.maximum(previousScores[cellBegin:cellEnd] + openGapScore, extendDeletions, out=deletionScores)
+
+        # Cell i compares reference[i-1] with query[j-1], j-1 = antiDiagonal-i-1 counts down as i counts up.
+        innerBegin = max(cellBegin, 1)
+        innerEnd = min(cellEnd, antiDiagonal)
+        if (innerEnd > innerBegin):
+            diagonalScores[innerBegin - cellBegin:innerEnd - cellBegin] += numpy.where(referenceCodes[innerBegin - 1:innerEnd - 1]
+                == reversedQueryCodes[queryLength - antiDiagonal + innerBegin:queryLength - antiDiagonal + innerEnd], matchScore, mismatchScore).astype(numpy.int32)
+
+        cellScores = currentScores[cellBegin + 1:cellEnd + 1]
+        numpy.maximum(diagonalScores, numpy.maximum(insertionScores, deletionScores), out=cellScores)
+        cellTraces = numpy.where(cellScores == diagonalScores, traceDiagonal, numpy.where(cellScores == insertionScores, traceInsertion, traceDeletion)).astype(numpy.uint8)
+        cellTraces |= (insertionScores == extendInsertions).view(numpy.uint8) << 2
+        cellTraces |= (deletionScores == extendDeletions).view(numpy.uint8) << 3
+
+        # The first row and column are free, an alignment can start anywhere in either sequence.
+        if (cellBegin == 0):
+            cellScores[0] = 0
+            cellTraces[0] = traceStart
+        if (cellEnd - 1 == antiDiagonal):
+            cellScores[-1] = 0
+            cellTraces[-1] = traceStart
+
+        # The last row and column are free too, the best cell there is the end of the alignment.
+        if (cellEnd - 1 == referenceLength and (bestEnd is None or cellScores[-1] > bestEnd[0])):
+            bestEnd = (int(cellScores[-1]), referenceLength, antiDiagonal - referenceLength)
+        if (antiDiagonal - cellBegin == queryLength and (bestEnd is None or cellScores[0] > bestEnd[0])):
+            bestEnd = (int(cellScores[0]), cellBegin, queryLength)
+
+        # The next two anti-diagonals read one cell beyond each end of this one.
+        for stateScores in (currentScores, currentInsertions, currentDeletions):
+            stateScores[cellBegin] = outsideBand
+            stateScores[cellEnd + 1] = outsideBand
+
+        traces.append(cellTraces)
+        traceBegins.append(cellBegin)
+        secondScores, previousScores, currentScores = previousScores, currentScores, secondScores
+        previousInsertions, currentInsertions = currentInsertions, previousInsertions
+        previousDeletions, currentDeletions = currentDeletions, previousDeletions
+
+    return traces, traceBegins, bestEnd
+
+def traceBand(traces, traceBegins, referenceLength, queryLength, bestEnd, lowDiagonal, highDiagonal):
+    # Follow the trace bits back from the end cell. Returns the cigar, and whether the path touched the edge of the band.
+    endScore, referenceIndex, queryIndex = bestEnd
+    reversedOperations = []
+    if (queryIndex < queryLength):
+        reversedOperations.append(('I', queryLength - queryIndex))
+    if (referenceIndex < referenceLength):
+        reversedOperations.append(('D', referenceLength - referenceIndex))
+
+    touchesEdge = False
+    currentState = traceDiagonal
+    while (referenceIndex > 0 and queryIndex > 0):
+        cellTrace = traces[referenceIndex + queryIndex][referenceIndex - traceBegins[referenceIndex + queryIndex]]
+        if ((queryIndex - referenceIndex == lowDiagonal and lowDiagonal > -referenceLength)
+            or (queryIndex - referenceIndex == highDiagonal and highDiagonal < queryLength)):
+            touchesEdge = True
+        if (currentState == traceDiagonal):
+            currentState = cellTrace & 3
+            if (currentState == traceDiagonal):
+                reversedOperations.append(('M', 1))
+                referenceIndex -= 1
+                queryIndex -= 1
+        elif (currentState == traceInsertion):
+            reversedOperations.append(('I', 1))
+            currentState = traceInsertion if cellTrace & traceExtendInsertion else traceDiagonal
+            queryIndex -= 1
+        else:
+            reversedOperations.append(('D', 1))
+            currentState = traceDeletion if cellTrace & traceExtendDeletion else traceDiagonal
+            referenceIndex -= 1
+
+    if (queryIndex > 0):
+        reversedOperations.append(('I', queryIndex))
+    if (referenceIndex > 0):
+        reversedOperations.append(('D', referenceIndex))
+
+    # Join the runs of the same operation.
+    cigar = []
+    for operation, length in reversed(reversedOperations):
+        if (len(cigar) > 0 and cigar[-1][0] == operation):
+            cigar[-1] = (operation, cigar[-1][1] + length)
+        else:
+            cigar.append((operation, length))
+    return cigar, touchesEdge
+
+def alignBanded(referenceSequence, querySequence, bandWidth=defaultBandWidth):
+    # Returns the BandedAlignment of the query against the reference.
+    referenceCodes = encodeSequence(referenceSequence)
+    queryCodes = encodeSequence(querySequence)
+    referenceLength = len(referenceCodes)
+    queryLength = len(queryCodes)
+
+    diagonalRange = findDiagonalRange(referenceSequence, querySequence)
+    while (True):
+        if (diagonalRange is None):
+            # Nothing in common to place the band with, every cell is computed.
+            lowDiagonal, highDiagonal = -referenceLength, queryLength
+        else:
+            lowDiagonal = max(diagonalRange[0] - bandWidth, -referenceLength)
+            highDiagonal = min(diagonalRange[1] + bandWidth, queryLength)
+
+        traces, traceBegins, bestEnd = fillBand(referenceCodes, queryCodes, lowDiagonal, highDiagonal)
+        if (bestEnd is None):
+            touchesEdge = True
+        else:
+            cigar, touchesEdge = traceBand(traces, traceBegins, referenceLength, queryLength, bestEnd, lowDiagonal, highDiagonal)
+        if (not touchesEdge or (lowDiagonal == -referenceLength and highDiagonal == queryLength)):
+            break
+        bandWidth *= 2
+        logging.debug('The alignment reached the edge of the band, aligning again with a band of ' + str(bandWidth))
+
+    return BandedAlignment(bestEnd[0], cigar)
+
+class BandedAligner():
+    # The same methods as the PairwiseAligner that LocalAnnotation uses, align() returns a list with the best alignment.
+
+    def __init__(self, bandWidth=defaultBandWidth):
+        self.bandWidth = bandWidth
+
+    def align(self, referenceSequence, querySequence):
+        return [alignBanded(referenceSequence, querySequence, self.bandWidth)]
+
+    def score(self, referenceSequence, querySequence):
+        return alignBanded(referenceSequence, querySequence, self.bandWidth).score
+
+def benchmarkAligners(alignerBackends, referenceSequence, querySequence, alignerMethod='align', repeatCount=1):
+    # alignerBackends is a dictionary of name -> aligner. alignerMethod is align (with the aligned blocks) or score.
+    # Returns a dictionary of name -> seconds for one call, the fastest of repeatCount. An aligner that fails gets no time.
+    alignerTimes = {}
+    for backendName, aligner in alignerBackends.items():
+        try:
+            fastestTime = None
+            for repeatIndex in range(0, repeatCount):
+                startTime = perf_counter()
+                if (alignerMethod == 'score'):
+                    aligner.score(referenceSequence, querySequence)
+                else:
+                    aligner.align(referenceSequence, querySequence)[0].aligned
+                fastestTime = perf_counter() - startTime if fastestTime is None else min(fastestTime, perf_counter() - startTime)
+            alignerTimes[backendName] = fastestTime
+            logging.debug('Aligner ' + str(backendName) + ' ' + str(alignerMethod) + ' took ' + str(round(fastestTime, 4)) + ' seconds for '
+                + str(len(referenceSequence)) + ' x ' + str(len(querySequence)) + ' nucleotides')
+        except Exception as alignerError:
+            logging.warning('Aligner ' + str(backendName) + ' failed in the benchmark:' + str(alignerError))
+    return alignerTimes
@@ -0,0 +1,92 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from sys import exc_info
+
+from saddlebags.AnnotationResponse import findAnnotationResponseError
+from saddlebags.AnnotationServiceClient import getAnnotationServiceClient
+from saddlebags.AnnotationCache import getAnnotationCache
+from saddlebags.SaddlebagsConfig import getConfigurationValue
+
+import logging
+
+# Annotate many HLA sequences with the ACT service at once.
+# The requests are sent concurrently, several requests are in flight at the same time instead of waiting for each allele.
+# Problems are reported per allele, there are no popups, so one bad sequence does not stop the batch.
+# Sequences in the annotation cache are not sent to the service.
+# The responses are parsed from the bytes that curl returns, they are not decoded to text first.
+
+def assignAnnotation(hlaSequence, responseBody):
+    # Returns None if the sequence was annotated, otherwise the error message. The response can be text or bytes.
+    try:
+        errorMessage = findAnnotationResponseError(responseBody)
+        if (errorMessage is None):
+            hlaSequence.parseFeaturesFromJson(responseBody)
+        return errorMessage
+    except Exception:
+        return str(exc_info()[1])
+
+def annotateSequencesUsingService(hlaSequences, rawRequestURL, maxInFlight=8, annotationClient=None, useCache=True):
+    # Annotate a list of HlaSequences. Returns a list with an error message for each sequence, None if the sequence was annotated.
+    if (annotationClient is None):
+        annotationClient = getAnnotationServiceClient()
+    annotationCache = getAnnotationCache() if useCache else None
+
+    errorMessages = [None] * len(hlaSequences)
+    requestIndices = []
+    requestFieldsList = []
+    for sequenceIndex, hlaSequence in enumerate(hlaSequences):
+        if (hlaSequence.rawSequence is None or len(hlaSequence.rawSequence) < 1):
+            errorMessages[sequenceIndex] = 'The sequence is empty.'
+            continue
+
+        # Sequences that were annotated before don't need a request.
+        if (annotationCache is not None):
+            cachedAnnotation = annotationCache.lookup(hlaSequence.getCleanedSequence(), rawRequestURL)
+            if (cachedAnnotation is not None and assignAnnotation(hlaSequence, cachedAnnotation) is None):
+                continue
+
+        requestIndices.append(sequenceIndex)
+        requestFieldsList.append(hlaSequence.getAnnotationRequestFields())
+
+    logging.info('Annotating ' + str(len(requestFieldsList)) + ' sequences, with up to ' + str(maxInFlight) + ' requests in flight. '
+        + str(len(hlaSequences) - len(requestFieldsList)) + ' sequences were empty or cached.')
+    batchResults = annotationClient.performAnnotationBatch(rawRequestURL, requestFieldsList, maxInFlight)
+
+    for sequenceIndex, (responseCode, responseBody, errorMessage) in zip(requestIndices, batchResults):
+        hlaSequence = hlaSequences[sequenceIndex]
+        if (errorMessage is None):
+            errorMessage = assignAnnotation(hlaSequence, responseBody)
+            if (errorMessage is None and annotationCache is not None):
+                annotationCache.store(hlaSequence.getCleanedSequence(), rawRequestURL, responseBody)
+
+        if (errorMessage is not None):
+            logging.error('Could not annotate sequence #' + str(sequenceIndex + 1) + ':' + str(errorMessage))
+            hlaSequence.features = []
+        errorMessages[sequenceIndex] = errorMessage
+
+    return errorMessages
+
+def annotateBatchUsingService(submissionBatch, rawRequestURL=None, maxInFlight=None):
+    # Annotate the raw sequences of every submission in the batch.
+    # Returns a list of tuples (submission, errorMessage), errorMessage is None if the allele was annotated.
+    if (rawRequestURL is None):
+        rawRequestURL = getConfigurationValue('nmdp_act_rest_address')
+    if (maxInFlight is None):
+        maxInFlight = int(getConfigurationValue('act_max_in_flight') or 8)
+
+    submissions = submissionBatch.submissionBatch
+    errorMessages = annotateSequencesUsingService([submission.submittedAllele for submission in submissions], rawRequestURL, maxInFlight)
+    return list(zip(submissions, errorMessages))
@@ -0,0 +1,123 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+
+from Bio.Data.CodonTable import standard_dna_table
+from Bio.Seq import translate
+
+import logging
+
+# Translate coding sequences with a lookup table of the 64 codons, instead of building a Bio.Seq for every allele.
+# The sequence is uppercased once, and each codon is one dictionary lookup. This is plain python, numpy is only needed by the local annotation.
+# Codons with other letters (N, or IUPAC codes) are rare, those are translated by biopython, so the protein is always the same as Seq.translate().
+# validateTranslation checks the stop codon and reading frame, and returns the problems instead of showing them, so it can run in a batch.
+
+# The amino acid of each uppercase codon, * for the stop codons.
+codonTable = dict(standard_dna_table.forward_table)
+for stopCodon in standard_dna_table.stop_codons:
+    codonTable[stopCodon] = '*'
+
+@lru_cache(maxsize=1024)
+def translateCodon(codon):
+    # One codon, ambiguous codons are translated by biopython.
+    codon = str(codon).upper()
+    aminoAcid = codonTable.get(codon)
+    if (aminoAcid is not None):
+        return aminoAcid
+    return str(translate(codon))
+
+def translateCodingSequence(nucleotideSequence):
+    # Returns a tuple (proteinSequence, stopCodonLocation, frameRemainder).
+    # The protein is translated up to the last complete codon and includes every stop codon as *, like Seq.translate().
+    # stopCodonLocation is the position of the first * in the protein, -1 if there is no stop codon.
+    # frameRemainder is the number of nucleotides after the last complete codon.
+    nucleotideSequence = str(nucleotideSequence).upper()
+    frameRemainder = len(nucleotideSequence) % 3
+    codonEnd = len(nucleotideSequence) - frameRemainder
+    proteinSequence = ''.join([codonTable.get(nucleotideSequence[codonIndex:codonIndex + 3])
+        or translateCodon(nucleotideSequence[codonIndex:codonIndex + 3]) for codonIndex in range(0, codonEnd, 3)])
+    return proteinSequence, proteinSequence.find('*'), frameRemainder
+
+class TranslationResult():
+    # The translation of a coding sequence, and what is wrong with it.
+    # proteinSequence is the protein for the submission, without the stop codon and everything after it.
+    # warningTitle and warningMessage are None if the coding sequence looks fine.
+
+    def __init__(self):
+        self.nucleotideLength = 0
+        self.translatedProtein = ''
+        self.proteinSequence = ''
+        self.stopCodonLocation = -1
+        self.frameRemainder = 0
+        self.isPseudoGene = False
+        self.warningTitle = None
+        self.warningMessage = None
+
+def validateTranslation(nucleotideSequence):
+    # Translate a coding sequence and check the stop codon and the reading frame. Returns a TranslationResult.
+    translationResult = TranslationResult()
+    if (nucleotideSequence is None or len(nucleotideSequence) < 1):
+        logging.warning('Translating a nucleotide sequence of length 0. Done. That was easy.')
+        return translationResult
+
+    proteinSequence, stopCodonLocation, frameRemainder = translateCodingSequence(nucleotideSequence)
+    translationResult.nucleotideLength = len(nucleotideSequence)
+    translationResult.translatedProtein = proteinSequence
+    translationResult.proteinSequence = proteinSequence
+    translationResult.stopCodonLocation = stopCodonLocation
+    translationResult.frameRemainder = frameRemainder
+
+    # Stop codon *should* be at the end of the protein. The peptides after the first stop codon are removed,
+    # because that's what happens in real life.
+    if (stopCodonLocation == -1):
+        logging.info('No Stop Codon found. This is a "pseudo-gene".')
+        translationResult.isPseudoGene = True
+        translationResult.warningTitle = 'No Stop Codon Found'
+        if (frameRemainder == 0):
+            translationResult.warningMessage = ('The translated protein does not contain a stop codon.\n'
+                + 'This is indicated by a /pseudo flag in the sequence submission.')
+        else:
+            translationResult.warningMessage = ('The translated protein does not contain a stop codon.\n'
+                + 'The coding nucleotide sequence length (' + str(len(nucleotideSequence)) + ') is not a multiple of 3.\n'
+                + 'This is indicated by a /pseudo flag in the sequence submission.')
+
+    # If Stop Codon is in the end of the protein (This is expected and correct)
+    elif (stopCodonLocation == len(proteinSequence) - 1):
+        translationResult.proteinSequence = proteinSequence[0:stopCodonLocation]
+        if (frameRemainder == 0):
+            logging.info('The stop codon is in the correct position. This is not a "pseudo-gene".')
+        else:
+            logging.info('The stop codon is in the correct position, but there are extra nucleotides. This is not a "pseudo-gene".')
+            translationResult.warningTitle = 'Extra Nucleotides After the Stop Codon'
+            translationResult.warningMessage = ('The stop codon is at the correct position in the protein, but '
+                + 'The coding nucleotide sequence length (' + str(len(nucleotideSequence)) + ') is not a multiple of 3.\n\n'
+                + 'Please double check your sequence.')
+
+    # Else Stop Codon is premature (before the end of the protein)
+    else:
+        logging.info('A premature stop codon was found. This is a "pseudo-gene".')
+        translationResult.isPseudoGene = True
+        translationResult.proteinSequence = proteinSequence[0:stopCodonLocation]
+        translationResult.warningTitle = 'Premature Stop Codon Detected'
+        translationResult.warningMessage = ('Premature stop codon found:\nProtein Position (' + str(stopCodonLocation + 1) + '/' + str(len(proteinSequence)) + ')\n\n'
+            + 'This is indicated by a /pseudo flag in the sequence submission.\n'
+            + ('' if frameRemainder == 0 else 'Nucleotide count is not a multiple of 3,\n')
+            + 'Double check your protein sequence,\n'
+            + 'this might indicate a missense mutation.\n\n'
+            + 'Translated Protein:\n' + proteinSequence
+            + '\n\nProtein in ENA Submission:\n' + proteinSequence[0:stopCodonLocation] + '\n')
+
+    return translationResult
@@ -0,0 +1,55 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import Counter
+from io import StringIO
+
+# Formatting shared by the ENA and IPD-IMGT/HLA flatfiles. Both are based on the EMBL flatfile format:
+# ftp://ftp.ebi.ac.uk/pub/databases/embl/doc/usrman.txt
+
+def captureText(writeMethod):
+    # Run a method that writes to a text stream, and return the text as a string.
+    # The submission generators write their sections to a stream, the print methods use this to return strings.
+    outputStream = StringIO()
+    writeMethod(outputStream)
+    return outputStream.getvalue()
+
+def writeSequenceBlock(outputStream, completeSequence):
+    # Write the SQ block to a text stream (an open file, a gzip file in text mode, StringIO...)
+    # The sequence is written as it is, so the caller decides if it should be uppercase.
+    totalLength = len(completeSequence)
+
+    # Count the nucleotides in one pass.
+    nucleotideCounts = Counter(completeSequence.upper())
+    aCount = nucleotideCounts['A']
+    cCount = nucleotideCounts['C']
+    gCount = nucleotideCounts['G']
+    tCount = nucleotideCounts['T']
+    otherCount = totalLength - (cCount + gCount + tCount + aCount)
+
+    outputStream.write('SQ   Sequence ' + str(totalLength) + ' BP; '
+                     + str(aCount) + ' A; ' + str(cCount) + ' C; '
+                     + str(gCount) + ' G; ' + str(tCount) + ' T; '
+                     + str(otherCount) + ' other;\n')
+
+    # Print the sequence information in groups of 10, up to six "chunks" per line.
+    # The character code for a sequence region is two blank spaces, followed by three blank spaces, for a total of 5 blanks.
+    # An incomplete last row is filled with spaces, to align the nucleotide index at the end of the line.
+    for currentSeqIndex in range(0, totalLength, 60):
+        sequenceRow = completeSequence[currentSeqIndex:currentSeqIndex + 60]
+        outputStream.write('     '
+            + ' '.join([sequenceRow[i:i + 10] for i in range(0, 60, 10)]) + ' '
+            + ' ' * (60 - len(sequenceRow))
+            + str(currentSeqIndex + len(sequenceRow)) + '\n')
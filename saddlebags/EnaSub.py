@@ -51,6 +51,7 @@ from saddlebags.SaddlebagsConfig import getConfigurationValue, assignConfigurati
 from saddlebags.EnaSubXml import createProjectXML, createProjectSubmissionXML
 from saddlebags.EnaSubRest import performProjectSubmission, interpretAnalysisSubmissionResults
 from saddlebags.EnaSubJar import findJarFile
+from saddlebags.Logging import isPayloadLogged
 
 # In this file we submit to EMBL/ENA using the webin .jar file.
 # ENA Submission manual can be found here:
@@ -63,7 +64,7 @@ def checkENAPrerequisites():
 
 
 def performBatchEnaSubmission(submissionBatch):
-    logging.info('Submitting this batch of alleles:' + str(submissionBatch))
+    logging.info('Submitting this batch of alleles:%s', submissionBatch)
 
     for submission in submissionBatch.submissionBatch:
         performFullEnaSubmission(submission, submissionBatch)
@@ -265,7 +266,9 @@ def prepareSubmissionFiles(submission, submissionBatch, workingDirectory, dateTi
     try:
         outputFileObject = open(submissionFileName, 'w')
         outputFileObject.write(submission.enaSubmissionText)
-        logging.debug('Submission Text:\n' + submission.enaSubmissionText)
+        # The flatfile is only logged if log_payloads is on.
+        if (isPayloadLogged()):
+            logging.debug('Submission Text:\n%s', submission.enaSubmissionText)
         outputFileObject.close()
 
     except Exception:
@@ -504,7 +504,13 @@ class EnaSubGui(Frame):
             allGen = EnaSubGenerator()
             allGen.submission = currentSubmission
             allGen.submissionBatch = self.submissionBatch
+            currentSubmission.translationResult = None
             enaSubmissionText = allGen.buildENASubmission()
+
+            # The generator does not show popups, a problem with the translation is shown here.
+            translationResult = currentSubmission.translationResult
+            if (translationResult is not None and translationResult.warningMessage is not None):
+                showInfoBox(translationResult.warningTitle, translationResult.warningMessage)
                         
             if (enaSubmissionText is None or len(enaSubmissionText) < 1):
                 #showInfoBox('Empty submission text'
@@ -14,170 +14,64 @@
 # along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
 
 from sys import exc_info
-from io import StringIO, BytesIO
-from urllib.parse import urlencode
-from pycurl import Curl
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.Alphabet import generic_dna
-from json import loads
+from io import StringIO
+from array import array
+from re import compile as compilePattern
+from itertools import islice
+from collections import Counter
 
 from saddlebags.AlleleSubCommon import showInfoBox
+from saddlebags.AnnotationServiceClient import getAnnotationServiceClient
+from saddlebags.AnnotationCache import getAnnotationCache
+from saddlebags.AnnotationResponse import findAnnotationResponseError, decodeAnnotationFeatures
+from saddlebags.CodonTranslation import validateTranslation
+from saddlebags.SequenceFileReader import sniffSequenceFormat, iterateSequenceRecords
+from saddlebags.Logging import isPayloadLogged
 
 import logging
 
 def translateSequence(submission):
-    # This is a short wrapper method to use biopython's translation method.
-    # Most of this code is just checking for things that went wrong
-    # TODO: I'll need to fix the imports for these biopython methods. Don't worry, it'll break when the time comes.
+    # Translate the exons of a submission, and set the pseudogene flag.
+    # Returns a TranslationResult. Nothing is shown to the user here, a translation warning is in the result and
+    # in submission.translationResult, the caller decides if it is a popup box or a line in a batch report.
     # TODO: This method should be a class method of AlleleSubmission. Move it there.
     inputSequence = submission.submittedAllele.getExonSequence()
-    proteinSequence = ''
     alleleLocalName = submission.localAlleleName
 
     try:
-        # Do nothing if the input sequence is blank.
-        if (len(inputSequence) > 0):
-
-            coding_dna = Seq(inputSequence, generic_dna)
-            proteinSequence = str(coding_dna.translate())
-            logging.debug('Translating allele:' + alleleLocalName)
-            logging.debug('Exon Sequence before translation:' + coding_dna)
-            logging.debug('Translated Protein:' + proteinSequence)
-
-            # Perform Sanity Checks.
-            # Stop codon *should* be at the end of the protein.
-            # Here we seek out the first instance of a stop codon,
-            # and remove the peptides afterwards.
-            # because that's what happens in real life.
-            stopCodonLocation = proteinSequence.find('*')
-
-            # If no stop codon was found
-            if (stopCodonLocation == -1):
-                submission.isPseudoGene = True
-                # assignConfigurationValue('is_pseudo_gene','1')
-                logging.info('No Stop Codon found. This is a "pseudo-gene".')
-                # If multiple of three (correct codon length)
-                if (len(coding_dna) % 3 == 0):
-                    showInfoBox('No Stop Codon Found',
-                                        'The translated protein does not contain a stop codon.\n' +
-                                        'This is indicated by a /pseudo flag in the sequence submission.'
-                                        )
-
-                # Wrong Codon Length
-                else:
-                    showInfoBox('No Stop Codon Found',
-                                        'The translated protein does not contain a stop codon.\n' +
-                                        'The coding nucleotide sequence length (' + str(
-                                            len(coding_dna)) + ') is not a multiple of 3.\n' +
-                                        'This is indicated by a /pseudo flag in the sequence submission.')
-
-            # If Stop Codon is in the end of the protein (This is expected and correct)
-            elif (stopCodonLocation == len(proteinSequence) - 1):
-                submission.isPseudoGene = False
-                # assignConfigurationValue('is_pseudo_gene','0')
-
-                # If multiple of three (correct codon length)
-                if (len(coding_dna) % 3 == 0):
-                    # Everything is fine in this case.  Trim off the stop codon
-                    logging.info('The stop codon is in the correct position. This is not a "pseudo-gene".')
-                    proteinSequence = proteinSequence[0:stopCodonLocation]
-                    pass
-                    # Wrong Codon Length
-                else:
-                    logging.info(
-                        'The stop codon is in the correct position, but there are extra nucleotides. This is not a "pseudo-gene".')
-                    showInfoBox('Extra Nucleotides After the Stop Codon',
-                                        'The stop codon is at the correct position in the protein, but ' +
-                                        'The coding nucleotide sequence length (' + str(
-                                            len(coding_dna)) + ') is not a multiple of 3.\n\n' +
-                                        'Please double check your sequence.')
-                    proteinSequence = proteinSequence[0:stopCodonLocation]
-
-            # Else Stop Codon is premature (before the end of the protein)
-            else:
-                logging.info('A premature stop codon was found. This is a "pseudo-gene".')
-                submission.isPseudoGene = True
-                # assignConfigurationValue('is_pseudo_gene','1')
-
-                # If multiple of three (correct codon length)
-                if (len(coding_dna) % 3 == 0):
-                    showInfoBox('Premature Stop Codon Detected',
-                                        'Premature stop codon found:\nProtein Position (' +
-                                        str(stopCodonLocation + 1) + '/' +
-                                        str(len(proteinSequence)) + ')\n\n' +
-                                        'This is indicated by a /pseudo flag in the sequence submission.\n' +
-                                        'Double check your protein sequence,\n' +
-                                        'this might indicate a missense mutation.\n\n' +
-                                        'Translated Protein:\n' + proteinSequence +
-                                        '\n\nProtein in ENA Submission:\n' + proteinSequence[0:stopCodonLocation] +
-                                        '\n'
-                                        )
-                    proteinSequence = proteinSequence[0:stopCodonLocation]
-
-
-                # Wrong Codon Length
-                else:
-                    showInfoBox('Premature Stop Codon Detected',
-                                        'Premature stop codon found:\nProtein Position (' +
-                                        str(stopCodonLocation + 1) + '/' +
-                                        str(len(proteinSequence)) + ')\n\n' +
-                                        'This is indicated by a /pseudo flag in the sequence submission.\n' +
-                                        'Nucleotide count is not a multiple of 3,\n' +
-                                        'Double check your protein sequence,\n' +
-                                        'this might indicate a missense mutation.\n\n' +
-                                        'Translated Protein:\n' + proteinSequence +
-                                        '\n\nProtein in ENA Submission:\n' + proteinSequence[0:stopCodonLocation] +
-                                        '\n'
-                                        )
-                    proteinSequence = proteinSequence[0:stopCodonLocation]
-        else:
-            logging.warning('Translating a nucleotide sequence of length 0. Done. That was easy.')
-            pass
-
-        return proteinSequence
+        logging.debug('Translating allele:%s', alleleLocalName)
+        translationResult = validateTranslation(inputSequence)
+        # Without a coding sequence the pseudogene flag stays as it is.
+        if (translationResult.nucleotideLength > 0):
+            submission.isPseudoGene = translationResult.isPseudoGene
+        submission.translationResult = translationResult
+        if (translationResult.warningMessage is not None):
+            logging.warning('Translation of allele ' + str(alleleLocalName) + ', ' + translationResult.warningTitle + ':' + translationResult.warningMessage)
+        return translationResult
 
     except Exception:
         logging.error('Problem when translating protein:')
         logging.error(str(exc_info()))
-        showInfoBox('Protein Translation Error','I could not translate your protein:\n' + str(exc_info()))
-
         raise
 
 def collectAndValidateRoughSequence(roughNucleotideSequence):
     # This method can clean up a sequence input.
     # Should work for fasta and fastq inputs. XML in the future???
     try:
-        cleanedSequence = None
+        sequenceText = None
 
-        # Is this sequence in Fasta format?
-        try:
-            logging.debug('Checking if sequence is fasta format.')
-
-            fileHandleObject = StringIO(roughNucleotideSequence)
-            fastaSeqList = list(SeqIO.parse(fileHandleObject, 'fasta'))
-            logging.debug('The length of the fasta seq list is:' + str(len(fastaSeqList)))
-            if (len(fastaSeqList) == 1):
-                cleanedSequence = cleanSequence(str(fastaSeqList[0].seq))
-                logging.debug('The input sequence is in .fasta format.')
-            else:
-                logging.debug('This sequence is not in .fasta format.')
-        except Exception:
-            logging.error('Exception when determining file type: ' + str(exc_info()))
-
-        # Is this sequence in Fastq format?
-        try:
-            logging.debug('Checking if sequence is fastq format.')
-            fileHandleObject = StringIO(roughNucleotideSequence)
-            fastqSeqList = list(SeqIO.parse(fileHandleObject, 'fastq'))
-            logging.debug('The length of the fasta seq list is:' + str(len(fastaSeqList)))
-            if (len(fastqSeqList) == 1):
-                cleanedSequence = cleanSequence(str(fastqSeqList[0].seq))
-                logging.debug('The input sequence is in .fastq format.')
-            else:
-                logging.debug('This sequence is not in .fastq format.')
-        except Exception:
-            logging.error('Exception when determining file type: ' + str(exc_info()))
+        # Is this sequence in Fasta or Fastq format? The format is found from the first character, and the text is parsed once.
+        sequenceFormat = sniffSequenceFormat(roughNucleotideSequence)
+        if (sequenceFormat is not None):
+            try:
+                # Only a single record is used, the second one is just read to know there is more than one.
+                sequenceRecords = list(islice(iterateSequenceRecords(StringIO(roughNucleotideSequence), sequenceFormat), 2))
+                logging.debug('The number of ' + sequenceFormat + ' records is:' + str(len(sequenceRecords)))
+                if (len(sequenceRecords) == 1):
+                    sequenceText = sequenceRecords[0][1]
+                    logging.debug('The input sequence is in .' + sequenceFormat + ' format.')
+            except Exception:
+                logging.error('Exception when reading the ' + sequenceFormat + ' sequence: ' + str(exc_info()))
 
         # TODO: If this file is xml what should we do?  Just give up i suppose.
         # TODO: I could warn the user that XML isn't supported yet...
@@ -185,21 +79,22 @@ def collectAndValidateRoughSequence(roughNucleotideSequence):
         # Yeah I dunno about HML, we will not implement that right now.
 
         # If we haven't found an annotated sequence yet, this is not fasta or fastq.
-        if (cleanedSequence is None):
-            cleanedSequence = cleanSequence(roughNucleotideSequence)
-
-        # Are we using any nonstandard / ambiguous nucleotides?
-        for nucleotideCharacter in cleanedSequence:
-            if (nucleotideCharacter not in ('A', 'G', 'C', 'T', 'a', 'g', 'c', 't')):
-                showInfoBox('Nonstandard Nucleotide'
-                                     , 'I found a non-standard\n'
-                                     + 'character in your nucleotide\n'
-                                     + 'sequence: '
-                                     + str(nucleotideCharacter) + '\n'
-                                     + 'You should use standard nucleotide\n'
-                                     + 'characters in your submission.\n'
-                                     + 'I will attempt to continue.')
-                break
+        if (sequenceText is None):
+            sequenceText = roughNucleotideSequence
+
+        # Are we using any nonstandard / ambiguous nucleotides? The sequence is cleaned and checked in the same pass.
+        cleanedSequence, nonstandardCounts, firstNonstandardPosition = cleanAndCheckSequence(sequenceText)
+        if (firstNonstandardPosition is not None):
+            logging.warning('Nonstandard nucleotides in the input sequence:' + str(dict(nonstandardCounts))
+                + ', the first one is at position ' + str(firstNonstandardPosition))
+            showInfoBox('Nonstandard Nucleotide'
+                                 , 'I found a non-standard\n'
+                                 + 'character in your nucleotide\n'
+                                 + 'sequence: '
+                                 + str(cleanedSequence[firstNonstandardPosition]) + '\n'
+                                 + 'You should use standard nucleotide\n'
+                                 + 'characters in your submission.\n'
+                                 + 'I will attempt to continue.')
 
         return cleanedSequence
 
@@ -217,22 +112,237 @@ def cleanSequence(inputSequenceText):
     else:
         logging.debug('Cleaning Input Sequence.')
 
-    cleanedSequence = inputSequenceText.replace(' ', '').replace('\n', '').replace('\t', '').replace('\r', '')
-    return cleanedSequence
+    return cleanAndCheckSequence(inputSequenceText)[0]
+
+# Spaces, tabs and newlines are deleted from a sequence with one translate call, instead of a copy of the sequence for each character.
+# Deleting the standard nucleotides from the cleaned sequence leaves only the nonstandard characters, so they don't need to be found one at a time.
+whitespaceCharacters = ' \n\t\r'
+standardNucleotides = 'ACGTacgt'
+whitespaceDeletionBytes = whitespaceCharacters.encode('ascii')
+standardNucleotideDeletionBytes = standardNucleotides.encode('ascii')
+whitespaceDeletionTable = str.maketrans('', '', whitespaceCharacters)
+standardNucleotideDeletionTable = str.maketrans('', '', standardNucleotides)
+
+def cleanAndCheckSequence(inputSequenceText):
+    # Returns a tuple (cleanedSequence, nonstandardCounts, firstNonstandardPosition).
+    # nonstandardCounts is a Counter of the characters that are not A, G, C or T, firstNonstandardPosition is
+    # the index of the first one in the cleaned sequence, or None if the sequence only has standard nucleotides.
+    if (inputSequenceText is None):
+        return None, Counter(), None
+
+    try:
+        # bytes.translate is faster than str.translate. Sequences are almost always ASCII.
+        cleanedBytes = inputSequenceText.encode('ascii').translate(None, whitespaceDeletionBytes)
+        cleanedSequence = cleanedBytes.decode('ascii')
+        nonstandardCharacters = cleanedBytes.translate(None, standardNucleotideDeletionBytes).decode('ascii')
+    except UnicodeEncodeError:
+        cleanedSequence = inputSequenceText.translate(whitespaceDeletionTable)
+        nonstandardCharacters = cleanedSequence.translate(standardNucleotideDeletionTable)
+
+    if (len(nonstandardCharacters) == 0):
+        return cleanedSequence, Counter(), None
+    nonstandardCounts = Counter(nonstandardCharacters)
+    # There are only a few different nonstandard characters, each one is searched for once.
+    firstNonstandardPosition = min(cleanedSequence.find(nonstandardCharacter) for nonstandardCharacter in nonstandardCounts)
+    return cleanedSequence, nonstandardCounts, firstNonstandardPosition
+
+# An exon run starts with a capital nucleotide and continues until the next lowercase nucleotide, and vice versa.
+# Nonstandard characters never end a run.
+featureRunPattern = compilePattern('[ACGT][^acgt]*|[acgt][^ACGT]*')
+nonstandardNucleotidePattern = compilePattern('[^ACGTacgt]')
+
+def findFeatureBoundaries(annotatedSequence):
+    # Find the exon/intron transitions in an annotated sequence (exons capital, introns/UTRs lowercase).
+    # Returns a list of (beginPosition, endPosition, isExon) tuples, positions are python slice indices.
+    featureBoundaries = []
+    for runMatch in featureRunPattern.finditer(annotatedSequence):
+        featureBoundaries.append((runMatch.start(), runMatch.end(), runMatch.group()[0].isupper()))
+
+    # Any nonstandard characters before the first nucleotide are the beginning of an Intron/UTR.
+    if (len(featureBoundaries) == 0):
+        if (len(annotatedSequence) > 0):
+            featureBoundaries.append((0, len(annotatedSequence), False))
+    elif (featureBoundaries[0][0] > 0):
+        if (featureBoundaries[0][2]):
+            featureBoundaries.insert(0, (0, featureBoundaries[0][0], False))
+        else:
+            featureBoundaries[0] = (0, featureBoundaries[0][1], False)
+
+    return featureBoundaries
 
 class GeneFeature():
-    
-    def __init__(self):
-        self.name = None
-        self.sequence = None
-        self.exon = False
-        self.beginIndex = 0
-        self.endIndex = 0
+    # A GeneFeature is a UTR, Exon, or Intron.
+    # A new GeneFeature stores its own values. Features that belong to an HlaSequence are views into the FeatureTable
+    # of that sequence, so the nucleotides are not copied for every feature.
+    __slots__ = ('_table', '_index', '_name', '_sequence', '_exon', '_beginIndex', '_endIndex')
+
+    def __init__(self, featureTable=None, featureIndex=0):
+        self._table = featureTable
+        self._index = featureIndex
+        self._name = None
+        self._sequence = None
+        self._exon = False
+        self._beginIndex = 0
+        self._endIndex = 0
+
+    @property
+    def name(self):
+        return self._name if self._table is None else self._table.names[self._index]
+
+    @name.setter
+    def name(self, name):
+        if(self._table is None):
+            self._name = name
+        else:
+            self._table.names[self._index] = name
+
+    @property
+    def sequence(self):
+        return self._sequence if self._table is None else self._table.getSequence(self._index)
+
+    @sequence.setter
+    def sequence(self, sequence):
+        if(self._table is None):
+            self._sequence = sequence
+        else:
+            self._table.setSequence(self._index, sequence)
+
+    @property
+    def exon(self):
+        return self._exon if self._table is None else self._table.isExon(self._index)
+
+    @exon.setter
+    def exon(self, exon):
+        if(self._table is None):
+            self._exon = exon
+        else:
+            self._table.setExon(self._index, exon)
+
+    @property
+    def beginIndex(self):
+        return self._beginIndex if self._table is None else self._table.beginIndices[self._index]
+
+    @beginIndex.setter
+    def beginIndex(self, beginIndex):
+        if(self._table is None):
+            self._beginIndex = beginIndex
+        else:
+            self._table.beginIndices[self._index] = beginIndex
+
+    @property
+    def endIndex(self):
+        return self._endIndex if self._table is None else self._table.endIndices[self._index]
+
+    @endIndex.setter
+    def endIndex(self, endIndex):
+        if(self._table is None):
+            self._endIndex = endIndex
+        else:
+            self._table.endIndices[self._index] = endIndex
 
     def length(self):
         return 1 + self.endIndex - self.beginIndex     
 
 
+class FeatureTable():
+    # The features of a single HLA allele, stored compactly.
+    # All of the nucleotides are in one str buffer, exons uppercase and introns/UTRs lowercase, so the buffer is
+    # the annotated sequence. Nucleotide strings are ASCII, which python stores with one byte per character. sequenceOffsets has the buffer offsets of each feature (one extra entry for the end).
+    # beginIndices and endIndices are the 1-based nucleotide positions assigned in nameAnnotatedFeatures.
+    # The exon flags are bits in exonMask.
+    # The sequences of new features are collected in sequenceChunks, and joined into the buffer the next time it is read,
+    # so a table that is built one feature at a time does not copy the whole buffer for every feature.
+    # Indexing a FeatureTable returns a GeneFeature view, so it can be used like the old list of GeneFeatures.
+    __slots__ = ('sequenceChunks', 'sequenceOffsets', 'beginIndices', 'endIndices', 'exonMask', 'names', 'modificationCount')
+
+    def __init__(self, features=None):
+        self.sequenceChunks = ['']
+        self.sequenceOffsets = array('I', [0])
+        self.beginIndices = array('I')
+        self.endIndices = array('I')
+        self.exonMask = 0
+        self.names = []
+        # This is incremented when the nucleotides change, HlaSequence uses it to know when the cached sequences are old.
+        self.modificationCount = 0
+        if(features is not None):
+            self.extend(features)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, featureIndex):
+        if(isinstance(featureIndex, slice)):
+            return [GeneFeature(self, x) for x in range(*featureIndex.indices(len(self)))]
+        if(featureIndex < 0):
+            featureIndex += len(self)
+        if(featureIndex < 0 or featureIndex >= len(self)):
+            raise IndexError('Feature index out of range:' + str(featureIndex))
+        return GeneFeature(self, featureIndex)
+
+    def __iter__(self):
+        for featureIndex in range(0, len(self)):
+            yield GeneFeature(self, featureIndex)
+
+    def append(self, feature):
+        self.extend([feature])
+
+    def extend(self, features):
+        currentOffset = self.sequenceOffsets[-1]
+        for feature in features:
+            featureIndex = len(self.names)
+            casedSequence = self.caseSequence(feature.sequence, feature.exon)
+            self.sequenceChunks.append(casedSequence)
+            currentOffset += len(casedSequence)
+            self.sequenceOffsets.append(currentOffset)
+            self.beginIndices.append(feature.beginIndex)
+            self.endIndices.append(feature.endIndex)
+            self.names.append(feature.name)
+            if(feature.exon):
+                self.exonMask |= (1 << featureIndex)
+        self.modificationCount += 1
+
+    @property
+    def sequenceBuffer(self):
+        if(len(self.sequenceChunks) > 1):
+            self.sequenceChunks = [''.join(self.sequenceChunks)]
+        return self.sequenceChunks[0]
+
+    def caseSequence(self, sequence, exon):
+        if(sequence is None):
+            return ''
+        return sequence.upper() if exon else sequence.lower()
+
+    def getSequence(self, featureIndex):
+        return self.sequenceBuffer[self.sequenceOffsets[featureIndex]:self.sequenceOffsets[featureIndex + 1]]
+
+    def setSequence(self, featureIndex, sequence):
+        casedSequence = self.caseSequence(sequence, self.isExon(featureIndex))
+        beginOffset = self.sequenceOffsets[featureIndex]
+        endOffset = self.sequenceOffsets[featureIndex + 1]
+        sequenceBuffer = self.sequenceBuffer
+        self.sequenceChunks = [sequenceBuffer[0:beginOffset] + casedSequence + sequenceBuffer[endOffset:]]
+        lengthDifference = len(casedSequence) - (endOffset - beginOffset)
+        for x in range(featureIndex + 1, len(self.sequenceOffsets)):
+            self.sequenceOffsets[x] += lengthDifference
+        self.modificationCount += 1
+
+    def isExon(self, featureIndex):
+        return bool(self.exonMask & (1 << featureIndex))
+
+    def setExon(self, featureIndex, exon):
+        currentSequence = self.getSequence(featureIndex)
+        if(exon):
+            self.exonMask |= (1 << featureIndex)
+        else:
+            self.exonMask &= ~(1 << featureIndex)
+        # Exons are stored uppercase, so the nucleotides must be re-cased.
+        self.setSequence(featureIndex, currentSequence)
+
+    def getAnnotatedSequence(self):
+        # The buffer is returned as it is, str is immutable so nobody can change it.
+        return self.sequenceBuffer
+
+
 class HlaSequence():
     # The HlaSequence class represents an entire HLA alleles, consisting of a series of loci.
 
@@ -242,6 +352,49 @@ class HlaSequence():
         self.geneLocus = None
         self.hlaClass = None
 
+    # The exon sequence is cached, because the generators ask for it over and over. The annotated sequence doesn't need a cache,
+    # it is the FeatureTable buffer. The cache is cleared when rawSequence or features is assigned, or when the nucleotides in the FeatureTable change.
+    # The cleaned raw sequence only depends on rawSequence, it is cached until rawSequence is assigned.
+    @property
+    def rawSequence(self):
+        return self._rawSequence
+
+    @rawSequence.setter
+    def rawSequence(self, rawSequence):
+        self._rawSequence = rawSequence
+        self._cleanedSequenceCache = None
+        self.invalidateSequenceCache()
+
+    @property
+    def features(self):
+        return self._features
+
+    @features.setter
+    def features(self, features):
+        # A list of GeneFeatures is copied into a FeatureTable.
+        self._features = features if isinstance(features, FeatureTable) else FeatureTable(features)
+        self.invalidateSequenceCache()
+
+    def invalidateSequenceCache(self):
+        self._exonSequenceCache = None
+        self._cachedModificationCount = None
+
+    def checkSequenceCache(self):
+        # Features can be modified in place, then the cached sequences are no longer valid.
+        if(self._cachedModificationCount != self.features.modificationCount):
+            self.invalidateSequenceCache()
+            self._cachedModificationCount = self.features.modificationCount
+
+    def checkRawSequence(self):
+        # Returns the tuple (cleanedSequence, nonstandardCounts, firstNonstandardPosition) of the raw sequence, see cleanAndCheckSequence.
+        if(self._cleanedSequenceCache is None):
+            self._cleanedSequenceCache = cleanAndCheckSequence(self.rawSequence)
+        return self._cleanedSequenceCache
+
+    def getCleanedSequence(self):
+        # The raw sequence without spaces, tabs and newlines.
+        return self.checkRawSequence()[0]
+
     def totalLength(self):
         #logging.info('Calculating the total length. It is:' + str(len(self.getCompleteSequence())))
         #logging.info('I have this many features: ' + str(len(self.features)))
@@ -255,26 +408,19 @@ class HlaSequence():
         if(len(self.features) < 1):
             logging.warning('There is no stored annotation, so I will return the raw sequence as an annotated sequence.')
             return self.rawSequence
-        else:
+        elif(includeLineBreaks):
             #logging.debug('getAnnotatedSequence: I identified ' + str(len(self.features)) + ' features.')
-            sequence=''
-            for i in range(0, len(self.features)):
-                currentFeature = self.features[i]
-                if(currentFeature.exon):
-                    sequence += currentFeature.sequence.upper()
-                else:
-                    sequence += currentFeature.sequence.lower()
-                if(includeLineBreaks):
-                    sequence += '\n'
-            return sequence
+            return ''.join(feature.sequence + '\n' for feature in self.features)
+        else:
+            # The FeatureTable buffer is already cased: Exons are uppercase, Introns and UTRs are lowercase.
+            return self.features.getAnnotatedSequence()
 
     def getExonSequence(self):
         # Combine the Exons into a contiguous sequence
-        sequence=''
-        for i in range(0, len(self.features)):
-            if(self.features[i].exon):
-                sequence += self.features[i].sequence
-        return sequence
+        self.checkSequenceCache()
+        if(self._exonSequenceCache is None):
+            self._exonSequenceCache = ''.join(feature.sequence for feature in self.features if feature.exon)
+        return self._exonSequenceCache
  
     def nameAnnotatedFeatures(self):
         # This method names the UTRs, Exons, and Introns, and records their indices.
@@ -349,153 +495,72 @@ class HlaSequence():
     #     # Circle back on this one later, should I store a variable somewhere if the sequence has been annotated?
     #     return False
 
-    def annotateSequenceUsingService(self, rawRequestURL=None):
+    def annotateSequenceUsingService(self, rawRequestURL=None, annotationClient=None, useCache=True):
         # Just a wrapper method, call this when I want to annotate using the service.
-        sequenceAnnotation = self.fetchAnnotationJson(rawRequestURL=rawRequestURL)
+        sequenceAnnotation = self.fetchAnnotationJson(rawRequestURL=rawRequestURL, annotationClient=annotationClient, useCache=useCache)
         self.identifyFeaturesFromJson(sequenceAnnotation)
 
-    def fetchAnnotationJson(self, rawRequestURL=None):
-        try:
-            postData = {'sequence': self.rawSequence}
+        # Only annotations that worked are stored in the cache.
+        annotationCache = getAnnotationCache() if useCache else None
+        if(annotationCache is not None and sequenceAnnotation is not None and len(self.features) > 0):
+            annotationCache.store(self.getCleanedSequence(), rawRequestURL, sequenceAnnotation)
+
+    def fetchAnnotationJson(self, rawRequestURL=None, annotationClient=None, useCache=True):
+        # Returns the annotation JSON, the bytes of the response or the text from the annotation cache. None if there was a problem.
+        # By default the shared client is used, so the connection to the service stays open between sequences.
+        if(annotationClient is None):
+            annotationClient = getAnnotationServiceClient()
+
+        # Sequences that were annotated before are read from the annotation cache, without asking the service.
+        annotationCache = getAnnotationCache() if useCache else None
+        if(annotationCache is not None and rawRequestURL is not None and self.rawSequence is not None):
+            cachedAnnotation = annotationCache.lookup(self.getCleanedSequence(), rawRequestURL)
+            if(cachedAnnotation is not None):
+                return cachedAnnotation
 
+        try:
             # Using configuration here causes circular dependency. So I'll just pass it in.
             if(rawRequestURL is None):
                 logging.error('You must pass a rawRequestURL to fetchAnnotationJson.')
                 return
-            else:
-                requestURL = rawRequestURL + '?' + urlencode(postData)
-
-            resultsIoObject = BytesIO()
-
-            curlObject = Curl()
-            curlObject.setopt(curlObject.URL, requestURL)
-            curlObject.setopt(curlObject.WRITEDATA, resultsIoObject)
-
-            curlObject.perform()
-            curlObject.close()
 
-            getBody = resultsIoObject.getvalue().decode('utf8')
+            # The sequence is sent in the request body, a long class II allele is too long for a URL.
+            responseCode, responseBody = annotationClient.performAnnotation(rawRequestURL, self.getAnnotationRequestFields())
 
-            logging.debug('JSON Request Body:\n' + getBody)
+            # The JSON has the whole sequence, it is only decoded and logged if log_payloads is on.
+            if(isPayloadLogged()):
+                logging.debug('JSON Request Body:\n%s', responseBody.decode('utf8', 'replace'))
 
-            # TODO:
-            # Detect error <head><title>414 Request-URI Too Large</title></head>
-            # For larger DRB alleles the webserver fails.
-            # Detect error if the result is not json.
-            # Maybe this error detection happens in parseExons. But i maybe need to detect server errors here.
-            # Simple case is an empty string.
-            if(getBody is None or len(getBody)<1):
-                logging.error('The JSON results were an empty string. Is there a problem with the ACT server?:' + str(requestURL))
-                showInfoBox('Problem Accessing Annotation Service','The JSON results were an empty string. Is there a problem with the ACT server?')
+            responseError = findAnnotationResponseError(responseBody)
+            if(responseError is not None):
+                logging.error(responseError + ':' + str(rawRequestURL))
+                showInfoBox('Problem Accessing Annotation Service', responseError)
                 return None
 
-            # If it's an html error we can respond nicely.
-            if(getBody[0:5]=='<html>'):
-                # TODO: this might not work if i get some other kind of html.
-                errorCode = getBody[getBody.find('<title>'):getBody.find('</title>')]
-                logging.error('The annotation JSON results are html, this probably indicates an issue with the annotation webserver:\n' + str(requestURL))
-                showInfoBox('Problem Accessing Annotation Service', 'The annotation results are HTML, not JSON, probably an issue with the ACT webserver:\n' + str(errorCode))
-                return None
-
-            return getBody
+            # The bytes are returned as they are, parseFeaturesFromJson decodes them without an intermediate str.
+            return responseBody
 
         except Exception:
             logging.error('Exception when performing CURL:\n')
             logging.error(str(exc_info()))
-            logging.error('URL:' + str(requestURL))
+            logging.error('URL:' + str(rawRequestURL))
 
             raise
 
+    def getAnnotationRequestFields(self):
+        return {'sequence': self.rawSequence}
+
     def identifyFeaturesFromJson(self, sequenceAnnotationJson):
         # This method parses the Json text from the ACT service, and identifies the genomic features.
         # It performs some sanity checks and then sets the according features in this HlaGene object.
 
-        # The json should be a String, but it is returned from the NMDP ACT API as a "Typing" object. I convert it to a String to make everyone happy.
-        jsonString = str(sequenceAnnotationJson)
-        if(jsonString is not None and len(jsonString) > 1):
+        # The json should be a String or the bytes of the response. If it is returned from the NMDP ACT API as a "Typing" object, I convert it to a String to make everyone happy.
+        if(sequenceAnnotationJson is not None and not isinstance(sequenceAnnotationJson, (str, bytes))):
+            sequenceAnnotationJson = str(sequenceAnnotationJson)
+        if(sequenceAnnotationJson is not None and len(sequenceAnnotationJson) > 1):
 
             try:
-                self.features = []
-                fivePrimeSequence = ''
-                threePrimeSequence = ''
-
-
-
-                #logging.debug('THIS IS THE JSON STRING\n:' + jsonString)
-                parsedJson = loads(jsonString)
-
-                if (len(parsedJson.keys()) > 1):
-                    # Loop through the recognized Features
-                    if 'features' in parsedJson.keys():
-                        # We found features.
-                        featureList = parsedJson['features']
-                        logging.info('I found this many Known Features:' + str(len(featureList)))
-
-                        for featureDictionary in featureList:
-
-                            term = str(featureDictionary['term'])
-                            rank = str(featureDictionary['rank'])
-                            sequence = str(featureDictionary['sequence'])
-
-                            logging.debug('Known Feature'
-                                          + ':' + term
-                                          + ':' + rank
-                                          + ':' + sequence)
-
-                            currentFeature = GeneFeature()
-
-                            if (term == 'five_prime_UTR'):
-                                currentFeature.sequence = sequence.lower()
-                                currentFeature.exon = False
-                                fivePrimeSequence = currentFeature.sequence
-                            elif (term == 'three_prime_UTR'):
-                                currentFeature.sequence = sequence.lower()
-                                currentFeature.exon = False
-                                threePrimeSequence = currentFeature.sequence
-                            elif (term == 'exon'):
-                                currentFeature.sequence = sequence.upper()
-                                currentFeature.exon = True
-                            elif (term == 'intron'):
-                                currentFeature.sequence = sequence.lower()
-                                currentFeature.exon = False
-                            else:
-                                raise Exception('Unknown Feature Term, expected exon or intron:' + term)
-
-                            self.features.append(currentFeature)
-
-                    else:
-                        raise Exception('Unable to identify any HLA exon features, unable to annotate sequence.')
-
-                    if (len(fivePrimeSequence) < 1):
-                        logging.warning('I cannot find a five prime UTR.')
-                        logging.info('Rough Sequence:\n' + cleanSequence(self.rawSequence).upper())
-                        logging.info('Annotated Sequence:\n' + cleanSequence(annotatedSequence).upper())
-                        raise Exception('GFE service did not find a 5\' UTR sequence. You will need to annotate the genomic features manually.')
-
-                    elif cleanSequence(fivePrimeSequence).upper() in cleanSequence(self.rawSequence).upper():
-                        # What if the reported 5' UTR is less than what is returned by GFE?
-                        # TODO: I don't know if this code is working. Hard to debug.
-                        beginIndex = cleanSequence(self.rawSequence).upper().find(cleanSequence(fivePrimeSequence).upper())
-                        endIndex = beginIndex + len(fivePrimeSequence)
-                        logging.info('GFE sequence exists in rough sequence, at index: (' + str(beginIndex) + ':' + str(endIndex) + ')')
-                        logging.info('previous fivePrime Sequence=\n' + fivePrimeSequence)
-                        fivePrimeSequence = cleanSequence(self.rawSequence)[0:endIndex].lower()
-                        logging.info('new fivePrime Sequence=\n' + fivePrimeSequence)
-
-                    self.nameAnnotatedFeatures()
-
-                    # Final check: Do the annotated sequence and rough sequence match?
-                    if (cleanSequence(self.getAnnotatedSequence(includeLineBreaks=False)).upper() == cleanSequence(self.rawSequence).upper()):
-                        logging.info('Successful annotation.')
-                        pass
-
-                    else:
-                        logging.error('Rough Sequence:\n' + cleanSequence(self.rawSequence).upper())
-                        logging.error('Annotated Sequence:\n' + cleanSequence(self.getAnnotatedSequence(includeLineBreaks=True)).upper())
-                        raise Exception('Annotated sequence and rough sequence do not match. Something went wrong in Annotation.')
-
-                else:
-                    raise Exception('No keys found in the JSON Dictionary, unable to annotate sequence.')
+                self.parseFeaturesFromJson(sequenceAnnotationJson)
 
             except Exception:
                 logging.error(str((exc_info())))
@@ -503,6 +568,62 @@ class HlaSequence():
         else:
             logging.error('JSON Parse is empty.')
 
+    def parseFeaturesFromJson(self, annotationJson):
+        # Assign the features from the ACT service Json, as text or as the bytes of the response. Raises an exception if the sequence could not be annotated,
+        # so batch annotation can report the problem for each allele instead of showing a popup.
+        self.features = []
+        parsedFeatures = []
+        fivePrimeSequence = ''
+
+        annotationFeatures = decodeAnnotationFeatures(annotationJson)
+        logging.info('I found this many Known Features:' + str(len(annotationFeatures)))
+
+        for term, sequence, isExon in annotationFeatures:
+            # The sequence is not cased here, the FeatureTable stores exons uppercase and the other features lowercase.
+            currentFeature = GeneFeature()
+            currentFeature.sequence = sequence
+            currentFeature.exon = isExon
+            if (term == 'five_prime_UTR'):
+                fivePrimeSequence = sequence
+            parsedFeatures.append(currentFeature)
+
+        # Assigning the list (instead of appending to self.features) clears the cached sequences.
+        self.features = parsedFeatures
+
+        # The raw sequence is cleaned and capitalized once, for all of the checks below.
+        cleanedRawSequence = self.getCleanedSequence()
+        upperRawSequence = '' if cleanedRawSequence is None else cleanedRawSequence.upper()
+
+        if (len(fivePrimeSequence) < 1):
+            logging.warning('I cannot find a five prime UTR.')
+            if (isPayloadLogged(logging.INFO)):
+                logging.info('Rough Sequence:\n%s', upperRawSequence)
+                logging.info('Annotated Sequence:\n%s', cleanSequence(self.getAnnotatedSequence(includeLineBreaks=False)).upper())
+            raise Exception('GFE service did not find a 5\' UTR sequence. You will need to annotate the genomic features manually.')
+
+        elif cleanSequence(fivePrimeSequence).upper() in upperRawSequence:
+            # What if the reported 5' UTR is less than what is returned by GFE?
+            # TODO: I don't know if this code is working. Hard to debug.
+            beginIndex = upperRawSequence.find(cleanSequence(fivePrimeSequence).upper())
+            endIndex = beginIndex + len(fivePrimeSequence)
+            logging.info('GFE sequence exists in rough sequence, at index: (%s:%s)', beginIndex, endIndex)
+            if (isPayloadLogged(logging.INFO)):
+                logging.info('previous fivePrime Sequence=\n%s', fivePrimeSequence)
+                logging.info('new fivePrime Sequence=\n%s', cleanedRawSequence[0:endIndex].lower())
+
+        self.nameAnnotatedFeatures()
+
+        # Final check: Do the annotated sequence and rough sequence match?
+        if (cleanSequence(self.getAnnotatedSequence(includeLineBreaks=False)).upper() == upperRawSequence):
+            logging.info('Successful annotation.')
+            pass
+
+        else:
+            if (isPayloadLogged(logging.ERROR)):
+                logging.error('Rough Sequence:\n%s', upperRawSequence)
+                logging.error('Annotated Sequence:\n%s', cleanSequence(self.getAnnotatedSequence(includeLineBreaks=True)).upper())
+            raise Exception('Annotated sequence and rough sequence do not match. Something went wrong in Annotation.')
+
     def identifyFeaturesFromFormattedSequence(self):
         # The input file should be a string of nucleotides, with capital letters to identify exons and introns.
         # Annotations are expected and read in this format:
@@ -513,6 +634,7 @@ class HlaSequence():
 
         inputSequenceText = self.rawSequence
         self.features = []
+        featureList = []
 
         if (inputSequenceText is None):
             logging.warning('Attempting to Identify Genomic Features on an input sequence that is None.')
@@ -523,76 +645,36 @@ class HlaSequence():
         # TODO: I probably need to change the call to cleanSequence to collectAndValidateRoughSequence
         # Disregard the header line completely. Is there still sequence?
 
-        cleanedInputText = cleanSequence(inputSequenceText)
+        cleanedInputText, nonstandardCounts, firstNonstandardPosition = cleanAndCheckSequence(inputSequenceText)
 
         # Capitalize, so I can store a copy of the full unannotated sequence.
         unannotatedGene = cleanedInputText.upper()
         self.rawSequence = unannotatedGene
-        logging.info('Total Unannotated Sequence Length = ' + str(len(unannotatedGene)))
+        logging.info('Total Unannotated Sequence Length = %s', len(unannotatedGene))
 
-        # Loop through the cleaned and annotated input sequence,
-        # capitals and lowercase letters to determine exon start and end
+        # Find the runs of capital and lowercase letters to determine exon start and end
         if (len(cleanedInputText) > 0):
 
             # Is the first feature an exon or an intron?
-            # If we begin in an Exon
-            if (cleanedInputText[0] in ('A', 'G', 'C', 'T')):
-                insideAnExon = True
-            # If we begin in an Intron/UTR
-            elif (cleanedInputText[0] in ('a', 'g', 'c', 't')):
-                insideAnExon = False
-            else:
+            # If we begin with a nonstandard nucleotide, it is treated as an Intron/UTR.
+            if (firstNonstandardPosition == 0):
                 # Nonstandard nucleotide? I should start panicking.
                 # raise Exception('Nonstandard Nucleotide, not sure how to handle it')
-                logging.error('Nonstandard Nucleotide at the beginning of the sequence, not sure how to handle it', 'ERROR')
-                insideAnExon = False
-
-            locusBeginPosition = 0
-            for x in range(0, len(cleanedInputText)):
-                currentChar = cleanedInputText[x]
-
-                # Is this a standard nucleotide character?
-                if (currentChar.upper() in ('A', 'G', 'C', 'T')):
-
-                    if (currentChar.isupper()):
-                        if (insideAnExon):
-                            # We're STILL in an exon.  In this case, I should just do nothing and continue.
-                            pass
-                        else:
-                            # In this case, we're just starting an EXON.
-                            # Store the last Intron in the list.
-                            currentIntron = GeneFeature()
-                            currentIntron.sequence = cleanedInputText[locusBeginPosition:x].upper()
-                            currentIntron.exon = False
-                            self.features.append(currentIntron)
-                            insideAnExon = True
-                            locusBeginPosition = x
-                            pass
-
-                    else:
-                        if not (insideAnExon):
-                            # We're STILL in an intron.  Continue.
-                            pass
-                        else:
-                            # Starting a new Intron.
-                            # Store an Exon in the list.
-                            currentExon = GeneFeature()
-                            currentExon.sequence = cleanedInputText[locusBeginPosition:x].upper()
-                            currentExon.exon = True
-                            self.features.append(currentExon)
-                            insideAnExon = False
-                            locusBeginPosition = x
-                            pass
-                else:
-                    logging.warning('Nonstandard nucleotide detected at position ' + str(x) + ' : ' + currentChar
-                                    + '.  If this is a wildcard character, you might be ok.')
-
-            # We've reached the end of the loop and we still need to store the last feature.
-            # Should be a 3' UTR, but I can't be sure, people like to put in weird sequences.
-            currentFeature = GeneFeature()
-            currentFeature.sequence = cleanedInputText[locusBeginPosition:len(cleanedInputText)].upper()
-            currentFeature.exon = insideAnExon
-            self.features.append(currentFeature)
+                logging.error('Nonstandard Nucleotide at the beginning of the sequence, not sure how to handle it')
+
+            # Nonstandard characters do not start a new feature, they belong to the feature they are inside.
+            # The positions are only searched for if the cleaning found nonstandard characters.
+            if (firstNonstandardPosition is not None):
+                for nonstandardMatch in nonstandardNucleotidePattern.finditer(cleanedInputText, firstNonstandardPosition):
+                    logging.warning('Nonstandard nucleotide detected at position ' + str(nonstandardMatch.start()) + ' : '
+                        + nonstandardMatch.group() + '.  If this is a wildcard character, you might be ok.')
+
+            for beginPosition, endPosition, isExon in findFeatureBoundaries(cleanedInputText):
+                currentFeature = GeneFeature()
+                currentFeature.sequence = cleanedInputText[beginPosition:endPosition]
+                currentFeature.exon = isExon
+                featureList.append(currentFeature)
+            self.features = featureList
 
             # Annotate the features (name them) and print the results of the read file.
             self.nameAnnotatedFeatures()
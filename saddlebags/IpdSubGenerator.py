@@ -14,9 +14,16 @@
 # along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
 
 from datetime import datetime
+from io import StringIO
+from os import remove, rmdir
+from os.path import join, isfile, isdir
+from zipfile import ZipFile
 
 from saddlebags.HlaSequence import HlaSequence
 from saddlebags.AlleleSubmission import  AlleleSubmission, SubmissionBatch
+from saddlebags.EmblFlatfile import writeSequenceBlock, captureText
+from saddlebags.AlleleSubCommon import showInfoBox, getSaddlebagsDirectory, createOutputFile
+from saddlebags.SaddlebagsConfig import getConfigurationValue
 
 #from saddlebags.AcademicCitation import AcademicCitation
 # TODO: I removed AcademicCitation because I'm pretty sure we don't actually need that in the submission. James and Dom agree this isn't necessary.
@@ -33,30 +40,32 @@ class IpdSubGenerator():
         # I think I need to also store the submission batch because it needs that info too. This is a bit redundant, but oh well.
         #self.sequenceAnnotation = HlaGene()
         self.submission = AlleleSubmission()
-        self.submissionBatch = SubmissionBatch()
+        self.submissionBatch = SubmissionBatch(False)
     
-    # Create the text submission based on the IPD format.
-    def buildIpdSubmission(self):
-        
-        documentBuffer = ''
+    # Write the text submission based on the IPD format to a text stream.
+    def writeIpdSubmission(self, outputStream):
 
         totalLength = self.submission.submittedAllele.totalLength()
-        logging.info('total calculated length = ' + str(totalLength))
+        logging.info('total calculated length = %s', totalLength)
         
         if(totalLength > 0):
 
             # These are the main sections of the IPD-IMGT/HLA submission.
-            documentBuffer += self.printHeader()
-            documentBuffer += self.printCitations()
-            documentBuffer += self.printKeyHeader()
-            documentBuffer += self.printSubmitter()
-            documentBuffer += self.printSource()
-            documentBuffer += self.printMethods()
-            documentBuffer += self.printFeatures()
-            documentBuffer += self.printSequence()
+            # The entry is written to the stream when it is complete, so an exception doesn't leave half of an entry in the file.
+            entryBuffer = StringIO()
+            self.writeHeader(entryBuffer)
+            self.writeCitations(entryBuffer)
+            self.writeKeyHeader(entryBuffer)
+            self.writeSubmitter(entryBuffer)
+            self.writeSource(entryBuffer)
+            self.writeMethods(entryBuffer)
+            self.writeFeatures(entryBuffer)
+            self.writeSequence(entryBuffer)
 
             # Print entry terminator.  The last line of an ENA entry.
-            documentBuffer += ('//\n')
+            entryBuffer.write('//\n')
+
+            outputStream.write(entryBuffer.getvalue())
             
         else:
             # TODO: Remove the messagebox stuff from this class. Put it in the GUI.
@@ -64,16 +73,13 @@ class IpdSubGenerator():
             #messagebox.showinfo('No HLA Sequence Found',
             #    'The HLA sequence is empty.\nPlease fill in an annotated HLA sequence\nbefore generating the submission.' )
             raise Exception('The HLA sequence is empty. Please fill in an annotated HLA sequence before generating the submission.')
-            
-            pass
-        
 
-        return documentBuffer
+    # Create the text submission based on the IPD format.
+    def buildIpdSubmission(self):
+        return captureText(self.writeIpdSubmission)
 
 
-    def printHeader(self):
-        
-        headerText = ''
+    def writeHeader(self, outputStream):
         
         # TODO: just use the ENA identifier, or something else.
         ipdIdentifier = self.submission.ipdSubmissionIdentifier
@@ -84,12 +90,12 @@ class IpdSubGenerator():
         # TODO: I'm removing the IMGT/HLA identifier from the input file, because I think I don't need it.
         # Check my notes, i think I was going to just provide an ENA identifier. IMGT/HLA can give us an "HS" identifier, I shouldn't assign those.
         # It's assigned by IMGT/HLA?
-        headerText += 'ID   ' + str(ipdIdentifier) + '; Sequence Submission; Confidential; ' + str(self.submission.submittedAllele.totalLength()) + ' BP.\n'
-        headerText += 'XX\n'
-        headerText += 'AC   ' + str(ipdIdentifier) + ';\n'
-        headerText += 'XX\n'
-        headerText += 'SV   ' + str(ipdIdentifierWithVersion) + '\n'
-        headerText += 'XX\n'
+        outputStream.write('ID   ' + str(ipdIdentifier) + '; Sequence Submission; Confidential; ' + str(self.submission.submittedAllele.totalLength()) + ' BP.\n')
+        outputStream.write('XX\n')
+        outputStream.write('AC   ' + str(ipdIdentifier) + ';\n')
+        outputStream.write('XX\n')
+        outputStream.write('SV   ' + str(ipdIdentifierWithVersion) + '\n')
+        outputStream.write('XX\n')
 
         # TODO: The DT fields refer to versions of the IMGT/HLA  database.
         # The manual.md on github describes it better, but i think these are DB versions assigned by IMGT/HLA.
@@ -101,41 +107,41 @@ class IpdSubGenerator():
         # TODO: I'm using the local allele name that is assigned by the user.
         # Maybe this allele name should be based on the closest allele.
         # Do I want the allele name, or should I generate a new one based on the closest allele?
-        headerText += 'DE   ' + str(self.submission.localAlleleName) + '\n'
-        headerText += 'XX\n'
-        headerText += 'KW   HLA WEB SUBMISSION;\n'
-        headerText += 'XX\n'
+        outputStream.write('DE   ' + str(self.submission.localAlleleName) + '\n')
+        outputStream.write('XX\n')
+        outputStream.write('KW   HLA WEB SUBMISSION;\n')
+        outputStream.write('XX\n')
         
         # The new allele description is split into multiple lines. I should add a new 'CC' line for each part of the description.
         rawDescription = str(self.submission.closestAlleleWrittenDescription)
         rawDescriptionLineTokens = rawDescription.split('\n')
         for lineToken in rawDescriptionLineTokens:
-            headerText += 'CC   ' + lineToken + '\n'
+            outputStream.write('CC   ' + lineToken + '\n')
             
         #headerText += 'CC   A*03:01:01:01new is identical to A*03:01:01:01 except for position 382 is a A\n'
         #headerText += 'CC   in the new allele. This result in an amino change from W to stopcodon.\n'
         
-        headerText += 'XX\n'
-        headerText += 'OS   Homo sapiens (human);\n'
-        headerText += 'OC   Eukaryota; Metazoa; Chordata; Vertebrata; Mammalia; Eutheria; Primates;\n'
-        headerText += 'OC   Catarrhini; Hominidae; Homo.\n'
-        headerText += 'XX\n'
+        outputStream.write('XX\n')
+        outputStream.write('OS   Homo sapiens (human);\n')
+        outputStream.write('OC   Eukaryota; Metazoa; Chordata; Vertebrata; Mammalia; Eutheria; Primates;\n')
+        outputStream.write('OC   Catarrhini; Hominidae; Homo.\n')
+        outputStream.write('XX\n')
         # TODO: Our submission says GENBANK, but we're using ENA Numbers. This works fine but maybe I should write ENA instead?
-        headerText += 'DR   GENBANK; ' + str(self.submission.enaAccessionIdentifier) + '.\n'
+        outputStream.write('DR   GENBANK; ' + str(self.submission.enaAccessionIdentifier) + '.\n')
 
-        return headerText
+    def printHeader(self):
+        return captureText(self.writeHeader)
 
-    def printCitations(self):
-        citationText = ''
-        citationText += 'XX\n'
+    def writeCitations(self, outputStream):
+        outputStream.write('XX\n')
 
         citationTextList = self.submission.citations
         #
         #str(self.submission.ipd_submission_identifier'))
 
-        citationText += 'RN   [1]\n'
-        citationText += 'RC   Unpublished.\n'
-        citationText += 'XX\n'
+        outputStream.write('RN   [1]\n')
+        outputStream.write('RC   Unpublished.\n')
+        outputStream.write('XX\n')
 
         # TODO: Fix the citation input. The citation input is a free form input String
         # Actually, don't. Based on discussions with james and Dom I can probably assume most submissions have no citations.
@@ -178,51 +184,49 @@ class IpdSubGenerator():
                 raise Exception('Invalid Citation. The Citation information is malformed in the configuration file. Please double check your citation information.')
 
         """
-        return citationText
 
-    def printKeyHeader(self):
-        keyHeaderText = ''
-        keyHeaderText += 'FH   Key            Location/Qualifier\n'
-        keyHeaderText += 'FH\n'
+    def printCitations(self):
+        return captureText(self.writeCitations)
 
-        return keyHeaderText
+    def writeKeyHeader(self, outputStream):
+        outputStream.write('FH   Key            Location/Qualifier\n')
+        outputStream.write('FH\n')
 
+    def printKeyHeader(self):
+        return captureText(self.writeKeyHeader)
 
-    def printSubmitter(self):
-        submitterText = ''
-        
+    def writeSubmitter(self, outputStream):
         # TODO: I don't know any of this data.  Should it be int he form?
         # Maybe I just need the submitter ID, and i can or can not get the rest?
         # I should be able to calculate the indices, at least.
 
-        submitterText += 'FT   submittor      1..' + str(self.submission.submittedAllele.totalLength()) + '\n'
-        submitterText += 'FT                  /ID="' + str(self.submissionBatch.ipdSubmitterId) + '"\n'
-        submitterText += 'FT                  /name="' + str(self.submissionBatch.ipdSubmitterName) + '"\n'
-        submitterText += 'FT                  /alt_contact="' + str(self.submissionBatch.ipdAltContact) + '"\n'
-        submitterText += 'FT                  /email="' + str(self.submissionBatch.ipdSubmitterEmail) + '"\n'
-        
-        return submitterText
+        outputStream.write('FT   submittor      1..' + str(self.submission.submittedAllele.totalLength()) + '\n')
+        outputStream.write('FT                  /ID="' + str(self.submissionBatch.ipdSubmitterId) + '"\n')
+        outputStream.write('FT                  /name="' + str(self.submissionBatch.ipdSubmitterName) + '"\n')
+        outputStream.write('FT                  /alt_contact="' + str(self.submissionBatch.ipdAltContact) + '"\n')
+        outputStream.write('FT                  /email="' + str(self.submissionBatch.ipdSubmitterEmail) + '"\n')
 
-    def printSource(self):
-        sourceText = ''
-        
+    def printSubmitter(self):
+        return captureText(self.writeSubmitter)
+
+    def writeSource(self, outputStream):
         # TODO: Submitting Laboratory Information. Can this be fetched from imgt, or use some sort of lookup
 
-        sourceText += 'FT   source         1..' + str(self.submission.submittedAllele.totalLength()) + '\n'
-        sourceText += 'FT                  /cell_id="' + str(self.submission.cellId) + '"\n'
-        sourceText += 'FT                  /ethnic_origin="' + str(self.submission.ethnicOrigin) + '"\n'
-        sourceText += 'FT                  /sex="' + str(self.submission.sex) + '"\n'
-        sourceText += 'FT                  /consanguineous="' + str(self.submission.consanguineous) + '"\n'
-        sourceText += 'FT                  /homozygous="' + str(self.submission.homozygous) + '"\n'
-        sourceText += 'FT                  /lab_of_origin="' + str(self.submissionBatch.labOfOrigin) + '"\n'
-        sourceText += 'FT                  /lab_contact="' + str(self.submissionBatch.labContact) + '"\n'
+        outputStream.write('FT   source         1..' + str(self.submission.submittedAllele.totalLength()) + '\n')
+        outputStream.write('FT                  /cell_id="' + str(self.submission.cellId) + '"\n')
+        outputStream.write('FT                  /ethnic_origin="' + str(self.submission.ethnicOrigin) + '"\n')
+        outputStream.write('FT                  /sex="' + str(self.submission.sex) + '"\n')
+        outputStream.write('FT                  /consanguineous="' + str(self.submission.consanguineous) + '"\n')
+        outputStream.write('FT                  /homozygous="' + str(self.submission.homozygous) + '"\n')
+        outputStream.write('FT                  /lab_of_origin="' + str(self.submissionBatch.labOfOrigin) + '"\n')
+        outputStream.write('FT                  /lab_contact="' + str(self.submissionBatch.labContact) + '"\n')
         
         # TODO: No Material Available.  What if Material is available?
         # I think I need to add this to the form still.
         # Same story with "cell_bank"
         
-        sourceText += 'FT                  /material_available="' + str(self.submission.materialAvailability) + '"\n'
-        sourceText += 'FT                  /cell_bank="' + str(self.submission.cellBank) + '"\n'
+        outputStream.write('FT                  /material_available="' + str(self.submission.materialAvailability) + '"\n')
+        outputStream.write('FT                  /cell_bank="' + str(self.submission.cellBank) + '"\n')
         
         # TODO: James suggested that I only allow valid fully-sequenced alleles.
         # Should I validate this, or should I leave that work to ipd?
@@ -243,7 +247,7 @@ class IpdSubGenerator():
 
                 #gene, nomenclatureFields = hlaAllele.split('*')
                 #methodsText += 'FT                  /primer_' + str(index + 1) + '="' + hlaAllele + '"\n'
-                sourceText += 'FT                  /' + str(loci) + '*="' + typedHlaAlleles[loci] + '"\n'
+                outputStream.write('FT                  /' + str(loci) + '*="' + typedHlaAlleles[loci] + '"\n')
 
         else:
             # TODO: What do if there are no other HLA alleles?
@@ -253,23 +257,22 @@ class IpdSubGenerator():
         #sourceText += 'FT                  /HLA-C*="07"\n'
         #sourceText += 'FT                  /HLA-B*="07"\n'
         #sourceText += 'FT                  /HLA-DRB1*="15:01,-"\n'
-        
-        return sourceText
-    
-    def printMethods(self):
-        methodsText = ''
-        
+
+    def printSource(self):
+        return captureText(self.writeSource)
+
+    def writeMethods(self, outputStream):
         # TODO: Get primer info from the form.  Make sure this all is correct        
         
-        methodsText += 'FT   method         1..' + str(self.submission.submittedAllele.totalLength()) + '\n'
+        outputStream.write('FT   method         1..' + str(self.submission.submittedAllele.totalLength()) + '\n')
         
         # TODO: What are the options for sequencing methodology?
         # I can provide an open-text field.        
         
-        methodsText += 'FT                  /primary_sequencing="' + str(self.submission.primarySequencingMethodology) + '"\n'
-        methodsText += 'FT                  /secondary_sequencing="' + str(self.submission.secondarySequencingMethodology) + '"\n'
-        methodsText += 'FT                  /type_of_primer="' + str(self.submission.primerType) + '"\n'
-        methodsText += 'FT                  /sequenced_in_isolation="' + str(self.submission.sequencedInIsolation) + '"\n'
+        outputStream.write('FT                  /primary_sequencing="' + str(self.submission.primarySequencingMethodology) + '"\n')
+        outputStream.write('FT                  /secondary_sequencing="' + str(self.submission.secondarySequencingMethodology) + '"\n')
+        outputStream.write('FT                  /type_of_primer="' + str(self.submission.primerType) + '"\n')
+        outputStream.write('FT                  /sequenced_in_isolation="' + str(self.submission.sequencedInIsolation) + '"\n')
         
         # TODO Add these primers dynamically
         # A primer has these pieces of information
@@ -290,30 +293,29 @@ class IpdSubGenerator():
 
         if primerList is not None:
             for index, primer in enumerate(primerList):
-                methodsText += 'FT                  /primer_' + str(index + 1) + '="' + primer + '"\n'
+                outputStream.write('FT                  /primer_' + str(index + 1) + '="' + primer + '"\n')
         else:
             # TODO: What do I do if we have not provided any primers? Im not sure right now.
             pass
 
 
-        methodsText += 'FT                  /no_of_reactions="' + str(self.submission.numOfReactions) + '"\n'
-        methodsText += 'FT                  /sequencing_direction="' + str(self.submission.sequencingDirection) + '"\n'
+        outputStream.write('FT                  /no_of_reactions="' + str(self.submission.numOfReactions) + '"\n')
+        outputStream.write('FT                  /sequencing_direction="' + str(self.submission.sequencingDirection) + '"\n')
         
         # TODO: There's something up with these primers.
         # Why are they in the comments? Did we run out of space?
         
         # Don't put primers in comments. Make this a loop. Multiline.
-        methodsText += 'FT                  /method_comments="' + str(self.submission.methodComments) + '"\n'
+        outputStream.write('FT                  /method_comments="' + str(self.submission.methodComments) + '"\n')
 
         # TODO the alignment seems to be rejected by the IMGT/HLA Validator. For now I will not include this, because this information is included in the header.
         # I can set this when the GFE/ACT was performed.
         #methodsText += 'FT                  /alignment="' + str(self.submission.closest_allele_written_description')) + '"\n'
-        
-        return methodsText
 
-    def printFeatures(self):
-        featureText = ''
-        
+    def printMethods(self):
+        return captureText(self.writeMethods)
+
+    def writeFeatures(self, outputStream):
         # TODO: I might double check with James about the backslashes before "number".
         # Seems inconsistent.
         
@@ -322,15 +324,15 @@ class IpdSubGenerator():
         #featureText += 'FT                  2753..2785,2928..2975,3145..3149)\n'
         # Coding sequence is just the exons.  Print out each exon.
         # Ignoring line-breaks for now, this might create a really wide line. Ok?
-        featureText += ('FT   CDS            join(') 
+        outputStream.write('FT   CDS            join(')
         for x in range(0, len(self.submission.submittedAllele.features)):
             geneLocus = self.submission.submittedAllele.features[x]
             if (geneLocus.exon):
-                featureText += str(geneLocus.beginIndex) + '..' + str(geneLocus.endIndex)
+                outputStream.write(str(geneLocus.beginIndex) + '..' + str(geneLocus.endIndex))
                 if not x == len(self.submission.submittedAllele.features) - 2:
-                    featureText += ','
+                    outputStream.write(',')
                 else:
-                    featureText += ')\n'
+                    outputStream.write(')\n')
                     
                     
         exonIndex = 1
@@ -348,44 +350,44 @@ class IpdSubGenerator():
 
             # 3' UTR
             if(currentFeature.name == '3UT'):
-                featureText += ('FT   3\' UTR         ' + str(currentFeature.beginIndex) + '..' + str(currentFeature.endIndex) + '\n')
+                outputStream.write('FT   3\' UTR         ' + str(currentFeature.beginIndex) + '..' + str(currentFeature.endIndex) + '\n')
                 geneHas3UTR = True  
                 
             # 5' UTR
             elif(currentFeature.name == '5UT'):
-                featureText += ('FT   5\' UTR         ' + str(currentFeature.beginIndex) + '..' + str(currentFeature.endIndex) + '\n')
+                outputStream.write('FT   5\' UTR         ' + str(currentFeature.beginIndex) + '..' + str(currentFeature.endIndex) + '\n')
                 geneHas5UTR = True   
             
             # Exon
             elif(currentFeature.exon):
-                featureText += ('FT   Exon           ' + str(currentFeature.beginIndex) 
+                outputStream.write('FT   Exon           ' + str(currentFeature.beginIndex) 
                     + '..' + str(currentFeature.endIndex) + '\n')
-                featureText += ('FT                  \\number="' + str(exonIndex) + '"\n') 
+                outputStream.write('FT                  \\number="' + str(exonIndex) + '"\n')
                 exonIndex += 1
             
             # Intron
             else:
-                featureText += ('FT   Intron         ' + str(currentFeature.beginIndex) 
-                    + '..' + str(currentFeature.endIndex) + '\n')   
-                featureText += ('FT                  \\number="' + str(intronIndex) + '"\n')
+                outputStream.write('FT   Intron         ' + str(currentFeature.beginIndex) 
+                    + '..' + str(currentFeature.endIndex) + '\n')
+                outputStream.write('FT                  \\number="' + str(intronIndex) + '"\n')
                 intronIndex += 1
 
         # Do a quick sanity check.  If we are missing either UTR I should warn the user.
         # But move on with your life, it is not necessary to become upset.
         if (not geneHas3UTR and not geneHas5UTR):
-            messagebox.showinfo('Missing UTRs', 
+            showInfoBox('Missing UTRs', 
                 'This sequence has no 5\' or 3\' UTR.\n\n' + 
                 'Use lowercase nucleotides at the\n' + 
                 'beginning and end of your DNA\n' +
                 'sequence to specify the 5\' and 3\' UTRs.' )
         elif (not geneHas5UTR):
-            messagebox.showinfo('Missing 5\' UTR', 
+            showInfoBox('Missing 5\' UTR', 
                 'This sequence has no 5\' UTR.\n\n' + 
                 'Use lowercase nucleotides at the\n' + 
                 'beginning and end of your DNA\n' +
                 'sequence to specify the 5\' and 3\' UTRs.' )            
         elif (not geneHas3UTR):
-            messagebox.showinfo('Missing 3\' UTR', 
+            showInfoBox('Missing 3\' UTR', 
                 'This sequence has no 3\' UTR.\n\n' + 
                 'Use lowercase nucleotides at the\n' + 
                 'beginning and end of your DNA\n' +
@@ -394,57 +396,14 @@ class IpdSubGenerator():
             logging.info('The UTRs look fine.')
             pass
 
+    def printFeatures(self):
+        return captureText(self.writeFeatures)
 
+    def writeSequence(self, outputStream):
+        writeSequenceBlock(outputStream, self.submission.submittedAllele.getAnnotatedSequence(includeLineBreaks=False).upper())
 
-        return featureText
-    
     def printSequence(self):
-        sequenceText = ''
-        
-        completeSequence = self.submission.submittedAllele.getAnnotatedSequence(includeLineBreaks=False).upper()
-                
-        cCount = completeSequence.count('C')
-        gCount = completeSequence.count('G')
-        tCount = completeSequence.count('T')
-        aCount = completeSequence.count('A')
-        otherCount = self.submission.submittedAllele.totalLength() - (cCount + gCount + tCount + aCount)
-
-        sequenceText += ('SQ   Sequence ' + str(self.submission.submittedAllele.totalLength()) + ' BP; '
-                         + str(aCount) + ' A; ' + str(cCount) + ' C; '
-                         + str(gCount) + ' G; ' + str(tCount) + ' T; '
-                         + str(otherCount) + ' other;\n')
-
-        # Here's some logic to print the sequence information in groups of 10.
-        # This format is specified in the User manual specified by ENA.
-        currentSeqIndex = 0
-
-        while (currentSeqIndex < self.submission.submittedAllele.totalLength()):
-            # The character code for a sequence region is two blank spaces,
-            # followed by three blank spaces, for a total of 5 blanks.
-            sequenceText += '     '
-            sequenceRow = self.submission.submittedAllele.getAnnotatedSequence(includeLineBreaks=False).upper()[currentSeqIndex: currentSeqIndex + 60]
-
-            # A sequenceChunk is 10 nucleotides in this context.
-            # Format specifies up to six "chunks" per line.
-            for i in range(0,6):
-                sequenceChunk = sequenceRow[i*10 : (i+1)*10]
-                sequenceText += sequenceChunk + ' '
-
-            # If line is complete (=60 bp), we can print the nucleotide index and move on to the next row.
-            if(len(sequenceRow) == 60):
-                sequenceText += str(currentSeqIndex + 60) + '\n'
-            # but if line is not complete (this is more likely, and more complicated.)
-            else:
-                # Fill with spaces to align the nucleotide indices at the end of the sequence.
-                numberSpaces = 60-len(sequenceRow)
-                for n in range (0, numberSpaces):
-                    sequenceText += ' '
-                sequenceText += (str(len(sequenceRow) + currentSeqIndex) + '\n')
-            
-            # The next row of the sequence
-            currentSeqIndex += 60         
-
-        return sequenceText
+        return captureText(self.writeSequence)
 
 
 # TODO: I suppose this method should be in an IPD SubGenerator file.
@@ -464,27 +423,30 @@ def createIPDZipFile(zipFileName):
 
     submissionFileList = []
 
+    # The submissions can be generated in parallel worker processes, this is configured in the config file.
+    # With a single worker each submission is written directly into its file.
+    # SubmissionBatchGenerator imports this module, so it is imported here.
+    from saddlebags.SubmissionBatchGenerator import writeSubmissionBatch
+    workerCount = int(getConfigurationValue('generation_worker_count') or 1)
+    chunkSize = int(getConfigurationValue('generation_chunk_size') or 0)
+
+    def openSubmissionFile(submissionObject):
+        submissionLocalFileName = str(submissionObject.localAlleleName) + '_submission.txt'
+        submissionFileList.append(submissionLocalFileName)
+        return createOutputFile(join(workingDirectory, submissionLocalFileName))
+
     submissioncount =0
-    for submissionObject in submissionBatch.submissionBatch:
+    for submissionObject, submissionFileObject, errorMessage in writeSubmissionBatch(submissionBatch, 'IPD', openSubmissionFile, workerCount, chunkSize):
 
         print ('Generating Submission #' + str(submissioncount))
         submissioncount += 1
 
-        # Create a submission for each entry in the batch.
-        allGen = IpdSubGenerator()
-        allGen.submission = submissionObject
-        allGen.submissionBatch = submissionBatch
-        ipdSubmission = allGen.buildIpdSubmission()
-
-        submissionLocalFileName = str(submissionObject.localAlleleName) + '_submission.txt'
-        submissionFileName = join(workingDirectory, submissionLocalFileName)
-        submissionFileList.append(submissionLocalFileName)
-
-        submissionFileObject = createOutputFile(submissionFileName)
-        submissionFileObject.write(ipdSubmission)
         submissionFileObject.close()
 
-        print ('I just saved this file: ' + submissionFileName)
+        if (errorMessage is not None):
+            raise Exception('Could not generate a submission for allele ' + str(submissionObject.localAlleleName) + ':' + str(errorMessage))
+
+        print ('I just saved this file: ' + join(workingDirectory, submissionFileList[-1]))
 
     # create a zip file from the list of files.
     zipFileName = join(zipDirectory,zipFileName)
@@ -518,7 +480,7 @@ def createIPDZipFile(zipFileName):
 
     except Exception as error:
         logging.error('ERROR when removing working directory and submission files:' + str(error))
-        raise()
+        raise
 
 
 
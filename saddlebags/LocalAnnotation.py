@@ -0,0 +1,195 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import join, isfile
+from sys import exc_info
+
+from Bio.Align import PairwiseAligner
+
+from saddlebags.AlleleSubCommon import getSaddlebagsDirectory
+from saddlebags.BandedAlignment import BandedAligner
+from saddlebags.HlaSequence import cleanSequence
+from saddlebags.HlaSequenceException import HlaSequenceException
+from saddlebags.SequenceAnnotation import readReferenceAlleles
+from saddlebags.ReferenceDatabase import getReferenceDatabase
+from saddlebags.ReferenceIndex import ReferenceIndex, buildReferenceIndex, readReferenceIndex, writeReferenceIndex
+
+import logging
+
+# Annotate HLA sequences without the ACT service, using the IMGT/HLA reference alleles in the local SeqAnn database.
+# The sequence is aligned to the closest reference allele of its locus, and the exon/intron/UTR boundaries of the
+# reference are projected onto the sequence. The result is an annotated sequence, exons uppercase and introns/UTRs lowercase,
+# which is read into features the same way as an annotated sequence from the user.
+
+# The annotators are kept, so the reference alleles are only read from the database once for each locus.
+# They are stored with the ReferenceDatabase they were read from, a new ReferenceDatabase means the alleles were loaded again.
+localAnnotators = {}
+
+# The aligners that can be used for the alignment that is projected. PairwiseAligner is the default, the banded aligner
+# is only used if local_aligner is BandedAligner in the config. The backend never changes the result:
+# a banded alignment with a lower score than the PairwiseAligner is replaced by the PairwiseAligner alignment.
+# The candidates are always scored with the PairwiseAligner.
+alignerBackends = {'PairwiseAligner': lambda: createAligner(), 'BandedAligner': lambda: CheckedBandedAligner()}
+defaultAlignerBackend = 'PairwiseAligner'
+
+def createAligner():
+    # Global alignment, but the overhanging ends of either sequence are free. A submitted sequence can be longer or shorter than the reference.
+    aligner = PairwiseAligner()
+    aligner.mode = 'global'
+    aligner.match_score = 2
+    aligner.mismatch_score = -1
+    aligner.open_gap_score = -3
+    aligner.extend_gap_score = -1
+    aligner.target_end_gap_score = 0
+    aligner.query_end_gap_score = 0
+    return aligner
+
+def projectAnnotation(annotatedReference, querySequence, aligner=None):
+    # Returns the query sequence, with the case (exon or not) of the reference nucleotide it is aligned to.
+    # Nucleotides inserted in the query belong to the feature before them. Nucleotides before and after the reference are UTR.
+    if (aligner is None):
+        aligner = createAligner()
+    querySequence = querySequence.upper()
+    referenceAlignment = aligner.align(annotatedReference.upper(), querySequence)[0]
+
+    exonFlags = [None] * len(querySequence)
+    for (referenceBegin, referenceEnd), (queryBegin, queryEnd) in zip(*referenceAlignment.aligned):
+        for alignedIndex in range(0, queryEnd - queryBegin):
+            exonFlags[queryBegin + alignedIndex] = annotatedReference[referenceBegin + alignedIndex].isupper()
+
+    # Fill in the insertions. The ends of the query are UTR.
+    lastAlignedIndex = max([queryIndex for queryIndex, isExon in enumerate(exonFlags) if isExon is not None], default=-1)
+    currentFlag = False
+    annotatedQuery = []
+    for queryIndex, isExon in enumerate(exonFlags):
+        if (queryIndex > lastAlignedIndex):
+            currentFlag = False
+        elif (isExon is not None):
+            currentFlag = isExon
+        annotatedQuery.append(querySequence[queryIndex] if currentFlag else querySequence[queryIndex].lower())
+    return ''.join(annotatedQuery)
+
+class CheckedBandedAligner():
+    # The banded alignment, checked against the PairwiseAligner score. The band is placed from the shared minimizers,
+    # a sequence with long replaced stretches can have its best alignment outside of the band. Scoring is much faster than
+    # aligning with the PairwiseAligner, so the check costs less than the banded alignment saves.
+
+    def __init__(self):
+        self.bandedAligner = BandedAligner()
+        self.pairwiseAligner = createAligner()
+
+    def align(self, referenceSequence, querySequence):
+        bandedAlignments = self.bandedAligner.align(referenceSequence, querySequence)
+        pairwiseScore = self.pairwiseAligner.score(referenceSequence, querySequence)
+        if (bandedAlignments[0].score == pairwiseScore):
+            return bandedAlignments
+        logging.debug('The banded alignment score %s is lower than %s, using the PairwiseAligner', bandedAlignments[0].score, pairwiseScore)
+        return self.pairwiseAligner.align(referenceSequence, querySequence)
+
+    def score(self, referenceSequence, querySequence):
+        return self.pairwiseAligner.score(referenceSequence, querySequence)
+
+def configureLocalAligner(alignerBackend):
+    # Called with the local_aligner value of the config.
+    global defaultAlignerBackend
+    if (alignerBackend not in alignerBackends):
+        raise HlaSequenceException('Unknown local aligner ' + str(alignerBackend) + ', expected one of ' + ', '.join(alignerBackends))
+    defaultAlignerBackend = alignerBackend
+
+def createLocalAligner(alignerBackend=None):
+    # A new aligner of the configured backend.
+    return alignerBackends[defaultAlignerBackend if alignerBackend is None else alignerBackend]()
+
+class LocalAnnotator():
+    # Annotates sequences of one locus. referenceAlleles is a list of tuples (alleleName, annotatedSequence).
+    # The referenceIndex is the minimizer index of the same alleles, in the same order. It is built in memory if it is not given.
+
+    def __init__(self, referenceAlleles, referenceIndex=None, candidateCount=3):
+        self.referenceAlleles = referenceAlleles
+        if (referenceIndex is None):
+            referenceIndex = ReferenceIndex(buildReferenceIndex(referenceAlleles), [alleleName for alleleName, annotatedSequence in referenceAlleles])
+        self.referenceIndex = referenceIndex
+        self.candidateCount = candidateCount
+        self.aligner = createLocalAligner()
+        self.scoreAligner = createAligner()
+
+    def findCandidateAlleles(self, querySequence):
+        # The references that share the most minimizers with the query. Returns a list of indices into referenceAlleles.
+        return [alleleNumber for alleleNumber, sharedMinimizerCount in self.referenceIndex.findCandidateAlleles(querySequence, self.candidateCount)]
+
+    def findClosestAllele(self, querySequence):
+        # Returns the index of the reference allele with the best alignment score, among the candidates.
+        closestIndex = None
+        closestScore = None
+        for referenceIndex in self.findCandidateAlleles(querySequence):
+            alignmentScore = self.scoreAligner.score(self.referenceAlleles[referenceIndex][1].upper(), querySequence)
+            if (closestScore is None or alignmentScore > closestScore):
+                closestIndex = referenceIndex
+                closestScore = alignmentScore
+        return closestIndex
+
+    def annotate(self, querySequence):
+        # Returns a tuple (closestAlleleName, annotatedSequence).
+        querySequence = cleanSequence(querySequence).upper()
+        if (len(querySequence) < 1 or len(self.referenceAlleles) < 1):
+            raise HlaSequenceException('Cannot annotate the sequence, the sequence or the list of reference alleles is empty.')
+        closestIndex = self.findClosestAllele(querySequence)
+        if (closestIndex is None):
+            raise HlaSequenceException('Cannot annotate the sequence, it is not similar to any reference allele.')
+        alleleName, annotatedReference = self.referenceAlleles[closestIndex]
+        logging.info('The closest reference allele is %s', alleleName)
+        return alleleName, projectAnnotation(annotatedReference, querySequence, self.aligner)
+
+def getLocalAnnotator(locus, databaseFullPath=None):
+    if (databaseFullPath is None):
+        databaseFullPath = join(getSaddlebagsDirectory(), 'SeqAnnDatabase.db')
+    # The loci are stored without the HLA- prefix.
+    locus = str(locus).replace('HLA-', '')
+    if (not isfile(databaseFullPath)):
+        raise HlaSequenceException('The local annotation database does not exist:' + str(databaseFullPath))
+
+    referenceDatabase = getReferenceDatabase(databaseFullPath)
+    if ((databaseFullPath, locus) not in localAnnotators or localAnnotators[(databaseFullPath, locus)][0] is not referenceDatabase):
+        referenceAlleles = list(readReferenceAlleles(databaseFullPath, locus))
+        logging.info('Loaded ' + str(len(referenceAlleles)) + ' reference alleles for locus ' + locus)
+        # The index is written when the database is loaded. If it is missing or from different data, it is written now.
+        referenceIndex = readReferenceIndex(databaseFullPath, locus)
+        if (referenceIndex is None or referenceIndex.alleleNames != [alleleName for alleleName, annotatedSequence in referenceAlleles]):
+            referenceIndex = writeReferenceIndex(referenceAlleles, databaseFullPath, locus)
+        localAnnotators[(databaseFullPath, locus)] = (referenceDatabase, LocalAnnotator(referenceAlleles, referenceIndex))
+    return localAnnotators[(databaseFullPath, locus)][1]
+
+def annotateSequenceLocally(hlaSequence, locus, databaseFullPath=None, localAnnotator=None):
+    # Annotate an HlaSequence using the local database instead of the ACT service.
+    # The features are the same as identifyFeaturesFromJson would find. Returns the name of the closest reference allele.
+    if (localAnnotator is None):
+        localAnnotator = getLocalAnnotator(locus, databaseFullPath)
+    closestAlleleName, annotatedSequence = localAnnotator.annotate(hlaSequence.rawSequence)
+    hlaSequence.rawSequence = annotatedSequence
+    hlaSequence.identifyFeaturesFromFormattedSequence()
+    return closestAlleleName
+
+def annotateSequencesLocally(hlaSequences, locus, databaseFullPath=None):
+    # Annotate a list of HlaSequences of one locus. Returns a list with an error message for each sequence, None if the sequence was annotated.
+    errorMessages = []
+    for sequenceIndex, hlaSequence in enumerate(hlaSequences):
+        try:
+            annotateSequenceLocally(hlaSequence, locus, databaseFullPath)
+            errorMessages.append(None)
+        except Exception:
+            logging.error('Could not annotate sequence #' + str(sequenceIndex + 1) + ':' + str(exc_info()[1]))
+            hlaSequence.features = []
+            errorMessages.append(str(exc_info()[1]))
+    return errorMessages
@@ -17,16 +17,27 @@ from os.path import join
 from saddlebags.AlleleSubCommon import getSaddlebagsDirectory
 import logging
 
-def initializeLog():
+# Sequences, JSON responses and flatfiles are several KB each. They are only written to the log if log_payloads is 1 in the config,
+# the log of a large batch stays readable and the payload text is not built when it is not written.
+# This is assigned from the config file by configurePayloadLogging, Logging cannot read the configuration directly.
+logPayloads = False
+
+def configurePayloadLogging(enabled):
+    global logPayloads
+    logPayloads = enabled
+
+def isPayloadLogged(logLevel=logging.DEBUG):
+    # Check this before building the text of a payload log message.
+    return logPayloads and logging.getLogger().isEnabledFor(logLevel)
+
+def initializeLog(logLevelText=None):
     logFileLocation = join(getSaddlebagsDirectory(),'Saddlebags.Log.txt')
 
-    # If there is no "globals" yet, then I haven't loaded a config yet, lets default to 'DEBUG' level.
-    if (not ("globalVariables" in globals()) or  getConfigurationValue('logging') is None):
+    # If I haven't loaded a config yet, lets default to 'DEBUG' level. The config passes in the 'logging' value.
+    if (logLevelText is None):
         logLevelText = 'DEBUG'
-    else:
-        logLevelText = getConfigurationValue('logging')
 
-    logLevel = getattr(logging,logLevelText.upper())
+    logLevel = getattr(logging, str(logLevelText).upper(), logging.DEBUG)
 
     logFormatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
     rootLogger = logging.getLogger()
@@ -0,0 +1,196 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+from os import getpid, stat
+from os.path import abspath, isfile
+from threading import Lock
+from time import monotonic
+from urllib.request import pathname2url
+
+import sqlite3
+
+from saddlebags.HlaSequenceException import HlaSequenceException
+
+import logging
+
+# Read-only queries of the IMGT/HLA reference alleles that were loaded by loadHLADataIntoSqlite.
+# A file is never changed while it is being read: a new release is built in a temporary file, which replaces the database (see SequenceAnnotation).
+# So the connections are opened with immutable=1, SQLite then does no locking at all, and the file is memory-mapped.
+# Threads take a connection from a small pool and give it back. Each query uses the same SQL text every time, sqlite keeps the prepared statements of each connection.
+# The results of the lookups are kept in LRU caches. The database can be replaced by another process, the lookups check the inode and
+# modification time of the file, and the connections and caches of the old file are dropped when it changed.
+
+# 256 MB of the database file is memory-mapped.
+mmapSize = 268435456
+
+# How often, in seconds, the lookups check if the database file was replaced.
+fileCheckInterval = 1.0
+
+alleleQuery = ('SELECT allele_name, locus, accession, sequence, annotated_sequence, exon_sequence FROM reference_allele WHERE allele_name = ?')
+locusAllelesQuery = ('SELECT allele_name, annotated_sequence FROM reference_allele '
+    + 'WHERE locus = ? AND annotated_sequence IS NOT NULL ORDER BY allele_id')
+locusAlleleNamesQuery = ('SELECT allele_name FROM reference_allele WHERE locus = ? ORDER BY allele_id')
+featureCoordinatesQuery = ('SELECT reference_feature.feature_name, reference_feature.begin_index, reference_feature.end_index, reference_feature.exon '
+    + 'FROM reference_allele JOIN reference_feature ON reference_feature.allele_id = reference_allele.allele_id '
+    + 'WHERE reference_allele.allele_name = ? ORDER BY reference_feature.begin_index')
+exonSequenceQuery = ('SELECT exon_sequence FROM reference_allele WHERE allele_name = ?')
+
+sharedReferenceDatabases = {}
+sharedReferenceDatabasesLock = Lock()
+
+class ReferenceDatabase():
+
+    def __init__(self, databaseFullPath, maximumIdleConnections=4, cacheSize=4096):
+        self.databaseFullPath = abspath(databaseFullPath)
+        self.maximumIdleConnections = maximumIdleConnections
+        self.poolLock = Lock()
+        self.idleConnections = []
+        self.processId = getpid()
+        self.fileSignature = self.readFileSignature()
+        self.lastFileCheck = monotonic()
+
+        # Each lookup has its own cache, a large locus list does not push the single alleles out.
+        self.cachedLookups = []
+        self.getAllele = self.createCachedLookup(self.queryAllele, cacheSize)
+        self.getFeatureCoordinates = self.createCachedLookup(self.queryFeatureCoordinates, cacheSize)
+        self.getExonSequence = self.createCachedLookup(self.queryExonSequence, cacheSize)
+        self.getLocusAlleles = self.createCachedLookup(self.queryLocusAlleles, 32)
+        self.getLocusAlleleNames = self.createCachedLookup(self.queryLocusAlleleNames, 32)
+
+    def createCachedLookup(self, queryMethod, cacheSize):
+        cachedLookup = lru_cache(maxsize=cacheSize)(queryMethod)
+        self.cachedLookups.append(cachedLookup)
+
+        def checkedLookup(*lookupArguments):
+            self.checkDatabaseFile()
+            return cachedLookup(*lookupArguments)
+        return checkedLookup
+
+    def readFileSignature(self):
+        # A new release has a new inode (os.replace), an in-place write changes the modification time or the size.
+        try:
+            fileStat = stat(self.databaseFullPath)
+        except OSError:
+            return None
+        return (fileStat.st_ino, fileStat.st_mtime_ns, fileStat.st_size)
+
+    def checkDatabaseFile(self):
+        # Drop the connections and cached lookups if the file was replaced since it was opened, at most once per fileCheckInterval.
+        currentTime = monotonic()
+        if (currentTime - self.lastFileCheck < fileCheckInterval):
+            return
+        self.lastFileCheck = currentTime
+        fileSignature = self.readFileSignature()
+        with self.poolLock:
+            if (fileSignature == self.fileSignature):
+                return
+            self.fileSignature = fileSignature
+            idleConnections = self.idleConnections
+            self.idleConnections = []
+        logging.info('The reference database %s has changed, reopening it', self.databaseFullPath)
+        for connectionSignature, databaseConnection in idleConnections:
+            databaseConnection.close()
+        self.clearCache()
+
+    def openConnection(self):
+        if (not isfile(self.databaseFullPath)):
+            raise HlaSequenceException('The reference database does not exist:' + str(self.databaseFullPath))
+        databaseConnection = sqlite3.connect('file:' + pathname2url(self.databaseFullPath) + '?mode=ro&immutable=1', uri=True
+            , check_same_thread=False, cached_statements=32)
+        databaseConnection.execute('PRAGMA mmap_size=' + str(mmapSize))
+        databaseConnection.execute('PRAGMA query_only=1')
+        return databaseConnection
+
+    def acquireConnection(self):
+        # Returns a tuple (fileSignature, databaseConnection), the signature of the file when the connection was opened.
+        with self.poolLock:
+            # Connections can't be used in a different process.
+            if (self.processId != getpid()):
+                self.idleConnections = []
+                self.processId = getpid()
+            if (len(self.idleConnections) > 0):
+                return self.idleConnections.pop()
+            fileSignature = self.fileSignature
+        return fileSignature, self.openConnection()
+
+    def releaseConnection(self, fileSignature, databaseConnection):
+        # A connection to a file that was replaced meanwhile is not kept.
+        with self.poolLock:
+            if (self.processId == getpid() and fileSignature == self.fileSignature and len(self.idleConnections) < self.maximumIdleConnections):
+                self.idleConnections.append((fileSignature, databaseConnection))
+                return
+        databaseConnection.close()
+
+    def fetchAll(self, sqlQuery, queryParameters):
+        fileSignature, databaseConnection = self.acquireConnection()
+        try:
+            return databaseConnection.execute(sqlQuery, queryParameters).fetchall()
+        finally:
+            self.releaseConnection(fileSignature, databaseConnection)
+
+    def queryAllele(self, alleleName):
+        # Returns a tuple (alleleName, locus, accession, sequence, annotatedSequence, exonSequence), or None if the allele is not in the database.
+        alleleRows = self.fetchAll(alleleQuery, (alleleName,))
+        return alleleRows[0] if len(alleleRows) > 0 else None
+
+    def queryLocusAlleles(self, locus):
+        # Returns a tuple of (alleleName, annotatedSequence) for the genomic reference alleles of a locus, in the order they were loaded.
+        return tuple(self.fetchAll(locusAllelesQuery, (str(locus).replace('HLA-', ''),)))
+
+    def queryLocusAlleleNames(self, locus):
+        # Every allele of a locus, including the alleles that only have a cDNA sequence.
+        return tuple(alleleName for alleleName, in self.fetchAll(locusAlleleNamesQuery, (str(locus).replace('HLA-', ''),)))
+
+    def queryFeatureCoordinates(self, alleleName):
+        # Returns a tuple of (featureName, beginIndex, endIndex, exon) for a reference allele, 1-based like HlaSequence features.
+        # A cDNA allele only has exons. An empty tuple if the allele is not in the database.
+        return tuple((featureName, beginIndex, endIndex, bool(isExon)) for featureName, beginIndex, endIndex, isExon
+            in self.fetchAll(featureCoordinatesQuery, (alleleName,)))
+
+    def queryExonSequence(self, alleleName):
+        # The exons of a reference allele joined together, or None if the allele is not in the database.
+        alleleRows = self.fetchAll(exonSequenceQuery, (alleleName,))
+        return alleleRows[0][0] if len(alleleRows) > 0 else None
+
+    def clearCache(self):
+        for cachedLookup in self.cachedLookups:
+            cachedLookup.cache_clear()
+
+    def close(self):
+        with self.poolLock:
+            idleConnections = self.idleConnections
+            self.idleConnections = []
+        for connectionSignature, databaseConnection in idleConnections:
+            databaseConnection.close()
+        self.clearCache()
+
+def getReferenceDatabase(databaseFullPath):
+    # The ReferenceDatabase that is shared by every thread in this process, for one database file.
+    databaseFullPath = abspath(databaseFullPath)
+    with sharedReferenceDatabasesLock:
+        if (databaseFullPath not in sharedReferenceDatabases):
+            sharedReferenceDatabases[databaseFullPath] = ReferenceDatabase(databaseFullPath)
+        return sharedReferenceDatabases[databaseFullPath]
+
+def closeReferenceDatabase(databaseFullPath):
+    # Called when the database is replaced in this process, the connections to the old file are closed and the caches are cleared.
+    # The other processes notice the new file in checkDatabaseFile.
+    databaseFullPath = abspath(databaseFullPath)
+    with sharedReferenceDatabasesLock:
+        referenceDatabase = sharedReferenceDatabases.pop(databaseFullPath, None)
+    if (referenceDatabase is not None):
+        logging.debug('Closing the reference database ' + databaseFullPath)
+        referenceDatabase.close()
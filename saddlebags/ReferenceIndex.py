@@ -0,0 +1,165 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from os import replace
+from os.path import join, dirname, isfile
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+import logging
+
+# A minimizer index of the reference alleles of one locus, to find the closest reference alleles of a sequence quickly.
+# Every k-mer of a sequence is hashed, and in each window of w consecutive k-mers the smallest hash is the minimizer.
+# Similar sequences share most of their minimizers. The index is a sorted array of (minimizer, allele) pairs,
+# saved as a .npy file next to the SeqAnn database. It is memory-mapped, so opening the index does not read the whole file.
+# The allele names are in a text file beside it, one per line, in the order of the allele numbers in the array.
+
+kmerLength = 15
+windowLength = 10
+
+indexRecordType = numpy.dtype([('minimizer', numpy.uint32), ('allele', numpy.uint32)])
+
+# A-C-G-T are 0-3, anything else is not part of a k-mer.
+nucleotideCodes = numpy.full(256, 255, dtype=numpy.uint8)
+for nucleotideCode, nucleotide in enumerate('ACGT'):
+    nucleotideCodes[ord(nucleotide)] = nucleotideCode
+    nucleotideCodes[ord(nucleotide.lower())] = nucleotideCode
+
+# Two bits for each nucleotide, a 15-mer fits in 30 bits. Windows without a valid k-mer get a value above that.
+kmerMask = numpy.uint32((1 << (2 * kmerLength)) - 1)
+noMinimizer = numpy.uint32(0xFFFFFFFF)
+
+# Number of reference alleles that are hashed together when the index is built.
+indexChunkSize = 500
+
+# Sequences are joined with this between them. It is longer than a window, so no window has k-mers of two sequences.
+sequenceSeparator = 'N' * (kmerLength + windowLength)
+
+def getReferenceIndexFileNames(databaseFullPath, locus):
+    # Returns the names of the index file and the allele name file, for one locus.
+    indexFileName = join(dirname(databaseFullPath), 'SeqAnnIndex.' + str(locus).replace('HLA-', '') + '.npy')
+    return indexFileName, indexFileName[0:-4] + '.names.txt'
+
+def findWindowMinimums(sequence):
+    # Returns the minimizer hash of every window of the sequence, by window position.
+    # Windows without a valid k-mer (only N's for example) are noMinimizer.
+    sequenceCodes = nucleotideCodes[numpy.frombuffer(str(sequence).encode('ascii', 'replace'), dtype=numpy.uint8)]
+    if (len(sequenceCodes) < kmerLength + windowLength - 1):
+        return numpy.zeros(0, dtype=numpy.uint32)
+
+    # The k-mers are built one nucleotide column at a time.
+    kmerCount = len(sequenceCodes) - kmerLength + 1
+    kmerValues = numpy.zeros(kmerCount, dtype=numpy.uint32)
+    invalidCounts = numpy.zeros(kmerCount, dtype=numpy.uint8)
+    for kmerOffset in range(0, kmerLength):
+        columnCodes = sequenceCodes[kmerOffset:kmerOffset + kmerCount]
+        kmerValues = (kmerValues << numpy.uint32(2)) | (columnCodes & 3)
+        invalidCounts += (columnCodes == 255)
+
+    # Mix the bits, otherwise the minimizers would mostly be poly-A k-mers. Both steps can be reversed, different k-mers have different hashes.
+    kmerHashes = (kmerValues * numpy.uint32(0x9E3779B1)) & kmerMask
+    kmerHashes ^= kmerHashes >> numpy.uint32(kmerLength)
+    kmerHashes[invalidCounts > 0] = noMinimizer
+
+    return sliding_window_view(kmerHashes, windowLength).min(axis=1)
+
+def findMinimizers(sequence):
+    # Returns the unique minimizer hashes of a sequence, as a sorted numpy array.
+    windowMinimums = findWindowMinimums(sequence)
+    return numpy.unique(windowMinimums[windowMinimums != noMinimizer])
+
+def buildReferenceIndex(referenceAlleles):
+    # referenceAlleles is a list of tuples (alleleName, sequence). Returns the index array, sorted by minimizer and allele.
+    # A chunk of alleles is joined into one sequence and hashed at once, instead of one allele at a time.
+    # Each (minimizer, allele) pair is packed into one 64 bit number, so the pairs can be sorted and made unique quickly.
+    indexKeys = []
+    for chunkBegin in range(0, len(referenceAlleles), indexChunkSize):
+        chunkSequences = [str(sequence) for alleleName, sequence in referenceAlleles[chunkBegin:chunkBegin + indexChunkSize]]
+        sequenceBegins = numpy.cumsum([0] + [len(sequence) + len(sequenceSeparator) for sequence in chunkSequences[0:-1]])
+        windowMinimums = findWindowMinimums(sequenceSeparator.join(chunkSequences))
+        # Neighbouring windows mostly have the same minimizer, only the first window of each run is kept.
+        newMinimums = numpy.ones(len(windowMinimums), dtype=bool)
+        newMinimums[1:] = windowMinimums[1:] != windowMinimums[0:-1]
+        windowPositions = numpy.flatnonzero(newMinimums & (windowMinimums != noMinimizer))
+
+        chunkAlleles = chunkBegin + numpy.searchsorted(sequenceBegins, windowPositions, side='right') - 1
+        indexKeys.append((windowMinimums[windowPositions].astype(numpy.uint64) << numpy.uint64(32)) | chunkAlleles.astype(numpy.uint64))
+
+    indexKeys = numpy.sort(numpy.concatenate(indexKeys)) if len(indexKeys) > 0 else numpy.zeros(0, dtype=numpy.uint64)
+    uniqueKeys = numpy.ones(len(indexKeys), dtype=bool)
+    uniqueKeys[1:] = indexKeys[1:] != indexKeys[0:-1]
+    indexKeys = indexKeys[uniqueKeys]
+    indexArray = numpy.empty(len(indexKeys), dtype=indexRecordType)
+    indexArray['minimizer'] = indexKeys >> numpy.uint64(32)
+    indexArray['allele'] = indexKeys & numpy.uint64(0xFFFFFFFF)
+    return indexArray
+
+def writeReferenceIndex(referenceAlleles, databaseFullPath, locus):
+    # Build the index of one locus and write it next to the database. Returns the ReferenceIndex.
+    indexFileName, namesFileName = getReferenceIndexFileNames(databaseFullPath, locus)
+    alleleNames = [str(alleleName) for alleleName, sequence in referenceAlleles]
+    indexArray = buildReferenceIndex(referenceAlleles)
+
+    # Write temporary files and move them, so nobody memory-maps half of an index.
+    with open(indexFileName + '.tmp', 'wb') as indexFile:
+        numpy.save(indexFile, indexArray)
+    with open(namesFileName + '.tmp', 'w') as namesFile:
+        namesFile.write(''.join(alleleName + '\n' for alleleName in alleleNames))
+    replace(namesFileName + '.tmp', namesFileName)
+    replace(indexFileName + '.tmp', indexFileName)
+    logging.info('Wrote a reference index of ' + str(len(alleleNames)) + ' alleles for locus ' + str(locus) + ':' + indexFileName)
+    return ReferenceIndex(indexArray, alleleNames)
+
+def readReferenceIndex(databaseFullPath, locus):
+    # Returns the memory-mapped ReferenceIndex of one locus, or None if there is no index file.
+    indexFileName, namesFileName = getReferenceIndexFileNames(databaseFullPath, locus)
+    if (not isfile(indexFileName) or not isfile(namesFileName)):
+        return None
+    with open(namesFileName, 'r') as namesFile:
+        alleleNames = namesFile.read().splitlines()
+    return ReferenceIndex(numpy.load(indexFileName, mmap_mode='r'), alleleNames)
+
+class ReferenceIndex():
+
+    def __init__(self, indexArray, alleleNames):
+        self.indexArray = indexArray
+        self.alleleNames = alleleNames
+        # The sorted minimizers, the array of pairs is memory-mapped and is not copied.
+        self.minimizers = indexArray['minimizer']
+
+    def findCandidateAlleles(self, querySequence, candidateCount=5):
+        # Returns a list of tuples (alleleNumber, sharedMinimizerCount) for the reference alleles that share the most
+        # minimizers with the query sequence, best first.
+        queryMinimizers = findMinimizers(querySequence)
+        if (len(queryMinimizers) < 1 or len(self.alleleNames) < 1):
+            return []
+
+        rangeBegins = numpy.searchsorted(self.minimizers, queryMinimizers, side='left')
+        rangeEnds = numpy.searchsorted(self.minimizers, queryMinimizers, side='right')
+        matchCount = int((rangeEnds - rangeBegins).sum())
+        if (matchCount < 1):
+            return []
+
+        # The positions of every matching index record, without a python loop over the minimizers.
+        rangeLengths = rangeEnds - rangeBegins
+        rangeOffsets = numpy.repeat(rangeBegins - numpy.cumsum(rangeLengths) + rangeLengths, rangeLengths)
+        matchPositions = numpy.arange(matchCount) + rangeOffsets
+        alleleCounts = numpy.bincount(self.indexArray['allele'][matchPositions], minlength=len(self.alleleNames))
+
+        candidateCount = min(candidateCount, len(alleleCounts))
+        candidateAlleles = numpy.argpartition(-alleleCounts, candidateCount - 1)[0:candidateCount]
+        candidateAlleles = sorted(candidateAlleles, key=lambda alleleNumber: (-alleleCounts[alleleNumber], alleleNumber))
+        return [(int(alleleNumber), int(alleleCounts[alleleNumber])) for alleleNumber in candidateAlleles if alleleCounts[alleleNumber] > 0]
@@ -30,6 +30,8 @@ from sys import exc_info
 from os.path import join, isfile
     #, expanduser, abspath, isdir, split
 
+import csv
+
 # from tkinter import messagebox, simpledialog
 #
 from xml.etree import ElementTree as ET
@@ -48,8 +50,12 @@ from xml.dom import minidom as MD
 #
 # from zipfile import ZipFile
 from saddlebags.AlleleSubCommon import getSaddlebagsDirectory, createOutputFile, showInfoBox
-from saddlebags.Logging import initializeLog
+from saddlebags.Logging import initializeLog, configurePayloadLogging
 from saddlebags.AlleleSubmission import SubmissionBatch, AlleleSubmission
+from saddlebags.HlaSequence import cleanSequence
+from saddlebags.SequenceFileReader import iterateSequenceFile
+from saddlebags.AnnotationServiceClient import configureAnnotationServiceClient
+from saddlebags.AnnotationCache import configureAnnotationCache
 
 import logging
 
@@ -81,7 +87,8 @@ def assignConfigurationValue(configurationKey, configurationValue):
         globalVariables[configurationKey] = configurationValue
 
     globalVariables[configurationKey] = configurationValue
-    logging.debug ('Just stored configuration key ' + configurationKey + ' which is ' + str(configurationValue) + ' of type ' + str(type(configurationValue)))
+    # The values are only formatted if the message is written. A value can be a whole SubmissionBatch.
+    logging.debug('Just stored configuration key %s which is %s of type %s', configurationKey, configurationValue, type(configurationValue))
 
 def assignIfNotExists(configurationKey, configurationValue):
     # Use this assigner if we want to declare important, new configuration values.
@@ -96,7 +103,8 @@ def getConfigurationValue(configurationKey):
 
         configurationValue = globalVariables[configurationKey]
 
-        logging.debug ('Retrieving configuration key ' + configurationKey + ' which is ' + str(configurationValue) + ' of type ' + str(type(configurationValue)))
+        # This is called very often, the message is only formatted if it is written.
+        logging.debug('Retrieving configuration key %s which is %s of type %s', configurationKey, configurationValue, type(configurationValue))
 
         if (type(configurationValue) is str):
             return deserializeConfigValue(configurationValue)
@@ -107,18 +115,14 @@ def getConfigurationValue(configurationKey):
         #raise KeyError('Key Not Found:' + configurationKey)
         return None
 
-def loadFromCSV(csvFileName):
-    # Read submission data from a .csv file.
-    logging.debug ('loading data from this csv file:' + csvFileName)
-
-    #TODO: If it's a zip file, I should be able to look for a .csv file in the root of the .zip.
-
+def getLoadingSubmissionBatch():
+    # The submission batch that loaded submissions are added to.
     # Load our submission batch. Does it already exist? It should.
     submissionBatch = getConfigurationValue('submission_batch')
     if(submissionBatch == None):
-        logging.warning('Loading from CSV file. There was no batch of submissions, so I had to create an empty batch')
+        logging.warning('Loading submissions. There was no batch of submissions, so I had to create an empty batch')
 
-        submissionBatch = SubmissionBatch()
+        submissionBatch = SubmissionBatch(False)
 
         # Assign some default information about this batch of submissions
         submissionBatch.ipdSubmitterId = ''
@@ -128,6 +132,39 @@ def loadFromCSV(csvFileName):
         submissionBatch.labOfOrigin = ''
         submissionBatch.labContact = ''
 
+        assignConfigurationValue('submission_batch', submissionBatch)
+
+    return submissionBatch
+
+def loadFromSequenceFile(sequenceFileName, geneLocus=None, hlaClass=None):
+    # Read the submissions from a FASTA or FASTQ file (gzipped or not), one allele per record.
+    # For example the consensus sequences of a sequencing run. The record name is the local allele name.
+    # The records are read one at a time in a single pass. Annotated sequences (exons uppercase) get their features.
+    logging.debug ('loading sequences from this file:' + sequenceFileName)
+    submissionBatch = getLoadingSubmissionBatch()
+
+    sequenceCount = 0
+    for recordName, sequence in iterateSequenceFile(sequenceFileName):
+        submission = AlleleSubmission()
+        submission.submittedAllele.rawSequence = cleanSequence(sequence)
+        submission.submittedAllele.identifyFeaturesFromFormattedSequence()
+        submission.submittedAllele.geneLocus = geneLocus
+        submission.submittedAllele.hlaClass = hlaClass
+        submission.localAlleleName = recordName
+        submissionBatch.submissionBatch.append(submission)
+        sequenceCount += 1
+
+    logging.info('Loaded ' + str(sequenceCount) + ' submission(s) from ' + str(sequenceFileName))
+    return submissionBatch
+
+def loadFromCSV(csvFileName):
+    # Read submission data from a .csv file.
+    logging.debug ('loading data from this csv file:' + csvFileName)
+
+    #TODO: If it's a zip file, I should be able to look for a .csv file in the root of the .zip.
+
+    submissionBatch = getLoadingSubmissionBatch()
+
     # Open the CSV and read the header.
     csvFile = open(csvFileName, 'r')
     csvInputReader = csv.reader(csvFile)
@@ -159,7 +196,8 @@ def loadFromCSV(csvFileName):
         # Create a submission Object
         # Get each column of data and store it in the submission.
         submission = AlleleSubmission()
-        # TODO: What if the .csv file is not annotated? I believe identifyFeaturesFromFormattedSequence expects the annotated sequence.
+        # identifyFeaturesFromFormattedSequence expects the annotated sequence. If the .csv file is not annotated,
+        # the batch can be annotated with the ACT service afterwards (annotateBatchUsingService, the --annotate option of the command line).
         submission.submittedAllele.rawSequence = submissionCSVRow[requiredFieldIndices['SEQUENCE']]
         submission.submittedAllele.identifyFeaturesFromFormattedSequence()
         submission.submittedAllele.geneLocus = submissionCSVRow[requiredFieldIndices['GENELOCUS']]
@@ -190,6 +228,8 @@ def loadFromCSV(csvFileName):
 
     csvFile.close()
 
+    return submissionBatch
+
 def assignConfigName():
     # Join together the working directory, a subfolder called "saddlebags", and the config name.
     assignConfigurationValue('config_file_location', join(getSaddlebagsDirectory(), 'Saddlebags.Config.xml'))
@@ -435,19 +475,48 @@ def loadConfigurationFile():
         assignIfNotExists('test_submission', '1')
         # Log levels are defined in the Saddlebags config, and passed into the python logging module.
         assignIfNotExists('logging', 'DEBUG')
+        # Sequences, annotation JSON and submission flatfiles are only written to the log if this is 1.
+        assignIfNotExists('log_payloads', '0')
         # Placeholder for proxy configuration. Not needed right now but maybe for the future.
         #assignIfNotExists('proxy', None)
         assignIfNotExists('ena_rest_address_test', 'https://www-test.ebi.ac.uk/ena/submit/drop-box/submit/')
         assignIfNotExists('ena_rest_address_prod', 'https://www.ebi.ac.uk/ena/submit/drop-box/submit/')
         assignIfNotExists('nmdp_act_rest_address', 'http://act.b12x.org/annotate')
+        # Timeouts in seconds for the annotation service. Connections to the service are reused between sequences.
+        assignIfNotExists('act_connect_timeout', '10')
+        assignIfNotExists('act_request_timeout', '120')
+        # Sequences are sent to the ACT service in POST requests, GET is used if the service does not accept them.
+        # The request body can be gzip compressed, if the service accepts compressed requests.
+        assignIfNotExists('act_use_post', '1')
+        assignIfNotExists('act_compress_requests', '0')
+        # Number of annotation requests that are sent at the same time when annotating a batch of sequences.
+        assignIfNotExists('act_max_in_flight', '8')
+        # Annotations from the ACT service are cached in the saddlebags directory. Old annotations are deleted after a number of days,
+        # and the least recently used annotations are deleted when the cache is larger than the maximum size.
+        assignIfNotExists('act_cache_enabled', '1')
+        assignIfNotExists('act_cache_max_age_days', '30')
+        assignIfNotExists('act_cache_max_size_mb', '100')
+        # The aligner for the local annotation: PairwiseAligner, or BandedAligner which is faster for long sequences.
+        # Both give the same alignment score, the banded alignment is checked against the PairwiseAligner score.
+        assignIfNotExists('local_aligner', 'PairwiseAligner')
         assignIfNotExists('webin_jar_location','webin-cli.jar')
         assignIfNotExists('submission_batch', SubmissionBatch(True))
+        # Number of worker processes used to generate a batch of submissions. 1 means no extra processes, 0 means one per CPU.
+        assignIfNotExists('generation_worker_count', '1')
+        # Number of submissions sent to a worker at once. 0 means choose automatically.
+        assignIfNotExists('generation_chunk_size', '0')
+
+        configureAnnotationServiceClient(float(getConfigurationValue('act_connect_timeout')), float(getConfigurationValue('act_request_timeout'))
+            , getConfigurationValue('act_use_post') == '1', getConfigurationValue('act_compress_requests') == '1')
+        configureAnnotationCache(getConfigurationValue('act_cache_enabled') == '1'
+            , float(getConfigurationValue('act_cache_max_age_days')), float(getConfigurationValue('act_cache_max_size_mb')))
+        configurePayloadLogging(getConfigurationValue('log_payloads') == '1')
 
         writeConfigurationFile()
 
         # Last step is to initialize the log files. Why is this the last step? initializing log should be first
         # but I need some config values before starting the log.
-        initializeLog()
+        initializeLog(getConfigurationValue('logging'))
     except:
         logging.error('Error when loading configuration file:' + str(globalVariables['config_file_location']) + '.\nTry deleting your configuration file and reload Saddlebags.\n' + str(exc_info()[1]))
         showInfoBox('Error Loading Configuration','Error when loading configuration file:' + str(globalVariables['config_file_location']) + '.\nTry deleting your configuration file and reload Saddlebags.\n' + str(exc_info()[1]))
@@ -14,6 +14,7 @@
 # along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
 
 from saddlebags.AlleleSubCommon import resourcePath
+from saddlebags.HlaSequenceException import HlaSequenceException
 
 import sqlite3
 from sqlite3 import Error
@@ -22,10 +23,17 @@ from BioSQL import BioSeqDatabase
 
 import logging
 
-from os.path import join
+from os import getpid, remove, replace
+from os.path import join, isfile
+from shutil import copyfile
 from sys import exc_info
+from hashlib import sha1
 
-from Bio.SeqIO import parse
+from Bio.SeqIO import read
+from io import StringIO
+
+from saddlebags.ReferenceIndex import writeReferenceIndex
+from saddlebags.ReferenceDatabase import getReferenceDatabase, closeReferenceDatabase
 
 def connectSqliteDatabase(databaseFullPath):
     # Create a sqlite database
@@ -97,91 +105,399 @@ def setupBioSqlDatabase(databaseFullPath, bioSqlCommandFilePath):
     sqliteConnection.close()
 
 
+# The loci that are loaded from the IMGT/HLA data.
+hlaLoci = ['A', 'B', 'C', 'DRB1', 'DQB1', 'DRB3', 'DRB4', 'DRB5', 'DQA1', 'DPA1', 'DPB1', 'DRA']
+
+# Number of records inserted at once.
+loadBatchSize = 5000
+
+def readAlleleNames(alleleListFileName):
+    # Returns a dictionary of IMGT accession numbers to allele names, from the Allelelist.txt of an IMGT/HLA release.
+    # The header lines (# comments and "AlleleID,Allele") are skipped.
+    alleleNames = {}
+    with open(alleleListFileName, 'r') as alleleListFile:
+        for line in alleleListFile:
+            line = line.strip()
+            if (len(line) < 1 or line.startswith('#') or ',' not in line):
+                continue
+            accession, alleleName = line.split(',', 1)
+            if ('*' in alleleName):
+                alleleNames[accession] = alleleName
+    logging.debug('Loaded ' + str(len(alleleNames)) + ' allele names from ' + alleleListFileName)
+    return alleleNames
+
+def iterateHlaDataRecords(hlaDataFileName):
+    # Read the hla.dat file record by record, the records are not all held in memory.
+    # Yields tuples (accession, recordText). The records are only split here, they are parsed when they are needed.
+    with open(hlaDataFileName, 'r') as hlaDataFile:
+        accession = None
+        recordLines = []
+        for line in hlaDataFile:
+            if (line.startswith('ID   ')):
+                accession = line[5:].split(';')[0].strip()
+            recordLines.append(line)
+            if (line.startswith('//')):
+                yield accession, ''.join(recordLines)
+                accession = None
+                recordLines = []
+
+def parseHlaDataRecord(recordText):
+    return read(StringIO(recordText), 'imgt')
+
+def iterateHlaReferences(hlaDataFolder):
+    # Yields tuples (locus, alleleName, recordText) for the alleles of the loci in hlaLoci. The allele names start with "HLA-".
+    alleleNames = readAlleleNames(join(hlaDataFolder, 'Allelelist.txt'))
+    for accession, recordText in iterateHlaDataRecords(join(hlaDataFolder, 'hla.dat')):
+        if (accession in alleleNames):
+            locus = alleleNames[accession].split('*')[0]
+            if (locus in hlaLoci):
+                yield locus, 'HLA-' + alleleNames[accession], recordText
+
 def loadHLADataIntoBioSql(databaseFullPath, hlaDataFolder):
     # This code is adopted from the script included with SeqAnn
     # https://github.com/nmdp-bioinformatics/seq-ann/scripts/create_imgtdb.py
     # Which is also released under the GPL 3.0 license.
+    # The records are loaded into one BioSQL database per locus, a batch at a time, instead of all of them at the end.
     logging.debug('Loading HLA data from this folder:' + hlaDataFolder)
 
-
-
-    #server = BioSeqDatabase.open_database(driver="pymysql", user="root",
-    #                                          passwd="", host="localhost",
-    #                                             db="bioseqdb")
-
-    sqliteConnection = connectSqliteDatabase(databaseFullPath)
-
-    #for dbv in dblist:
-
-    #hladat = download_dat(dbv)
-    #allele_list = download_allelelist(dbv)
-    hladat = join(hlaDataFolder, 'hla.dat')
-    allele_list = join(hlaDataFolder, 'Allelelist.txt')
-
-    hla_names = {}
+    # The sequences are loaded by the BioSQL server, a plain sqlite connection does not have new_database.
+    server = BioSeqDatabase.open_database(driver='sqlite3', db=databaseFullPath)
     try:
-        #s = "," if dbv == "3260" or dbv == "3270" else " "
-        s = ','
-        with open(allele_list, 'r') as f:
-            for line in f:
-                line = line.rstrip()
-                accession, name = line.split(s)
-                hla_names.update({accession: name})
-        f.close()
-        logging.debug("Loaded allele names " +  allele_list)
-    except ValueError as err:
-        logging.error("Allelelist error: {0}".format(err))
-        sqliteConnection.close()
-        #os.remove(hladat)
-        #os.remove(allele_list)
-        #sys.exit()
-
+        locusDatabases = {}
+        for locus in hlaLoci:
+            locusDatabases[locus] = server[locus] if locus in server else server.new_database(locus, description='IMGT/HLA ' + locus)
+
+        locusBatches = dict((locus, []) for locus in hlaLoci)
+        locusCounts = dict((locus, 0) for locus in hlaLoci)
+        for locus, alleleName, recordText in iterateHlaReferences(hlaDataFolder):
+            seqRecord = parseHlaDataRecord(recordText)
+            seqRecord.name = alleleName
+            locusBatches[locus].append(seqRecord)
+            if (len(locusBatches[locus]) >= loadBatchSize):
+                locusCounts[locus] += locusDatabases[locus].load(locusBatches[locus])
+                locusBatches[locus] = []
+                server.commit()
+
+        for locus in hlaLoci:
+            if (len(locusBatches[locus]) > 0):
+                locusCounts[locus] += locusDatabases[locus].load(locusBatches[locus])
+            logging.info('Loaded ' + str(locusCounts[locus]) + ' sequences for locus ' + locus)
+        server.commit()
+    except Exception:
+        logging.error('Failed to load the HLA data into BioSQL:' + str(exc_info()[1]))
+        server.rollback()
+        raise
+    finally:
+        server.close()
+
+def readReleaseVersion(alleleListFileName):
+    # The IMGT/HLA release is in the header of Allelelist.txt, "# version: IPD-IMGT/HLA 3.40.0". Returns None if it is not there.
+    with open(alleleListFileName, 'r') as alleleListFile:
+        for line in alleleListFile:
+            if (not line.startswith('#')):
+                break
+            if (line[1:].strip().lower().startswith('version:')):
+                return line.split(':', 1)[1].strip()
+    return None
+
+def createReferenceTables(databaseConnection):
+    # Flat tables of the IMGT/HLA reference alleles, for the local annotation.
+    # The coordinates of the UTRs, exons and introns of every allele are in reference_feature, and the exons joined together in exon_sequence.
+    # The checksum of each allele and the release version are used to update only the alleles that changed.
+    databaseConnection.execute('CREATE TABLE IF NOT EXISTS reference_allele ( '
+        + 'allele_id INTEGER PRIMARY KEY, '
+        + 'allele_name TEXT NOT NULL, '
+        + 'locus TEXT NOT NULL, '
+        + 'accession TEXT NOT NULL, '
+        + 'sequence TEXT NOT NULL, '
+        + 'annotated_sequence TEXT, '
+        + 'exon_sequence TEXT, '
+        + 'checksum TEXT)')
+    databaseConnection.execute('CREATE TABLE IF NOT EXISTS reference_feature ( '
+        + 'allele_id INTEGER NOT NULL, '
+        + 'feature_name TEXT NOT NULL, '
+        + 'begin_index INTEGER NOT NULL, '
+        + 'end_index INTEGER NOT NULL, '
+        + 'exon INTEGER NOT NULL)')
+    databaseConnection.execute('CREATE TABLE IF NOT EXISTS reference_release ( '
+        + 'release_id INTEGER PRIMARY KEY, '
+        + 'release_version TEXT, '
+        + 'load_date TEXT NOT NULL)')
+
+    # Databases loaded before there were checksums or features. Every allele is written again by the next update.
+    alleleColumns = [columnInfo[1] for columnInfo in databaseConnection.execute('PRAGMA table_info(reference_allele)')]
+    if ('checksum' not in alleleColumns):
+        databaseConnection.execute('ALTER TABLE reference_allele ADD COLUMN checksum TEXT')
+    if ('exon_sequence' not in alleleColumns):
+        databaseConnection.execute('ALTER TABLE reference_allele ADD COLUMN exon_sequence TEXT')
+        databaseConnection.execute('UPDATE reference_allele SET checksum = NULL')
+        databaseConnection.execute('DELETE FROM reference_release')
+
+# executescript() would commit the load transaction, these statements are executed one by one.
+def dropReferenceIndexes(databaseConnection):
+    databaseConnection.execute('DROP INDEX IF EXISTS reference_allele_name')
+    databaseConnection.execute('DROP INDEX IF EXISTS reference_allele_locus')
+    databaseConnection.execute('DROP INDEX IF EXISTS reference_feature_allele')
+
+def createReferenceIndexes(databaseConnection):
+    # The indexes are built after the rows are inserted, that is faster than updating them for every row.
+    databaseConnection.execute('CREATE UNIQUE INDEX IF NOT EXISTS reference_allele_name ON reference_allele (allele_name)')
+    databaseConnection.execute('CREATE INDEX IF NOT EXISTS reference_allele_locus ON reference_allele (locus, allele_id)')
+    databaseConnection.execute('CREATE INDEX IF NOT EXISTS reference_feature_allele ON reference_feature (allele_id, begin_index)')
+
+def getRecordChecksum(alleleName, recordText):
+    # The checksum of the hla.dat record, an allele whose record did not change is not parsed again.
+    return sha1((alleleName + '\n' + recordText).encode('utf-8')).hexdigest()
+
+def getReferenceAllele(locus, alleleName, recordText, checksum=None):
+    # Returns a tuple (alleleValues, featureCoordinates). alleleValues are the reference_allele columns after allele_id,
+    # allele_name first and checksum last. featureCoordinates are the reference_feature columns after allele_id.
+    seqRecord = parseHlaDataRecord(recordText)
+    featureCoordinates = getReferenceFeatureCoordinates(seqRecord)
+    sequence = str(seqRecord.seq).upper()
+    exonSequence = ''.join(sequence[featureBegin - 1:featureEnd] for featureName, featureBegin, featureEnd, isExon in featureCoordinates if isExon)
+    return ((alleleName, locus, seqRecord.name, sequence, getAnnotatedReferenceSequence(seqRecord), exonSequence if len(exonSequence) > 0 else None
+        , getRecordChecksum(alleleName, recordText) if checksum is None else checksum), featureCoordinates)
+
+def getReferenceLoadPath(databaseFullPath):
+    # The new release is written into a copy of the database, and replaces it when the load is finished.
+    # The readers in other processes open the database as immutable, so it is never changed in place. They keep reading the old file
+    # until they see that it was replaced, like the ReferenceIndex files.
+    loadPath = databaseFullPath + '.' + str(getpid()) + '.tmp'
+    if (isfile(databaseFullPath)):
+        copyfile(databaseFullPath, loadPath)
+    elif (isfile(loadPath)):
+        remove(loadPath)
+    return loadPath
+
+def replaceReferenceDatabase(loadPath, databaseFullPath):
     try:
-        seq_list = parse(hladat, "imgt")
-    except ValueError as err:
-        logging.error("Read dat error: {0}".format(err))
-        sqliteConnection.close()
-        #os.remove(hladat)
-        #os.remove(allele_list)
-        #sys.exit()
-
-    new_seqs = {"A": [], "B": [], "C": [], "DRB1": [],
-                "DQB1": [], "DRB3": [], "DRB4": [], "DRB5": [],
-                "DQA1": [], "DPA1": [], "DPB1": [], "DRA": []}
-
-    for seq in seq_list:
-        if seq.name in hla_names:
-            loc, allele = hla_names[seq.name].split("*")
-            if loc in new_seqs:
-                hla_name = "HLA-" + hla_names[seq.name]
-                seq.name = hla_name
-                new_seqs[loc].append(seq)
-
-    #dbsp = list(dbv)
-    #descr = ".".join([dbsp[0], dbsp[1] + dbsp[2], dbsp[3]])
-    #print("Loaded IMGT dat file ", descr)
-
-    for locus in new_seqs:
-        #dbname = dbv + "_" + locus
-        dbname = locus
-        dbdescription = "IMGT/HLA " + locus
-        db = sqliteConnection.new_database(dbname, description=dbdescription)
-        try:
-            count = db.load(new_seqs[locus])
-        except:
-            logging.error("Failed to load :" + str(exc_info()[0]))
-            sqliteConnection.close()
-            #os.remove(hladat)
-            #os.remove(allele_list)
-            #sys.exit()
-
-        print("Loaded ", count, " for ", locus)
-        sqliteConnection.commit()
-
-    #os.remove(hladat)
-    #os.remove(allele_list)
-    logging.debug("Finished ", dbdescription)
-
-    #server.close()
-    sqliteConnection.close()
-
+        replace(loadPath, databaseFullPath)
+    except OSError:
+        # On Windows the database can't be replaced while another program has it open.
+        discardReferenceLoad(loadPath)
+        raise HlaSequenceException('Could not replace the reference database ' + str(databaseFullPath)
+            + ', is it open in another saddlebags window?:' + str(exc_info()[1]))
+    finally:
+        closeReferenceDatabase(databaseFullPath)
+
+def discardReferenceLoad(loadPath):
+    for discardedPath in (loadPath, loadPath + '-wal', loadPath + '-shm'):
+        if (isfile(discardedPath)):
+            remove(discardedPath)
+
+def openReferenceLoadConnection(databaseFullPath):
+    databaseConnection = sqlite3.connect(databaseFullPath, isolation_level=None)
+    # The database is rebuilt if the load fails, it doesn't need to survive a power failure during the load.
+    databaseConnection.execute('PRAGMA journal_mode=WAL')
+    databaseConnection.execute('PRAGMA synchronous=OFF')
+    databaseConnection.execute('PRAGMA cache_size=-65536')
+    databaseConnection.execute('PRAGMA temp_store=MEMORY')
+    createReferenceTables(databaseConnection)
+    return databaseConnection
+
+def finishReferenceLoad(databaseConnection, releaseVersion):
+    # Record the release and commit the load transaction.
+    databaseConnection.execute('INSERT INTO reference_release (release_version, load_date) VALUES (?, datetime(\'now\'))', (releaseVersion,))
+    databaseConnection.execute('COMMIT')
+    databaseConnection.execute('PRAGMA synchronous=NORMAL')
+    databaseConnection.execute('ANALYZE')
+    # The readers open the file as immutable and would not see a WAL file, everything is written back into the database before it is replaced.
+    databaseConnection.execute('PRAGMA journal_mode=DELETE')
+
+def abortReferenceLoad(databaseConnection):
+    logging.error('Failed to load the HLA data:' + str(exc_info()[1]))
+    if (databaseConnection.in_transaction):
+        databaseConnection.execute('ROLLBACK')
+
+def writeReferenceIndexes(databaseFullPath, loci):
+    # The minimizer index to find the closest reference alleles, for the local annotation.
+    for locus in loci:
+        writeReferenceIndex(list(readReferenceAlleles(databaseFullPath, locus)), databaseFullPath, locus)
+
+insertReferenceStatement = ('INSERT INTO reference_allele (allele_id, allele_name, locus, accession, sequence, annotated_sequence, exon_sequence, checksum) '
+    + 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+updateReferenceStatement = ('UPDATE reference_allele SET locus = ?, accession = ?, sequence = ?, annotated_sequence = ?, exon_sequence = ?, checksum = ? '
+    + 'WHERE allele_id = ?')
+insertFeatureStatement = ('INSERT INTO reference_feature (allele_id, feature_name, begin_index, end_index, exon) VALUES (?, ?, ?, ?, ?)')
+
+def writeReferenceRows(databaseConnection, insertRows, updateRows, featureRows):
+    # Write a batch of alleles. The old features of the updated alleles are replaced by featureRows.
+    databaseConnection.executemany('DELETE FROM reference_feature WHERE allele_id = ?', [(updateRow[-1],) for updateRow in updateRows])
+    databaseConnection.executemany(updateReferenceStatement, updateRows)
+    databaseConnection.executemany(insertReferenceStatement, insertRows)
+    databaseConnection.executemany(insertFeatureStatement, featureRows)
+
+def loadHLADataIntoSqlite(databaseFullPath, hlaDataFolder):
+    # Load the reference alleles of an IMGT/HLA release into the reference_allele table, replacing the previous release.
+    # hla.dat is read one record at a time and the rows are inserted in batches, in one transaction.
+    # Returns the number of loaded alleles.
+    logging.debug('Loading HLA data into ' + str(databaseFullPath) + ' from this folder:' + hlaDataFolder)
+    loadPath = getReferenceLoadPath(databaseFullPath)
+    databaseConnection = openReferenceLoadConnection(loadPath)
+    try:
+        databaseConnection.execute('BEGIN')
+        dropReferenceIndexes(databaseConnection)
+        databaseConnection.execute('DELETE FROM reference_allele')
+        databaseConnection.execute('DELETE FROM reference_feature')
+
+        alleleCount = 0
+        alleleRows = []
+        featureRows = []
+        for locus, alleleName, recordText in iterateHlaReferences(hlaDataFolder):
+            alleleCount += 1
+            alleleValues, featureCoordinates = getReferenceAllele(locus, alleleName, recordText)
+            alleleRows.append((alleleCount,) + alleleValues)
+            featureRows.extend((alleleCount,) + featureValues for featureValues in featureCoordinates)
+            if (len(alleleRows) >= loadBatchSize):
+                writeReferenceRows(databaseConnection, alleleRows, [], featureRows)
+                alleleRows = []
+                featureRows = []
+        writeReferenceRows(databaseConnection, alleleRows, [], featureRows)
+
+        createReferenceIndexes(databaseConnection)
+        finishReferenceLoad(databaseConnection, readReleaseVersion(join(hlaDataFolder, 'Allelelist.txt')))
+        logging.info('Loaded ' + str(alleleCount) + ' reference alleles into ' + str(databaseFullPath))
+    except Exception:
+        abortReferenceLoad(databaseConnection)
+        databaseConnection.close()
+        discardReferenceLoad(loadPath)
+        raise
+    databaseConnection.close()
+    replaceReferenceDatabase(loadPath, databaseFullPath)
+
+    writeReferenceIndexes(databaseFullPath, hlaLoci)
+    return alleleCount
+
+def getLoadedReleaseVersion(databaseFullPath):
+    # Returns the version of the last IMGT/HLA release that was loaded, or None.
+    databaseConnection = sqlite3.connect(databaseFullPath)
+    try:
+        createReferenceTables(databaseConnection)
+        releaseRow = databaseConnection.execute('SELECT release_version FROM reference_release ORDER BY release_id DESC LIMIT 1').fetchone()
+        return None if releaseRow is None else releaseRow[0]
+    finally:
+        databaseConnection.close()
+
+def updateHLADataInSqlite(databaseFullPath, hlaDataFolder, forceUpdate=False):
+    # Update the reference_allele table to a newer IMGT/HLA release. Only the alleles that were added, changed or removed are written,
+    # an allele changed if the checksum of its hla.dat record is different, the unchanged records are not parsed. Nothing is done if this release was already loaded, unless forceUpdate.
+    # Returns a tuple (insertCount, updateCount, deleteCount).
+    releaseVersion = readReleaseVersion(join(hlaDataFolder, 'Allelelist.txt'))
+    loadedVersion = getLoadedReleaseVersion(databaseFullPath)
+    if (not forceUpdate and releaseVersion is not None and releaseVersion == loadedVersion):
+        logging.info('The IMGT/HLA release ' + str(releaseVersion) + ' is already loaded into ' + str(databaseFullPath))
+        return 0, 0, 0
+    logging.debug('Updating HLA data in ' + str(databaseFullPath) + ' from release ' + str(loadedVersion) + ' to ' + str(releaseVersion))
+
+    loadPath = getReferenceLoadPath(databaseFullPath)
+    databaseConnection = openReferenceLoadConnection(loadPath)
+    try:
+        databaseConnection.execute('BEGIN')
+        # Only the names and checksums of the loaded alleles are kept in memory, not the sequences.
+        loadedChecksums = {}
+        loadedLoci = {}
+        for alleleId, alleleName, locus, checksum in databaseConnection.execute('SELECT allele_id, allele_name, locus, checksum FROM reference_allele'):
+            loadedChecksums[alleleName] = (alleleId, checksum)
+            loadedLoci[alleleName] = locus
+
+        nextAlleleId = databaseConnection.execute('SELECT COALESCE(MAX(allele_id), 0) + 1 FROM reference_allele').fetchone()[0]
+
+        changedLoci = set()
+        insertCount = 0
+        updateCount = 0
+        insertRows = []
+        updateRows = []
+        featureRows = []
+        for locus, alleleName, recordText in iterateHlaReferences(hlaDataFolder):
+            checksum = getRecordChecksum(alleleName, recordText)
+            loadedAllele = loadedChecksums.pop(alleleName, None)
+            if (loadedAllele is None):
+                alleleValues, featureCoordinates = getReferenceAllele(locus, alleleName, recordText, checksum)
+                insertRows.append((nextAlleleId,) + alleleValues)
+                featureRows.extend((nextAlleleId,) + featureValues for featureValues in featureCoordinates)
+                nextAlleleId += 1
+                insertCount += 1
+                changedLoci.add(locus)
+            elif (loadedAllele[1] != checksum):
+                alleleValues, featureCoordinates = getReferenceAllele(locus, alleleName, recordText, checksum)
+                updateRows.append(alleleValues[1:] + (loadedAllele[0],))
+                featureRows.extend((loadedAllele[0],) + featureValues for featureValues in featureCoordinates)
+                updateCount += 1
+                changedLoci.add(locus)
+                changedLoci.add(loadedLoci[alleleName])
+
+            if (len(insertRows) + len(updateRows) >= loadBatchSize):
+                writeReferenceRows(databaseConnection, insertRows, updateRows, featureRows)
+                insertRows = []
+                updateRows = []
+                featureRows = []
+        writeReferenceRows(databaseConnection, insertRows, updateRows, featureRows)
+
+        # The alleles that are left were not in this release.
+        deletedAlleleIds = [(alleleId,) for alleleId, checksum in loadedChecksums.values()]
+        databaseConnection.executemany('DELETE FROM reference_allele WHERE allele_id = ?', deletedAlleleIds)
+        databaseConnection.executemany('DELETE FROM reference_feature WHERE allele_id = ?', deletedAlleleIds)
+        deleteCount = len(loadedChecksums)
+        changedLoci.update(loadedLoci[alleleName] for alleleName in loadedChecksums)
+
+        createReferenceIndexes(databaseConnection)
+        finishReferenceLoad(databaseConnection, releaseVersion)
+        logging.info('Updated the reference alleles in ' + str(databaseFullPath) + ' to release ' + str(releaseVersion) + ':'
+            + str(insertCount) + ' inserted, ' + str(updateCount) + ' updated, ' + str(deleteCount) + ' deleted')
+    except Exception:
+        abortReferenceLoad(databaseConnection)
+        databaseConnection.close()
+        discardReferenceLoad(loadPath)
+        raise
+    databaseConnection.close()
+    replaceReferenceDatabase(loadPath, databaseFullPath)
+
+    # Only the indexes of the loci that changed are rebuilt.
+    writeReferenceIndexes(databaseFullPath, [locus for locus in hlaLoci if locus in changedLoci])
+    return insertCount, updateCount, deleteCount
+
+def getAnnotatedReferenceSequence(seqRecord):
+    # Returns the sequence of an IMGT/HLA reference allele, exons uppercase and introns/UTRs lowercase.
+    # Returns None if the reference is not a full genomic sequence, a cDNA reference has no intron boundaries to project.
+    featureTypes = set(feature.type for feature in seqRecord.features)
+    if ('exon' not in featureTypes or ('intron' not in featureTypes and 'UTR' not in featureTypes)):
+        return None
+
+    sequence = str(seqRecord.seq).lower()
+    annotatedParts = []
+    previousEnd = 0
+    for feature in sorted((feature for feature in seqRecord.features if feature.type == 'exon'), key=lambda feature: int(feature.location.start)):
+        featureBegin = max(int(feature.location.start), previousEnd)
+        featureEnd = int(feature.location.end)
+        annotatedParts.append(sequence[previousEnd:featureBegin])
+        annotatedParts.append(sequence[featureBegin:featureEnd].upper())
+        previousEnd = max(featureEnd, previousEnd)
+    annotatedParts.append(sequence[previousEnd:])
+    return ''.join(annotatedParts)
+
+def getReferenceFeatureCoordinates(seqRecord):
+    # Returns a list of (featureName, beginIndex, endIndex, exon) for the UTRs, exons and introns of an IMGT/HLA reference allele.
+    # The coordinates are 1-based, the same as HlaSequence features. The exons and introns are named by their IMGT number.
+    featureCoordinates = []
+    exonIndex = 0
+    intronIndex = 0
+    for feature in sorted((feature for feature in seqRecord.features if feature.type in ('UTR', 'exon', 'intron')), key=lambda feature: int(feature.location.start)):
+        featureNumber = feature.qualifiers.get('number', [None])[0]
+        if (feature.type == 'exon'):
+            exonIndex = int(featureNumber) if featureNumber is not None and str(featureNumber).isdigit() else exonIndex + 1
+            featureName = 'EX' + str(exonIndex)
+        elif (feature.type == 'intron'):
+            intronIndex = int(featureNumber) if featureNumber is not None and str(featureNumber).isdigit() else intronIndex + 1
+            featureName = 'I' + str(intronIndex)
+        else:
+            # The 5' UTR comes before the first exon.
+            featureName = '5UT' if exonIndex == 0 else '3UT'
+        featureCoordinates.append((featureName, int(feature.location.start) + 1, int(feature.location.end), feature.type == 'exon'))
+    return featureCoordinates
+
+def readReferenceAlleles(databaseFullPath, locus):
+    # Returns the genomic reference alleles of one locus (without "HLA-") from the reference_allele table.
+    # A tuple of (alleleName, annotatedSequence), in the order they were loaded.
+    logging.debug('Reading the reference alleles for locus ' + str(locus) + ' from ' + str(databaseFullPath))
+    return getReferenceDatabase(databaseFullPath).getLocusAlleles(locus)
@@ -0,0 +1,78 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from gzip import open as openGzip
+
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+from saddlebags.HlaSequenceException import HlaSequenceException
+
+import logging
+
+# Read the records of a FASTA or FASTQ file one at a time, for example the consensus sequences of a sequencing run.
+# The format is found once from the first characters, and the file is parsed once. Gzipped files are opened as text.
+# The records are not kept, so a large file is never held in memory. The parsers return plain strings instead of SeqRecords.
+
+# Number of characters read to find the format.
+sniffLength = 1024
+
+gzipMagicBytes = b'\x1f\x8b'
+
+def sniffSequenceFormat(sequenceText):
+    # Returns 'fasta' or 'fastq' from the start of a text, None if it is neither (a plain sequence for example).
+    sequenceText = sequenceText.lstrip()
+    if (sequenceText.startswith('>')):
+        return 'fasta'
+    elif (sequenceText.startswith('@')):
+        return 'fastq'
+    return None
+
+def openSequenceFile(sequenceFileName):
+    # Open a FASTA or FASTQ file as text. A gzipped file is decompressed while it is read.
+    with open(sequenceFileName, 'rb') as sequenceFile:
+        isGzipped = sequenceFile.read(2) == gzipMagicBytes
+    if (isGzipped):
+        return openGzip(sequenceFileName, 'rt')
+    return open(sequenceFileName, 'r')
+
+def sniffSequenceHandle(sequenceHandle):
+    # The format of an open text handle. The handle is moved back to where it was.
+    handlePosition = sequenceHandle.tell()
+    sequenceFormat = sniffSequenceFormat(sequenceHandle.read(sniffLength))
+    sequenceHandle.seek(handlePosition)
+    return sequenceFormat
+
+def iterateSequenceRecords(sequenceHandle, sequenceFormat=None):
+    # Yields a tuple (recordName, sequence) for each record of a FASTA or FASTQ text handle, in order.
+    # recordName is the first word of the header line.
+    if (sequenceFormat is None):
+        sequenceFormat = sniffSequenceHandle(sequenceHandle)
+    if (sequenceFormat == 'fasta'):
+        for recordTitle, sequence in SimpleFastaParser(sequenceHandle):
+            yield (recordTitle.split()[0] if len(recordTitle.split()) > 0 else ''), sequence
+    elif (sequenceFormat == 'fastq'):
+        for recordTitle, sequence, qualityText in FastqGeneralIterator(sequenceHandle):
+            yield (recordTitle.split()[0] if len(recordTitle.split()) > 0 else ''), sequence
+    else:
+        raise HlaSequenceException('The input is not in FASTA or FASTQ format.')
+
+def iterateSequenceFile(sequenceFileName):
+    # Yields a tuple (recordName, sequence) for each record of a FASTA or FASTQ file, gzipped or not.
+    with openSequenceFile(sequenceFileName) as sequenceHandle:
+        sequenceFormat = sniffSequenceHandle(sequenceHandle)
+        logging.debug('Reading ' + str(sequenceFormat) + ' records from ' + str(sequenceFileName))
+        for sequenceRecord in iterateSequenceRecords(sequenceHandle, sequenceFormat):
+            yield sequenceRecord
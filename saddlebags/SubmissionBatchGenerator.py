@@ -0,0 +1,167 @@
+# This file is part of saddle-bags.
+#
+# saddle-bags is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# saddle-bags is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with saddle-bags. If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from io import StringIO
+from os import cpu_count
+from sys import exc_info
+
+from saddlebags.AlleleSubCommon import setHeadlessMode
+from saddlebags.EnaSubGenerator import EnaSubGenerator
+from saddlebags.IpdSubGenerator import IpdSubGenerator
+
+import logging
+
+# Generate the ENA or IPD flatfiles for a whole submission batch, optionally in parallel worker processes.
+# Each worker receives the batch information (submitter, lab...) once, and the allele submissions in chunks.
+# The results are returned in the same order as the submissions in the batch.
+# Without workers, writeSubmissionBatch streams each submission directly into its destination file.
+
+# The batch information and submission format, copied into each worker process when it starts.
+workerSubmissionBatch = None
+workerSubmissionFormat = None
+
+def initializeGenerationWorker(submissionBatch, submissionFormat):
+    global workerSubmissionBatch
+    global workerSubmissionFormat
+
+    # Nobody will see a popup box in a worker process.
+    setHeadlessMode(True)
+    workerSubmissionBatch = submissionBatch
+    workerSubmissionFormat = submissionFormat
+
+def runGenerationWorker(submission):
+    return generateSubmissionText(submission, workerSubmissionBatch, workerSubmissionFormat)
+
+def writeSubmission(submission, submissionBatch, submissionFormat, outputStream):
+    # Generate one submission straight into a text stream.
+    # Returns None if the submission was written, otherwise the error message. Nothing is written if the submission fails.
+    try:
+        if (submissionFormat == 'ENA'):
+            enaGenerator = EnaSubGenerator()
+            enaGenerator.submission = submission
+            enaGenerator.submissionBatch = submissionBatch
+            if (not enaGenerator.writeENASubmission(outputStream)):
+                return 'Inputs do not look valid to generate an ENA submission.'
+
+        elif (submissionFormat == 'IPD'):
+            ipdGenerator = IpdSubGenerator()
+            ipdGenerator.submission = submission
+            ipdGenerator.submissionBatch = submissionBatch
+            ipdGenerator.writeIpdSubmission(outputStream)
+
+        else:
+            raise Exception('Unknown submission format, expected ENA or IPD:' + str(submissionFormat))
+
+        return None
+
+    except Exception:
+        logging.error('Could not generate a submission for allele ' + str(submission.localAlleleName) + ':' + str(exc_info()[1]))
+        return str(exc_info()[1])
+
+def generateSubmissionText(submission, submissionBatch, submissionFormat):
+    # Returns a tuple (submissionText, isPseudoGene, translationResult, errorMessage). submissionText is None if the submission failed.
+    # The pseudogene flag and the translation are found during generation, they are returned because a worker process only has a copy of the submission.
+    documentBuffer = StringIO()
+    submission.translationResult = None
+    errorMessage = writeSubmission(submission, submissionBatch, submissionFormat, documentBuffer)
+    submissionText = documentBuffer.getvalue() if errorMessage is None else None
+    return submissionText, submission.isPseudoGene, submission.translationResult, errorMessage
+
+def getWorkerCount(submissionCount, workerCount):
+    # workerCount<1 means one worker process per CPU. There is no point in more workers than submissions.
+    if (workerCount is None or workerCount < 1):
+        workerCount = cpu_count()
+    return min(workerCount, submissionCount)
+
+def iterateWorkerResults(submissionBatch, submissionFormat, workerCount, chunkSize):
+    # Generate the submissions in worker processes. Yields a tuple (submission, submissionText, errorMessage), in order.
+    # chunkSize<1 picks a chunk size that gives each worker about four chunks.
+    submissions = submissionBatch.submissionBatch
+    if (chunkSize is None or chunkSize < 1):
+        chunkSize = max(1, len(submissions) // (workerCount * 4))
+
+    logging.info('Generating ' + str(len(submissions)) + ' ' + str(submissionFormat) + ' submissions using '
+        + str(workerCount) + ' worker processes, in chunks of ' + str(chunkSize))
+
+    # The workers don't need the list of submissions, they get those one chunk at a time.
+    batchInformation = copy(submissionBatch)
+    batchInformation.submissionBatch = []
+
+    with ProcessPoolExecutor(max_workers=workerCount, initializer=initializeGenerationWorker
+        , initargs=(batchInformation, submissionFormat)) as executor:
+        workerResults = executor.map(runGenerationWorker, submissions, chunksize=chunkSize)
+        for submission, (submissionText, isPseudoGene, translationResult, errorMessage) in zip(submissions, workerResults):
+            submission.isPseudoGene = isPseudoGene
+            submission.translationResult = translationResult
+            yield submission, submissionText, errorMessage
+
+def iterateSubmissionTexts(submissionBatch, submissionFormat, workerCount=1, chunkSize=0):
+    # Yields a tuple (submission, submissionText, errorMessage) for each submission in the batch, in order.
+    # workerCount=1 generates in this process. workerCount<1 uses one worker process per CPU.
+    workerCount = getWorkerCount(len(submissionBatch.submissionBatch), workerCount)
+
+    if (workerCount <= 1):
+        for submission in submissionBatch.submissionBatch:
+            submissionText, isPseudoGene, translationResult, errorMessage = generateSubmissionText(submission, submissionBatch, submissionFormat)
+            yield submission, submissionText, errorMessage
+    else:
+        for workerResult in iterateWorkerResults(submissionBatch, submissionFormat, workerCount, chunkSize):
+            yield workerResult
+
+def writeSubmissionBatch(submissionBatch, submissionFormat, openOutputStream, workerCount=1, chunkSize=0):
+    # Write each submission in the batch to the text stream returned by openOutputStream(submission), in order.
+    # Yields a tuple (submission, outputStream, errorMessage) after each submission, so the caller can close the stream.
+    # With a single worker the generators write straight into the destination stream, the text is never held as a string.
+    # Only the worker processes return the submissions as strings, because the text has to get back to this process.
+    workerCount = getWorkerCount(len(submissionBatch.submissionBatch), workerCount)
+
+    if (workerCount <= 1):
+        for submission in submissionBatch.submissionBatch:
+            outputStream = openOutputStream(submission)
+            submission.translationResult = None
+            yield submission, outputStream, writeSubmission(submission, submissionBatch, submissionFormat, outputStream)
+    else:
+        for submission, submissionText, errorMessage in iterateWorkerResults(submissionBatch, submissionFormat, workerCount, chunkSize):
+            outputStream = openOutputStream(submission)
+            if (submissionText is not None):
+                outputStream.write(submissionText)
+            yield submission, outputStream, errorMessage
+
+def generateSubmissionBatch(submissionBatch, submissionFormat, workerCount=1, chunkSize=0):
+    # Generate every submission in the batch, and store the text in the submission (enaSubmissionText or ipdSubmissionText).
+    # Returns the number of submissions that could not be generated.
+    failureCount = 0
+    for submission, submissionText, errorMessage in iterateSubmissionTexts(submissionBatch, submissionFormat, workerCount, chunkSize):
+        if (submissionFormat == 'ENA'):
+            submission.enaSubmissionText = submissionText
+        else:
+            submission.ipdSubmissionText = submissionText
+        if (submissionText is None):
+            failureCount += 1
+    return failureCount
+
+def getTranslationReport(submissionBatch):
+    # One line for each submission with a problem in the translation, to report once after the whole batch.
+    reportLines = []
+    for submission in submissionBatch.submissionBatch:
+        translationResult = submission.translationResult
+        if (translationResult is not None and translationResult.warningTitle is not None):
+            reportLines.append(str(submission.localAlleleName) + ': ' + translationResult.warningTitle + ' (first stop codon: '
+                + ('none' if translationResult.stopCodonLocation == -1 else str(translationResult.stopCodonLocation + 1) + '/' + str(len(translationResult.translatedProtein)))
+                + ', ' + str(translationResult.frameRemainder) + ' nucleotide(s) after the last codon'
+                + (', /pseudo' if translationResult.isPseudoGene else '') + ')')
+    return reportLines
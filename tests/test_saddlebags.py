@@ -9,23 +9,57 @@ from nose.tools import assert_equal, assert_true
 #from saddlebags.AlleleSubCommon import identifyGenomicFeatures, parseExons, fetchSequenceAnnotation, clearGlobalVariables,\
 #    initializeGlobalVariables, assignIfNotExists,\
 #    initializeLog,cleanSequence,loadFromCSV, createIPDZipFile, parseTypedAlleleInput, showYesNoBox
-from saddlebags.AlleleSubCommon import getSaddlebagsDirectory
+from saddlebags.AlleleSubCommon import getSaddlebagsDirectory, setHeadlessMode
 
-from saddlebags.SaddlebagsConfig import getConfigurationValue, assignConfigurationValue, writeConfigurationFile, initializeGlobalVariables, loadConfigurationFile
-from saddlebags.Logging import initializeLog
+from saddlebags.SaddlebagsConfig import getConfigurationValue, assignConfigurationValue, writeConfigurationFile, initializeGlobalVariables, loadConfigurationFile, loadFromSequenceFile
+from saddlebags.Logging import initializeLog, configurePayloadLogging, isPayloadLogged
 #from saddlebags.HlaSequence import fetchAnnotationJson, identifyFeaturesFromJson
+from saddlebags.HlaSequence import HlaSequence, FeatureTable, findFeatureBoundaries, collectAndValidateRoughSequence, cleanAndCheckSequence, cleanSequence
+from saddlebags.SequenceFileReader import iterateSequenceFile
+from saddlebags.EmblFlatfile import writeSequenceBlock
+from saddlebags.SubmissionBatchGenerator import iterateSubmissionTexts, generateSubmissionBatch, getTranslationReport
+from saddlebags.AnnotationServiceClient import AnnotationServiceClient
+from saddlebags.AlleleSubMainCli import runCommandLine
+from saddlebags.BatchAnnotation import annotateSequencesUsingService
+from saddlebags.AnnotationCache import AnnotationCache
+from saddlebags.AnnotationResponse import decodeAnnotationFeatures, findAnnotationResponseError
 
 from saddlebags.EnaSubGenerator import EnaSubGenerator
+from saddlebags.HlaSequenceException import HlaSequenceException
 from saddlebags.IpdSubGenerator import IpdSubGenerator
 from saddlebags.AlleleSubmission import SubmissionBatch, AlleleSubmission
 from saddlebags.IpdGoogleDriveUpload import uploadZipToIpdHla
 from saddlebags.EnaSub import performBatchEnaSubmission
 
-from saddlebags.SequenceAnnotation import connectSqliteDatabase, createTable, setupBioSqlDatabase, loadHLADataIntoBioSql
+from saddlebags.SequenceAnnotation import connectSqliteDatabase, createTable, setupBioSqlDatabase, loadHLADataIntoBioSql, getAnnotatedReferenceSequence\
+    , loadHLADataIntoSqlite, updateHLADataInSqlite, readReferenceAlleles, getLoadedReleaseVersion
+from saddlebags.LocalAnnotation import LocalAnnotator, annotateSequenceLocally, createAligner, projectAnnotation, CheckedBandedAligner
+from saddlebags.ReferenceIndex import writeReferenceIndex, readReferenceIndex
+from saddlebags.ReferenceDatabase import getReferenceDatabase, ReferenceDatabase
+from saddlebags.CodonTranslation import translateCodingSequence, validateTranslation
+from saddlebags.BandedAlignment import BandedAligner, alignBanded
+from saddlebags.AlleleDifferences import findSequenceDifferences, describeAlleleDifferences, describeNovelAlleles, describeAminoAcidChange
 
+from os import environ, utime, listdir
 from os.path import join, expanduser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
 
 from json import dumps
+from gzip import decompress, open as openGzip
+from urllib.parse import parse_qs, urlparse
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from random import Random
+from collections import Counter
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqFeature import SeqFeature, FeatureLocation
+from Bio.Alphabet import generic_dna
+from Bio import SeqIO
 
 initializeLog()
 
@@ -57,6 +91,688 @@ def testCreateAndQueryDatabase():
     loadHLADataIntoBioSql(databaseLocation, hlaDataFolder)
 
 
+def testAnnotatedSequenceCache():
+    # The annotated sequence is cached, but it must be rebuilt when the sequence is re-annotated.
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = 'aagCGTCGTccgGGCTGAaat'
+    hlaSequence.identifyFeaturesFromFormattedSequence()
+    assert_equal(hlaSequence.getAnnotatedSequence(includeLineBreaks=False), 'aagCGTCGTccgGGCTGAaat')
+    assert_equal(hlaSequence.getAnnotatedSequence(includeLineBreaks=True), 'aag\nCGTCGT\nccg\nGGCTGA\naat\n')
+    assert_equal(hlaSequence.getExonSequence(), 'CGTCGTGGCTGA')
+    assert_equal(hlaSequence.totalLength(), 21)
+
+    hlaSequence.rawSequence = 'ccGGGtt'
+    hlaSequence.identifyFeaturesFromFormattedSequence()
+    assert_equal(hlaSequence.getAnnotatedSequence(includeLineBreaks=False), 'ccGGGtt')
+    assert_equal(hlaSequence.getExonSequence(), 'GGG')
+    assert_equal(hlaSequence.totalLength(), 7)
+
+
+def testFeatureTable():
+    # Features are views into the FeatureTable, they should behave like the old GeneFeature objects.
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = 'aagCGTCGTccgGGCTGAaat'
+    hlaSequence.identifyFeaturesFromFormattedSequence()
+    assert_equal(len(hlaSequence.features), 5)
+    assert_equal([feature.name for feature in hlaSequence.features], ['5UT', 'EX1', 'I1', 'EX2', '3UT'])
+    assert_equal(hlaSequence.features[1].sequence, 'CGTCGT')
+    assert_equal((hlaSequence.features[3].beginIndex, hlaSequence.features[3].endIndex), (13, 18))
+    assert_true(hlaSequence.features[3].exon)
+    # The annotated sequence is the buffer of the table, not a copy.
+    assert_true(hlaSequence.getAnnotatedSequence(includeLineBreaks=False) is hlaSequence.features.sequenceBuffer)
+
+    # A table built one feature at a time is the same, the sequences are joined once when the buffer is read.
+    appendedTable = FeatureTable()
+    for feature in hlaSequence.features:
+        appendedTable.append(feature)
+    assert_equal(len(appendedTable.sequenceChunks), 6)
+    assert_equal(appendedTable.sequenceBuffer, 'aagCGTCGTccgGGCTGAaat')
+    assert_equal(len(appendedTable.sequenceChunks), 1)
+    assert_equal([feature.sequence for feature in appendedTable], ['aag', 'CGTCGT', 'ccg', 'GGCTGA', 'aat'])
+
+    # Modifying a feature in place should update the cached sequences.
+    hlaSequence.features[1].sequence = 'CCCC'
+    assert_equal(hlaSequence.getAnnotatedSequence(includeLineBreaks=False), 'aagCCCCccgGGCTGAaat')
+    assert_equal(hlaSequence.getExonSequence(), 'CCCCGGCTGA')
+    hlaSequence.features[3].exon = False
+    assert_equal(hlaSequence.getExonSequence(), 'CCCC')
+
+
+def testIdentifyFeaturesFromJson():
+    # A response from the ACT service with a 5' UTR, one exon and a 3' UTR.
+    setHeadlessMode(True)
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = 'aagCGTCGTaat'
+    hlaSequence.identifyFeaturesFromJson(dumps({'locus': 'HLA-A', 'features': [
+        {'term': 'five_prime_UTR', 'rank': 1, 'sequence': 'AAG'}
+        , {'term': 'exon', 'rank': 1, 'sequence': 'CGTCGT'}
+        , {'term': 'three_prime_UTR', 'rank': 1, 'sequence': 'AAT'}]}))
+    assert_equal(len(hlaSequence.features), 3)
+    assert_equal([feature.name for feature in hlaSequence.features], ['5UT', 'EX1', '3UT'])
+    assert_equal(hlaSequence.getAnnotatedSequence(includeLineBreaks=False), 'aagCGTCGTaat')
+
+    # The bytes of a response are parsed without decoding them first.
+    hlaSequence.rawSequence = 'ccGGGtt'
+    hlaSequence.parseFeaturesFromJson(dumps({'locus': 'HLA-A', 'features': [
+        {'term': 'five_prime_UTR', 'rank': 1, 'sequence': 'cc'}
+        , {'term': 'exon', 'rank': 1, 'sequence': 'ggg'}
+        , {'term': 'three_prime_UTR', 'rank': 1, 'sequence': 'TT'}]}).encode('utf8'))
+    assert_equal(hlaSequence.getAnnotatedSequence(includeLineBreaks=False), 'ccGGGtt')
+
+
+def testDecodeAnnotationFeatures():
+    responseBody = dumps({'locus': 'HLA-A', 'features': [{'term': 'five_prime_UTR', 'sequence': 'aag'}, {'term': 'exon', 'sequence': 'CGT'}]})
+    assert_equal(decodeAnnotationFeatures(responseBody), [('five_prime_UTR', 'aag', False), ('exon', 'CGT', True)])
+    assert_equal(decodeAnnotationFeatures(responseBody.encode('utf8')), [('five_prime_UTR', 'aag', False), ('exon', 'CGT', True)])
+    for badResponse in (b'{"features": []}', b'{"locus": "HLA-A", "typing": []}', b'{"locus": "HLA-A", "features": [{"term": "gene", "sequence": "A"}]}'):
+        try:
+            decodeAnnotationFeatures(badResponse)
+            assert_true(False)
+        except HlaSequenceException:
+            pass
+
+    assert_equal(findAnnotationResponseError(b'{"features": []}'), None)
+    assert_true(findAnnotationResponseError(b'') is not None)
+    assert_true('502 Bad Gateway' in findAnnotationResponseError(b'<html><head><title>502 Bad Gateway</title></head></html>'))
+
+
+def testFindFeatureBoundaries():
+    # Nonstandard characters stay inside the current feature, leading ones are part of the 5' UTR.
+    assert_equal(findFeatureBoundaries('aagCGTccgGGCaat'), [(0, 3, False), (3, 6, True), (6, 9, False), (9, 12, True), (12, 15, False)])
+    assert_equal(findFeatureBoundaries('NNacgTNCnnGt'), [(0, 5, False), (5, 11, True), (11, 12, False)])
+    assert_equal(findFeatureBoundaries('NNACGtt'), [(0, 2, False), (2, 5, True), (5, 7, False)])
+    assert_equal(findFeatureBoundaries('NNN'), [(0, 3, False)])
+    assert_equal(findFeatureBoundaries(''), [])
+
+def testCleanAndCheckSequence():
+    # Whitespace is removed, and the nonstandard characters are counted.
+    assert_equal(cleanAndCheckSequence('acg T\nAC\r\n\tgt'), ('acgTACgt', Counter(), None))
+    assert_equal(cleanAndCheckSequence('acgN\nRNct'), ('acgNRNct', Counter({'N': 2, 'R': 1}), 3))
+    # Characters that are not ASCII are nonstandard too.
+    assert_equal(cleanAndCheckSequence('ac gT\u00e9a'), ('acgT\u00e9a', Counter({'\u00e9': 1}), 4))
+    assert_equal(cleanAndCheckSequence(None), (None, Counter(), None))
+    assert_equal(cleanSequence(' aC\tg\n'), 'aCg')
+
+    # The result is cached on the HlaSequence until the raw sequence changes.
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = 'aag CGT\nNaat'
+    assert_equal(hlaSequence.checkRawSequence(), ('aagCGTNaat', Counter({'N': 1}), 6))
+    assert_true(hlaSequence.checkRawSequence() is hlaSequence.checkRawSequence())
+    hlaSequence.rawSequence = 'cc gg'
+    assert_equal(hlaSequence.getCleanedSequence(), 'ccgg')
+
+def testLocalAnnotation():
+    # An IMGT reference record, exons are uppercase.
+    referenceRecord = SeqRecord(Seq('AAGCGTCGTCCGGGCAAT'), name='HLA00001', features=[
+        SeqFeature(FeatureLocation(0, 3), type='UTR'), SeqFeature(FeatureLocation(3, 9), type='exon')
+        , SeqFeature(FeatureLocation(9, 12), type='intron'), SeqFeature(FeatureLocation(12, 15), type='exon')
+        , SeqFeature(FeatureLocation(15, 18), type='UTR')])
+    assert_equal(getAnnotatedReferenceSequence(referenceRecord), 'aagCGTCGTccgGGCaat')
+    # cDNA references can't be used to find introns.
+    assert_equal(getAnnotatedReferenceSequence(SeqRecord(Seq('CGTCGT'), features=[SeqFeature(FeatureLocation(0, 6), type='exon')])), None)
+
+    # Random reference alleles, with the same feature lengths and a few differences.
+    randomGenerator = Random(5)
+    featureTemplates = [''.join(randomGenerator.choice('ACGT') for nucleotideIndex in range(featureLength)) for featureLength in (100, 300, 600, 270, 200)]
+    referenceAlleles = []
+    for alleleIndex in range(0, 10):
+        features = []
+        for featureIndex, featureTemplate in enumerate(featureTemplates):
+            featureSequence = list(featureTemplate)
+            for mutationIndex in range(0, 3):
+                featureSequence[randomGenerator.randrange(len(featureSequence))] = randomGenerator.choice('ACGT')
+            features.append(''.join(featureSequence) if featureIndex % 2 == 1 else ''.join(featureSequence).lower())
+        referenceAlleles.append(('HLA-A*01:' + str(alleleIndex + 1).zfill(2), ''.join(features)))
+
+    # The sequence is shorter than the reference at both ends, and has an insertion in the intron.
+    referenceSequence = referenceAlleles[6][1].upper()
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = referenceSequence[30:500] + 'GGG' + referenceSequence[500:1400]
+    closestAlleleName = annotateSequenceLocally(hlaSequence, 'HLA-A', localAnnotator=LocalAnnotator(referenceAlleles))
+    assert_equal(closestAlleleName, 'HLA-A*01:07')
+    assert_equal([(feature.name, feature.beginIndex, feature.endIndex) for feature in hlaSequence.features]
+        , [('5UT', 1, 70), ('EX1', 71, 370), ('I1', 371, 973), ('EX2', 974, 1243), ('3UT', 1244, 1373)])
+
+    # The memory-mapped index on disk finds the same closest allele.
+    indexDirectory = mkdtemp()
+    try:
+        writeReferenceIndex(referenceAlleles, join(indexDirectory, 'SeqAnnDatabase.db'), 'HLA-A')
+        referenceIndex = readReferenceIndex(join(indexDirectory, 'SeqAnnDatabase.db'), 'A')
+        assert_equal(referenceIndex.alleleNames, [alleleName for alleleName, annotatedSequence in referenceAlleles])
+        assert_equal(referenceIndex.findCandidateAlleles(hlaSequence.getAnnotatedSequence(includeLineBreaks=False), 3)[0][0], 6)
+        assert_equal(readReferenceIndex(join(indexDirectory, 'SeqAnnDatabase.db'), 'B'), None)
+    finally:
+        rmtree(indexDirectory)
+
+def writeTestHlaData(hlaDataFolder, referenceSequences, releaseVersion='3.40.0'):
+    # Write a small hla.dat and Allelelist.txt. referenceSequences is a list of tuples (accession, alleleName, annotatedSequence).
+    seqRecords = []
+    for accession, alleleName, annotatedSequence in referenceSequences:
+        seqRecord = SeqRecord(Seq(annotatedSequence.upper(), generic_dna), id=accession + '.1', name=accession, description=alleleName)
+        seqRecord.annotations['molecule_type'] = 'DNA'
+        for featureBegin, featureEnd, isExon in findFeatureBoundaries(annotatedSequence):
+            seqRecord.features.append(SeqFeature(FeatureLocation(featureBegin, featureEnd)
+                , type='exon' if isExon else ('UTR' if featureBegin == 0 or featureEnd == len(annotatedSequence) else 'intron')))
+        seqRecords.append(seqRecord)
+    SeqIO.write(seqRecords, join(hlaDataFolder, 'hla.dat'), 'embl')
+    with open(join(hlaDataFolder, 'Allelelist.txt'), 'w') as alleleListFile:
+        alleleListFile.write('# version: IPD-IMGT/HLA ' + releaseVersion + '\nAlleleID,Allele\n')
+        alleleListFile.write(''.join(accession + ',' + alleleName + '\n' for accession, alleleName, annotatedSequence in referenceSequences))
+
+def testLoadHLADataIntoSqlite():
+    hlaDataFolder = mkdtemp()
+    try:
+        writeTestHlaData(hlaDataFolder, [('HLA00001', 'A*01:01:01:01', 'aagCGTCGTACGTTGACccgtaagGGCTGACTGAaat')
+            , ('HLA00002', 'A*01:02', 'aagCGTCGTACGTTGACccgtaagGGCTGCCTGAaat'), ('HLA00003', 'B*07:02', 'ttgACGTACGTAGGAcccTTTTGGACCCaa')
+            , ('HLA00004', 'XYZ*01:01', 'aagCGTCGTaat')])
+        databaseFullPath = join(hlaDataFolder, 'SeqAnnDatabase.db')
+        assert_equal(loadHLADataIntoSqlite(databaseFullPath, hlaDataFolder), 3)
+        # Loading the same release again replaces the alleles.
+        assert_equal(loadHLADataIntoSqlite(databaseFullPath, hlaDataFolder), 3)
+        assert_equal(list(readReferenceAlleles(databaseFullPath, 'A')), [('HLA-A*01:01:01:01', 'aagCGTCGTACGTTGACccgtaagGGCTGACTGAaat')
+            , ('HLA-A*01:02', 'aagCGTCGTACGTTGACccgtaagGGCTGCCTGAaat')])
+        assert_equal(readReferenceIndex(databaseFullPath, 'B').alleleNames, ['HLA-B*07:02'])
+        assert_equal(getLoadedReleaseVersion(databaseFullPath), 'IPD-IMGT/HLA 3.40.0')
+
+        # The read-only lookups, from several threads at once.
+        referenceDatabase = getReferenceDatabase(databaseFullPath)
+        lookupResults = []
+        lookupThreads = [Thread(target=lambda: lookupResults.append(referenceDatabase.queryFeatureCoordinates('HLA-A*01:02'))) for threadIndex in range(0, 8)]
+        for lookupThread in lookupThreads:
+            lookupThread.start()
+        for lookupThread in lookupThreads:
+            lookupThread.join()
+        assert_equal(lookupResults, [(('5UT', 1, 3, False), ('EX1', 4, 17, True), ('I1', 18, 24, False), ('EX2', 25, 34, True), ('3UT', 35, 37, False))] * 8)
+        assert_equal(referenceDatabase.getAllele('HLA-B*07:02'), ('HLA-B*07:02', 'B', 'HLA00003', 'TTGACGTACGTAGGACCCTTTTGGACCCAA', 'ttgACGTACGTAGGAcccTTTTGGACCCaa'
+            , 'ACGTACGTAGGATTTTGGACCC'))
+        assert_equal(referenceDatabase.getExonSequence('HLA-A*01:02'), 'CGTCGTACGTTGACGGCTGCCTGA')
+        assert_equal(referenceDatabase.getAllele('HLA-B*07:03'), None)
+        assert_equal(referenceDatabase.getLocusAlleleNames('HLA-A'), ('HLA-A*01:01:01:01', 'HLA-A*01:02'))
+
+        # A reader in another process, it has its own connections and caches.
+        otherProcessDatabase = ReferenceDatabase(databaseFullPath)
+        assert_equal(otherProcessDatabase.getAllele('HLA-B*07:02')[2], 'HLA00003')
+
+        # The same release is not loaded again. In the next release one allele changed, one was removed and one is new.
+        assert_equal(updateHLADataInSqlite(databaseFullPath, hlaDataFolder), (0, 0, 0))
+        writeTestHlaData(hlaDataFolder, [('HLA00001', 'A*01:01:01:01', 'aagCGTCGTACGTTGACccgtaagGGCTGACTGAaat')
+            , ('HLA00002', 'A*01:02', 'aagCGTCGTACGTTGACccgtaagtGGCTGCCTGAaat'), ('HLA00005', 'A*01:03', 'aagCGTCGTACGTTGACccgtGGCTGCCTGAaat')]
+            , releaseVersion='3.41.0')
+        assert_equal(updateHLADataInSqlite(databaseFullPath, hlaDataFolder), (1, 1, 1))
+        assert_equal(list(readReferenceAlleles(databaseFullPath, 'A')), [('HLA-A*01:01:01:01', 'aagCGTCGTACGTTGACccgtaagGGCTGACTGAaat')
+            , ('HLA-A*01:02', 'aagCGTCGTACGTTGACccgtaagtGGCTGCCTGAaat'), ('HLA-A*01:03', 'aagCGTCGTACGTTGACccgtGGCTGCCTGAaat')])
+        assert_equal(list(readReferenceAlleles(databaseFullPath, 'B')), [])
+        assert_equal(getReferenceDatabase(databaseFullPath).getAllele('HLA-B*07:02'), None)
+        assert_equal(getReferenceDatabase(databaseFullPath).getFeatureCoordinates('HLA-A*01:02')[2], ('I1', 18, 25, False))
+        assert_equal(getReferenceDatabase(databaseFullPath).getFeatureCoordinates('HLA-B*07:02'), ())
+        assert_equal(readReferenceIndex(databaseFullPath, 'A').alleleNames, ['HLA-A*01:01:01:01', 'HLA-A*01:02', 'HLA-A*01:03'])
+        assert_equal(getLoadedReleaseVersion(databaseFullPath), 'IPD-IMGT/HLA 3.41.0')
+        assert_equal([fileName for fileName in listdir(hlaDataFolder) if fileName.endswith('.tmp')], [])
+
+        # The other reader notices that the database was replaced, the next time it checks the file.
+        otherProcessDatabase.lastFileCheck = float('-inf')
+        assert_equal(otherProcessDatabase.getAllele('HLA-B*07:02'), None)
+        assert_equal(otherProcessDatabase.getFeatureCoordinates('HLA-A*01:02')[2], ('I1', 18, 25, False))
+    finally:
+        rmtree(hlaDataFolder)
+
+def testTranslateCodingSequence():
+    assert_equal(translateCodingSequence('ATGGCCAAAGGCTGA'), ('MAKG*', 4, 0))
+    assert_equal(translateCodingSequence('atgTAGgcNaaRcNNgg'), ('M*AKX', 1, 2))
+    assert_equal(translateCodingSequence(''), ('', -1, 0))
+    translationResult = validateTranslation('ATGTAGGCCTGAC')
+    assert_equal((translationResult.proteinSequence, translationResult.stopCodonLocation, translationResult.frameRemainder, translationResult.isPseudoGene)
+        , ('M', 1, 1, True))
+    assert_equal(translationResult.warningTitle, 'Premature Stop Codon Detected')
+    assert_equal(validateTranslation('ATGGCCTGA').warningMessage, None)
+    # The same protein as biopython.
+    randomGenerator = Random(7)
+    for sequenceIndex in range(0, 50):
+        nucleotideSequence = ''.join(randomGenerator.choice('ACGTacgtNRY') for nucleotideIndex in range(0, randomGenerator.randint(0, 200)))
+        assert_equal(translateCodingSequence(nucleotideSequence)[0], str(Seq(nucleotideSequence[0:len(nucleotideSequence) // 3 * 3], generic_dna).translate()))
+
+def testBandedAlignment():
+    assert_equal(alignBanded('AAAACCCCGGGGTTTT', 'CCCCGGGG').getCigarString(), '4D8M4D')
+    assert_equal(alignBanded('ACGTTACGT', 'ACGTACGT').aligned, (((0, 3), (4, 9)), ((0, 3), (3, 8))))
+
+    # The same scores as the PairwiseAligner, for sequences with substitutions, insertions and deletions.
+    randomGenerator = Random(3)
+    pairwiseAligner = createAligner()
+    for sequenceIndex in range(0, 20):
+        referenceSequence = ''.join(randomGenerator.choice('ACGT') for nucleotideIndex in range(0, randomGenerator.randint(100, 1500)))
+        querySequence = list(referenceSequence[randomGenerator.randint(0, 30):])
+        for differenceIndex in range(0, randomGenerator.randint(0, 6)):
+            differencePosition = randomGenerator.randrange(len(querySequence))
+            querySequence[differencePosition:differencePosition + randomGenerator.randint(0, 25)] = randomGenerator.choice('ACGT') * randomGenerator.randint(0, 25)
+        querySequence = ''.join(querySequence)
+        assert_equal(alignBanded(referenceSequence, querySequence).score, pairwiseAligner.score(referenceSequence, querySequence))
+
+    annotatedReference = 'aagCGTCGTACGTTGACccgtaagGGCTGACTGAaat'
+    assert_equal(projectAnnotation(annotatedReference, 'AAGCGTCGTACGTTGACCCGTAAGTTGGCTGACTGAAAT', BandedAligner()), 'aagCGTCGTACGTTGACccgtaagttGGCTGACTGAaat')
+
+    # Long replaced stretches can put the best alignment outside of the band. The checked aligner falls back to the PairwiseAligner.
+    randomGenerator = Random(11)
+    checkedAligner = CheckedBandedAligner()
+    lowerScoreCount = 0
+    for sequenceIndex in range(0, 45):
+        referenceSequence = ''.join(randomGenerator.choice('ACGT') for nucleotideIndex in range(0, randomGenerator.randint(100, 800)))
+        querySequence = list(referenceSequence[randomGenerator.randint(0, 30):])
+        for differenceIndex in range(0, randomGenerator.randint(0, 8)):
+            differencePosition = randomGenerator.randrange(len(querySequence))
+            querySequence[differencePosition:differencePosition + randomGenerator.randint(0, 150)] = randomGenerator.choice('ACGT') * randomGenerator.randint(0, 150)
+        querySequence = ''.join(querySequence)
+        pairwiseScore = pairwiseAligner.score(referenceSequence, querySequence)
+        if (alignBanded(referenceSequence, querySequence).score < pairwiseScore):
+            lowerScoreCount += 1
+        assert_equal(checkedAligner.align(referenceSequence, querySequence)[0].score, pairwiseScore)
+    assert_true(lowerScoreCount > 0)
+
+def testDescribeNovelAlleles():
+    featureCoordinates = (('5UT', 1, 3, False), ('EX1', 4, 17, True), ('I1', 18, 24, False), ('EX2', 25, 34, True), ('3UT', 35, 37, False))
+    referenceSequence = 'aagCGTCGTACGTTGACccgtaagGGCTGACTGAaat'
+    aligner = createAligner()
+    assert_equal(findSequenceDifferences(referenceSequence, 'AAGCGTCATACGTTGACCCGTAAGGGCTGACTGAAAT', aligner), [(8, 'G', 'A')])
+    assert_equal(findSequenceDifferences(referenceSequence, 'AAGCGTCGTACGTTGACCCGTAAGTTGGCTGACTGAAAT', aligner), [(24, '', 'TT')])
+    assert_equal(findSequenceDifferences(referenceSequence, 'AAGCGTCGTACGTTGACCCGTGGCTGACTGAAAT', aligner), [(22, 'AAG', '')])
+    assert_equal(describeAlleleDifferences('A*01:01:01:01new', 'HLA-A*01:01:01:01', [(8, 'G', 'A')], featureCoordinates, 'CGTCGTACGTTGACGGCTGACTGA')
+        , 'A*01:01:01:01new is identical to A*01:01:01:01 except for position 8 (EX1) is an A instead of G, codon -23 changes from R to H.')
+    assert_equal(describeAlleleDifferences('XYZ*01:01new', 'HLA-XYZ*01:01', [(8, 'G', 'T')], featureCoordinates, 'CGTCGTACGTTGACGGCTGACTGA')
+        , 'XYZ*01:01new is identical to XYZ*01:01 except for position 8 (EX1) is a T instead of G, codon 2 (counted from the start codon) changes from R to L.')
+    # The signal peptide of HLA-A is 24 codons long, the mature protein starts at codon 1.
+    codingSequence = 'ATG' + 'GCC' * 30
+    assert_equal(describeAminoAcidChange(codingSequence, 69, 'A', 'HLA-A'), 'codon -1 changes from A to T')
+    assert_equal(describeAminoAcidChange(codingSequence, 72, 'A', 'HLA-A'), 'codon 1 changes from A to T')
+    assert_equal(describeAlleleDifferences('A*01:01:01:01new', 'HLA-A*01:01:01:01', [(22, 'AAG', ''), (26, '', 'T')], featureCoordinates, 'CGTCGTACGTTGACGGCTGACTGA')
+        , 'A*01:01:01:01new is identical to A*01:01:01:01 except for these differences:\n'
+        + 'a deletion of positions 22-24 (I1).\nan insertion of T after position 26 (EX2), causing a frameshift.')
+
+    # The closest allele is found in the local database. A description from the user is kept.
+    hlaDataFolder = mkdtemp()
+    try:
+        writeTestHlaData(hlaDataFolder, [('HLA00001', 'A*01:01:01:01', referenceSequence), ('HLA00002', 'A*01:02', 'aagCGTCGTACGTTGACccgtaagGGCTGCCTGAaat')])
+        databaseFullPath = join(hlaDataFolder, 'SeqAnnDatabase.db')
+        loadHLADataIntoSqlite(databaseFullPath, hlaDataFolder)
+        submissionBatch = SubmissionBatch(False)
+        for localAlleleName, annotatedSequence, closestAlleleWrittenDescription in [('Allele_1', 'aagCGTCGTACGTTGACccgtaagGGCTGACTAAaat', None)
+            , ('Allele_2', 'aagCGTCGTACGTTGACccgtaagGGCTGCCTGAaat', 'From the user.')]:
+            submission = AlleleSubmission()
+            submission.localAlleleName = localAlleleName
+            submission.submittedAllele.rawSequence = annotatedSequence
+            submission.submittedAllele.geneLocus = 'HLA-A'
+            submission.closestAlleleWrittenDescription = closestAlleleWrittenDescription
+            submissionBatch.submissionBatch.append(submission)
+        assert_equal([errorMessage for submission, errorMessage in describeNovelAlleles(submissionBatch, databaseFullPath)], [None, None])
+        assert_equal(submissionBatch.submissionBatch[0].closestAlleleWrittenDescription, 'Allele_1 is identical to A*01:01:01:01 except for position 33 (EX2) is an A instead of G.')
+        assert_equal(submissionBatch.submissionBatch[1].closestAlleleWrittenDescription, 'From the user.')
+    finally:
+        rmtree(hlaDataFolder)
+
+def testLoadFromSequenceFile():
+    assert_equal(collectAndValidateRoughSequence('>Allele_1 consensus\naagCGT\nccgTGAaa\n'), 'aagCGTccgTGAaa')
+    assert_equal(collectAndValidateRoughSequence('@Allele_1\nACGT\n+\nIIII\n'), 'ACGT')
+    assert_equal(collectAndValidateRoughSequence('acgt ACGT\n'), 'acgtACGT')
+
+    sequenceFolder = mkdtemp()
+    try:
+        # The format is found from the first character, a gzipped file is read the same way.
+        fastaFileName = join(sequenceFolder, 'consensus.fasta')
+        with open(fastaFileName, 'w') as fastaFile:
+            fastaFile.write('>Allele_1 read count 250\naagCGTCGT\nccgTGAaa\n>Allele_2\nACGTACGT\n')
+        fastqFileName = join(sequenceFolder, 'consensus.fastq.gz')
+        with openGzip(fastqFileName, 'wt') as fastqFile:
+            fastqFile.write('@Allele_1\naagCGTCGTccgTGAaa\n+\nIIIIIIIIIIIIIIIII\n@Allele_2\nACGTACGT\n+\n@IIIIIII\n')
+        assert_equal(list(iterateSequenceFile(fastaFileName)), [('Allele_1', 'aagCGTCGTccgTGAaa'), ('Allele_2', 'ACGTACGT')])
+        assert_equal(list(iterateSequenceFile(fastqFileName)), list(iterateSequenceFile(fastaFileName)))
+
+        # Each record is a submission in the batch.
+        assignConfigurationValue('submission_batch', SubmissionBatch(False))
+        submissionBatch = loadFromSequenceFile(fastqFileName, 'HLA-A', '1')
+        assert_equal([submission.localAlleleName for submission in submissionBatch.submissionBatch], ['Allele_1', 'Allele_2'])
+        assert_equal(submissionBatch.submissionBatch[0].submittedAllele.getExonSequence(), 'CGTCGTTGA')
+        assert_equal(submissionBatch.submissionBatch[1].submittedAllele.geneLocus, 'HLA-A')
+    finally:
+        assignConfigurationValue('submission_batch', None)
+        rmtree(sequenceFolder)
+
+def testLazyLogging():
+    # Configuration values are not formatted for debug messages that are not written.
+    class CountedValue():
+        def __init__(self):
+            self.formatCount = 0
+        def __str__(self):
+            self.formatCount += 1
+            return 'CountedValue'
+
+    rootLogger = logging.getLogger()
+    previousLevel = rootLogger.level
+    countedValue = CountedValue()
+    try:
+        rootLogger.setLevel(logging.INFO)
+        assignConfigurationValue('counted_value', countedValue)
+        assert_true(getConfigurationValue('counted_value') is countedValue)
+        assert_equal(countedValue.formatCount, 0)
+
+        # Payloads are only logged if log_payloads is on, and the level is enabled.
+        configurePayloadLogging(True)
+        assert_true(not isPayloadLogged())
+        assert_true(isPayloadLogged(logging.INFO))
+        configurePayloadLogging(False)
+        assert_true(not isPayloadLogged(logging.ERROR))
+    finally:
+        rootLogger.setLevel(previousLevel)
+        configurePayloadLogging(False)
+        assignConfigurationValue('counted_value', None)
+
+def testWriteSequenceBlock():
+    sequenceText = StringIO()
+    writeSequenceBlock(sequenceText, 'aacgtACGTAAAACCCCGGGGTTTTacgtnacgtacgtacgtacgtacgtacgtacgtacgtACGTACGTACGTNN')
+    assert_equal(sequenceText.getvalue(),
+        'SQ   Sequence 76 BP; 19 A; 18 C; 18 G; 18 T; 3 other;\n'
+        + '     aacgtACGTA AAACCCCGGG GTTTTacgtn acgtacgtac gtacgtacgt acgtacgtac 60\n'
+        + '     gtACGTACGT ACGTNN                                                 76\n')
+
+def testWriteEnaSubmission():
+    # The ENA submission is written to a stream, buildENASubmission returns the same text.
+    enaGenerator = EnaSubGenerator()
+    enaGenerator.submission.submittedAllele.rawSequence = 'aagtcATGGCCAAAGGCTGAggct'
+    enaGenerator.submission.submittedAllele.identifyFeaturesFromFormattedSequence()
+    enaGenerator.submission.submittedAllele.geneLocus = 'HLA-A'
+    enaGenerator.submission.submittedAllele.hlaClass = '1'
+    enaGenerator.submission.localAlleleName = 'Allele_1'
+    enaGenerator.submission.cellId = 'Sample_1'
+
+    submissionText = StringIO()
+    assert_true(enaGenerator.writeENASubmission(submissionText))
+    assert_equal(submissionText.getvalue(), enaGenerator.buildENASubmission())
+    assert_true(submissionText.getvalue().startswith('ID   XXX; XXX; linear; genomic DNA; XXX; XXX; 24 BP.\n'))
+    assert_true('FT   mRNA            join(1..5,6..20,21..24)\n' in submissionText.getvalue())
+    assert_true(submissionText.getvalue().endswith(' 24\n//\n'))
+
+    # Nothing is written without a sample ID.
+    enaGenerator.submission.cellId = None
+    submissionText = StringIO()
+    assert_true(not enaGenerator.writeENASubmission(submissionText))
+    assert_equal(submissionText.getvalue(), '')
+    assert_equal(enaGenerator.buildENASubmission(), None)
+
+    # A sequence without a 3' UTR fails in the features section. The header was already generated, but it is not written.
+    enaGenerator.submission.cellId = 'Sample_1'
+    enaGenerator.submission.submittedAllele.rawSequence = 'aagtcATGGCCAAAGGCTGA'
+    enaGenerator.submission.submittedAllele.identifyFeaturesFromFormattedSequence()
+    submissionText = StringIO()
+    try:
+        enaGenerator.writeENASubmission(submissionText)
+        assert_true(False)
+    except HlaSequenceException:
+        pass
+    assert_equal(submissionText.getvalue(), '')
+
+def testParallelSubmissionGeneration():
+    # Worker processes return the same submissions as generating them one at a time, in the same order.
+    # There is no display for the translation warnings.
+    setHeadlessMode(True)
+    submissionBatch = SubmissionBatch(False)
+    for alleleIndex, annotatedSequence in enumerate(['aagtcATGGCCAAAGGCTGAggct', 'aagtcATGGCCAAAGGCTAggct', 'ATGGCC', 'ccATGTGAaa']):
+        submission = AlleleSubmission()
+        submission.submittedAllele.rawSequence = annotatedSequence
+        submission.submittedAllele.identifyFeaturesFromFormattedSequence()
+        submission.submittedAllele.geneLocus = 'HLA-A'
+        submission.submittedAllele.hlaClass = '1'
+        submission.localAlleleName = 'Allele_' + str(alleleIndex)
+        submission.cellId = 'Sample_' + str(alleleIndex)
+        submissionBatch.submissionBatch.append(submission)
+
+    serialResults = list(iterateSubmissionTexts(submissionBatch, 'ENA', workerCount=1))
+    for submission in submissionBatch.submissionBatch:
+        submission.isPseudoGene = None
+    assert_equal(generateSubmissionBatch(submissionBatch, 'ENA', workerCount=2, chunkSize=1), 1)
+
+    assert_equal([submission.localAlleleName for submission, submissionText, errorMessage in serialResults], ['Allele_0', 'Allele_1', 'Allele_2', 'Allele_3'])
+    assert_equal([submission.enaSubmissionText for submission in submissionBatch.submissionBatch], [submissionText for submission, submissionText, errorMessage in serialResults])
+    # The missing UTRs are reported for the third allele, the pseudogene flags come back from the workers.
+    assert_true('UTR' in serialResults[2][2])
+    assert_equal([submission.isPseudoGene for submission in submissionBatch.submissionBatch], [False, True, True, False])
+    # The translation problems come back from the workers too, for one report of the batch.
+    assert_equal(getTranslationReport(submissionBatch), ['Allele_1: No Stop Codon Found (first stop codon: none, 2 nucleotide(s) after the last codon, /pseudo)'
+        , 'Allele_2: No Stop Codon Found (first stop codon: none, 0 nucleotide(s) after the last codon, /pseudo)'])
+
+def testCommandLine():
+    # Run the headless commands on a small .csv file. The configuration is written to a temporary home directory.
+    previousHome = environ.get('HOME')
+    temporaryDirectory = mkdtemp()
+    environ['HOME'] = temporaryDirectory
+    try:
+        csvFileName = join(temporaryDirectory, 'submissions.csv')
+        with open(csvFileName, 'w') as csvFile:
+            csvFile.write('class,cellbank,cellid,citations,closestallelewrittendescription,consanguineous,ethnicorigin,genelocus,homozygous'
+                + ',ipdsubmissionidentifier,ipdsubmissionversion,enasequenceaccession,localallelename,materialavailability,methodcomments'
+                + ',numofreactions,primarysequencingmethodology,primers,primertype,secondarysequencingmethodology,sequencedinisolation'
+                + ',sequencingdirection,sex,typedalleles,sequence\n')
+            csvFile.write('1,,Sample_1,,,,,HLA-A,,HWS1,1,,Allele_1,,,,,,,,,,,,aagtcATGGCCAAAGGCTGAggct\n')
+            csvFile.write('1,,Sample_2,,,,,HLA-A,,HWS2,1,,Allele_2,,,,,,,,,,,,aagtcATGGCCAAAGGCTGA\n')
+
+        # The second allele has no 3' UTR.
+        assert_equal(runCommandLine(['validate', csvFileName, '-w', '1']), 1)
+
+        outputFileName = join(temporaryDirectory, 'ENA.HLA.Submission.txt')
+        assert_equal(runCommandLine(['convert-ena', csvFileName, '-o', outputFileName, '-w', '1']), 1)
+        with open(outputFileName, 'r') as outputFile:
+            enaText = outputFile.read()
+        # Only the complete entry is in the flatfile.
+        assert_equal(enaText.count('//\n'), 1)
+        assert_true('/allele="Allele_1"' in enaText)
+        assert_true('Allele_2' not in enaText)
+
+        # With --annotate the exons come from the ACT service. The fake service finds a 3' UTR in the second allele too.
+        fakeServer = ThreadingHTTPServer(('127.0.0.1', 0), FakeActHandler)
+        Thread(target=fakeServer.serve_forever, daemon=True).start()
+        previousRequestURL = getConfigurationValue('nmdp_act_rest_address')
+        assignConfigurationValue('nmdp_act_rest_address', 'http://127.0.0.1:' + str(fakeServer.server_address[1]) + '/annotate')
+        writeConfigurationFile()
+        FakeActHandler.requestMethods = []
+        try:
+            assert_equal(runCommandLine(['convert-ena', csvFileName, '-o', outputFileName, '-w', '1', '--annotate', '-n', '2']), 0)
+        finally:
+            assignConfigurationValue('nmdp_act_rest_address', previousRequestURL)
+            fakeServer.shutdown()
+        assert_equal(len(FakeActHandler.requestMethods), 2)
+        with open(outputFileName, 'r') as outputFile:
+            enaText = outputFile.read()
+        assert_equal(enaText.count('//\n'), 2)
+        assert_true('/allele="Allele_2"' in enaText)
+
+    finally:
+        if (previousHome is None):
+            del environ['HOME']
+        else:
+            environ['HOME'] = previousHome
+        rmtree(temporaryDirectory)
+
+class FakeAnnotationHandler(BaseHTTPRequestHandler):
+    # A keep-alive web server that remembers which client port every request came from.
+    protocol_version = 'HTTP/1.1'
+    clientPorts = []
+
+    def do_GET(self):
+        FakeAnnotationHandler.clientPorts.append(self.client_address[1])
+        responseBody = b'{"features": []}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(responseBody)))
+        self.end_headers()
+        self.wfile.write(responseBody)
+
+    def log_message(self, *args):
+        pass
+
+def testAnnotationServiceClientReusesConnections():
+    fakeServer = ThreadingHTTPServer(('127.0.0.1', 0), FakeAnnotationHandler)
+    Thread(target=fakeServer.serve_forever, daemon=True).start()
+    requestURL = 'http://127.0.0.1:' + str(fakeServer.server_address[1]) + '/annotate'
+
+    annotationClient = AnnotationServiceClient(connectTimeout=5, requestTimeout=5)
+    for sequenceIndex in range(5):
+        hlaSequence = HlaSequence()
+        hlaSequence.rawSequence = 'ACGT' * (sequenceIndex + 1)
+        assert_equal(hlaSequence.fetchAnnotationJson(rawRequestURL=requestURL, annotationClient=annotationClient, useCache=False), b'{"features": []}')
+
+    annotationClient.close()
+    fakeServer.shutdown()
+    # This server doesn't accept POST, so the client switched to GET after the first request. All of the GET requests used the same connection.
+    assert_equal(len(FakeAnnotationHandler.clientPorts), 5)
+    assert_equal(len(set(FakeAnnotationHandler.clientPorts)), 1)
+
+class FakeActHandler(BaseHTTPRequestHandler):
+    # Annotates the sequence in the request like the ACT service: a 3 nucleotide UTR on each end, the rest is one exon.
+    # Sequences with an N get an html error page.
+    protocol_version = 'HTTP/1.1'
+    requestMethods = []
+
+    def do_GET(self):
+        FakeActHandler.requestMethods.append('GET')
+        self.sendAnnotation(parse_qs(urlparse(self.path).query)['sequence'][0])
+
+    def do_POST(self):
+        FakeActHandler.requestMethods.append('POST')
+        requestBody = self.rfile.read(int(self.headers['Content-Length']))
+        if (self.headers.get('Content-Encoding') == 'gzip'):
+            requestBody = decompress(requestBody)
+        self.sendAnnotation(parse_qs(requestBody.decode('utf8'))['sequence'][0])
+
+    def sendAnnotation(self, sequence):
+        if ('N' in sequence):
+            responseBody = b'<html><head><title>500 Internal Server Error</title></head></html>'
+        else:
+            responseBody = dumps({'locus': 'HLA-A', 'features': [
+                {'term': 'five_prime_UTR', 'rank': 1, 'sequence': sequence[0:3]}
+                , {'term': 'exon', 'rank': 1, 'sequence': sequence[3:-3]}
+                , {'term': 'three_prime_UTR', 'rank': 1, 'sequence': sequence[-3:]}]}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(responseBody)))
+        self.end_headers()
+        self.wfile.write(responseBody)
+
+    def log_message(self, *args):
+        pass
+
+def testAnnotateSequencesUsingService():
+    fakeServer = ThreadingHTTPServer(('127.0.0.1', 0), FakeActHandler)
+    Thread(target=fakeServer.serve_forever, daemon=True).start()
+    requestURL = 'http://127.0.0.1:' + str(fakeServer.server_address[1]) + '/annotate'
+
+    hlaSequences = []
+    for rawSequence in ['AAGCGTCGTAAT', 'CCCNTTTGGG', 'TTAGGGGGGCCA', '', 'GGATGTGATT']:
+        hlaSequence = HlaSequence()
+        hlaSequence.rawSequence = rawSequence
+        hlaSequences.append(hlaSequence)
+
+    FakeActHandler.requestMethods = []
+    annotationClient = AnnotationServiceClient(connectTimeout=5, requestTimeout=5)
+    errorMessages = annotateSequencesUsingService(hlaSequences, requestURL, maxInFlight=2, annotationClient=annotationClient, useCache=False)
+
+    # A single sequence is parsed from the response bytes as well.
+    singleSequence = HlaSequence()
+    singleSequence.rawSequence = 'AAGCGTCGTAAT'
+    singleSequence.annotateSequenceUsingService(rawRequestURL=requestURL, annotationClient=annotationClient, useCache=False)
+    assert_equal(singleSequence.getAnnotatedSequence(includeLineBreaks=False), 'aagCGTCGTaat')
+    annotationClient.close()
+    fakeServer.shutdown()
+
+    assert_true('GET' not in FakeActHandler.requestMethods)
+    # The results are in the same order as the sequences, a failure doesn't stop the rest of the batch.
+    assert_equal([errorMessage is None for errorMessage in errorMessages], [True, False, True, False, True])
+    assert_true('500 Internal Server Error' in errorMessages[1])
+    assert_equal(hlaSequences[0].getAnnotatedSequence(includeLineBreaks=False), 'aagCGTCGTaat')
+    assert_equal(hlaSequences[2].getExonSequence(), 'GGGGGG')
+    assert_equal(len(hlaSequences[1].features), 0)
+    assert_equal([feature.name for feature in hlaSequences[4].features], ['5UT', 'EX1', '3UT'])
+
+def testAnnotationCache():
+    temporaryDirectory = mkdtemp()
+    try:
+        annotationCache = AnnotationCache(cacheDirectory=temporaryDirectory, maximumAgeDays=1, maximumSizeMb=1)
+        # The key is the cleaned, uppercase sequence and the service address.
+        annotationCache.store('aagCGTaat', 'http://act/annotate', '{"features": [1]}')
+        assert_equal(annotationCache.lookup('AAGCGTAAT', 'http://act/annotate'), '{"features": [1]}')
+        assert_equal(annotationCache.lookup('AAGCGTAAT', 'http://other/annotate'), None)
+        assert_equal(annotationCache.lookup('AAGCGTAAA', 'http://act/annotate'), None)
+
+        # Old annotations are deleted.
+        cacheFileName = annotationCache.getCacheFileName('AAGCGTAAT', 'http://act/annotate')
+        utime(cacheFileName, (0, 0))
+        assert_equal(annotationCache.lookup('AAGCGTAAT', 'http://act/annotate'), None)
+
+        # The least recently used annotations are deleted first when the cache is too big.
+        annotationCache.maximumSize = 150
+        for sequenceIndex in range(4):
+            annotationCache.store('ACGT' * (sequenceIndex + 1), 'http://act/annotate', 'x' * 50)
+            utime(annotationCache.getCacheFileName('ACGT' * (sequenceIndex + 1), 'http://act/annotate'), (time() - 100 + sequenceIndex, time() - 100 + sequenceIndex))
+        assert_equal(annotationCache.evict(), 1)
+        assert_equal(annotationCache.lookup('ACGT', 'http://act/annotate'), None)
+        assert_equal(annotationCache.lookup('ACGTACGT', 'http://act/annotate'), 'x' * 50)
+    finally:
+        rmtree(temporaryDirectory)
+
+class FakeMissingHandler(BaseHTTPRequestHandler):
+    # A web server without the annotation service, every request is answered with 404.
+    protocol_version = 'HTTP/1.1'
+    requestMethods = []
+
+    def do_GET(self):
+        self.sendNotFound('GET')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.sendNotFound('POST')
+
+    def sendNotFound(self, requestMethod):
+        FakeMissingHandler.requestMethods.append(requestMethod)
+        responseBody = b'<html><head><title>404 Not Found</title></head></html>'
+        self.send_response(404)
+        self.send_header('Content-Length', str(len(responseBody)))
+        self.end_headers()
+        self.wfile.write(responseBody)
+
+    def log_message(self, *args):
+        pass
+
+def testAnnotationPostRequests():
+    # A long sequence does not fit in a URL, it is sent in the body of a POST request.
+    setHeadlessMode(True)
+    fakeServer = ThreadingHTTPServer(('127.0.0.1', 0), FakeActHandler)
+    Thread(target=fakeServer.serve_forever, daemon=True).start()
+    requestURL = 'http://127.0.0.1:' + str(fakeServer.server_address[1]) + '/annotate'
+    longSequence = 'AAG' + 'CGT' * 25000 + 'AAT'
+
+    FakeActHandler.requestMethods = []
+    annotationClient = AnnotationServiceClient(connectTimeout=5, requestTimeout=5, compressRequests=True)
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = longSequence
+    hlaSequence.annotateSequenceUsingService(rawRequestURL=requestURL, annotationClient=annotationClient, useCache=False)
+    annotationClient.close()
+    assert_equal(FakeActHandler.requestMethods, ['POST'])
+    assert_equal(hlaSequence.getExonSequence(), 'CGT' * 25000)
+
+    # The same sequence in the URL is too long for the web server.
+    annotationClient = AnnotationServiceClient(connectTimeout=5, requestTimeout=5, usePost=False)
+    hlaSequence = HlaSequence()
+    hlaSequence.rawSequence = longSequence
+    hlaSequence.annotateSequenceUsingService(rawRequestURL=requestURL, annotationClient=annotationClient, useCache=False)
+    annotationClient.close()
+    fakeServer.shutdown()
+    assert_equal(len(hlaSequence.features), 0)
+
+    # A wrong URL is not mistaken for a service that doesn't accept POST, the requests are not sent again with GET.
+    fakeServer = ThreadingHTTPServer(('127.0.0.1', 0), FakeMissingHandler)
+    Thread(target=fakeServer.serve_forever, daemon=True).start()
+    requestURL = 'http://127.0.0.1:' + str(fakeServer.server_address[1]) + '/wrong'
+    FakeMissingHandler.requestMethods = []
+    annotationClient = AnnotationServiceClient(connectTimeout=5, requestTimeout=5)
+    assert_equal(annotationClient.performAnnotation(requestURL, {'sequence': 'AAGCGTAAT'})[0], 404)
+    batchResults = annotationClient.performAnnotationBatch(requestURL, [{'sequence': 'AAGCGTAAT'}, {'sequence': 'AAGCCCAAT'}])
+    annotationClient.close()
+    fakeServer.shutdown()
+    assert_equal([responseCode for responseCode, responseBody, errorMessage in batchResults], [404, 404])
+    assert_equal(FakeMissingHandler.requestMethods, ['POST', 'POST', 'POST'])
 
 
 # def testLoadConfigAndBatchEnaSubmission():